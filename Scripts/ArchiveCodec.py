@@ -0,0 +1,157 @@
+""" Codecs of the daily archives, shared by the uploader, the reprocessing
+and the benchmark. An archive is a zip file either way: with the "zip"
+codec, each hourly file is a DEFLATE member; with the "zstd" codec, each
+one is a stored member NAME.zst of independent zstd frames of about 1 MB,
+compressed with a dictionary trained on the tweets of recent hours, and
+the dictionary is a member of the archive too. The dictionary keeps the
+small frames almost as dense as one large frame, and any frame can be
+read on its own. Importing this module has no side effects, and
+zstandard is only needed by the zstd codec. """
+
+import io
+import random
+import re
+import zipfile
+from typing import Callable
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODECS = ("zip", "zstd")
+ZSTD_SUFFIX = ".zst"
+ZSTD_LEVEL = 9
+# Frames end with the first line past this size
+FRAME_SIZE = 1048576
+# Member of a zstd archive with the dictionary of its frames, named after
+# the id zstd gives the dictionary and writes in every frame
+DICT_PATTERN = re.compile(r"^dictionary-(\d+)\.zdict$")
+DICT_SIZE = 112640
+# Tweets sampled from the recent hours to train a dictionary
+DICT_SAMPLES = 50000
+
+
+def require_zstd() -> None:
+    if zstandard is None:
+        raise ValueError("The zstd codec needs the zstandard package")
+
+
+def dictionary_name(dict_id: int) -> str:
+    return f"dictionary-{dict_id}.zdict"
+
+
+def sample_lines(names: list, opener: Callable,
+                 num_samples: int = DICT_SAMPLES, seed: int = 0) -> list:
+    """ Sample lines evenly from hourly files, opened in binary by
+    opener(name), with a reservoir per file """
+    rng = random.Random(seed)
+    quota = max(1, num_samples // max(1, len(names)))
+    samples = []
+    for name in names:
+        reservoir = []
+        with opener(name) as inf:
+            for i, line in enumerate(inf):
+                if len(reservoir) < quota:
+                    reservoir.append(line)
+                else:
+                    j = rng.randrange(i + 1)
+                    if j < quota:
+                        reservoir[j] = line
+        samples.extend(reservoir)
+    return samples
+
+
+def train_dictionary(samples: list) -> (int, bytes):
+    """ Train a dictionary on sample lines, return its id and content """
+    require_zstd()
+    try:
+        trained = zstandard.train_dictionary(DICT_SIZE, samples,
+                                             level = ZSTD_LEVEL)
+    except zstandard.ZstdError as e:
+        raise ValueError(f"Cannot train a dictionary on {len(samples)} "
+                         f"lines: {e}")
+    return trained.dict_id(), trained.as_bytes()
+
+
+class FrameWriter:
+    """ Write text as independent zstd frames, each ending with a line.
+    Close it to write the last frame and close the file. """
+
+    def __init__(self, fp, cctx):
+        self.__fp = fp
+        self.__cctx = cctx
+        self.__buf = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def write(self, data: bytes) -> int:
+        self.__buf += data
+        while True:
+            end = self.__buf.find(b"\n", FRAME_SIZE - 1) + 1
+            if end == 0:
+                break
+            self.__fp.write(self.__cctx.compress(bytes(self.__buf[:end])))
+            del self.__buf[:end]
+        return len(data)
+
+    def close(self) -> None:
+        if len(self.__buf) > 0:
+            self.__fp.write(self.__cctx.compress(bytes(self.__buf)))
+            self.__buf.clear()
+        self.__fp.close()
+
+
+def zstd_contexts(dictionary: bytes, level: int = ZSTD_LEVEL) -> tuple:
+    """ Compression and decompression contexts of a dictionary, or of none """
+    require_zstd()
+    kwargs = {} if dictionary is None else {
+        "dict_data": zstandard.ZstdCompressionDict(dictionary)}
+    return zstandard.ZstdCompressor(level = level, write_checksum = True,
+                                    **kwargs), \
+        zstandard.ZstdDecompressor(**kwargs)
+
+
+def open_member_writer(zf: zipfile.ZipFile, name: str, dictionary: bytes,
+                       force_zip64: bool):
+    """ Open a member of an archive for the text of an hourly file, a
+    DEFLATE member without dictionary, zstd frames with one. Close it to
+    finish the member. In an archive written to an unseekable file, the
+    sizes and CRC of the stored zstd member follow it in a data descriptor,
+    as those of a DEFLATE member do. """
+    if dictionary is None:
+        return zf.open(name, "w", force_zip64 = force_zip64)
+    info = zipfile.ZipInfo(name + ZSTD_SUFFIX)
+    info.compress_type = zipfile.ZIP_STORED
+    cctx, _ = zstd_contexts(dictionary)
+    return FrameWriter(zf.open(info, "w", force_zip64 = force_zip64), cctx)
+
+
+def hour_members(zf: zipfile.ZipFile, pattern: re.Pattern) -> list:
+    """ Names of the hourly files of an archive, whatever its codec """
+    names = []
+    for n in zf.namelist():
+        name = n[:-len(ZSTD_SUFFIX)] if n.endswith(ZSTD_SUFFIX) else n
+        if pattern.match(name):
+            names.append(name)
+    return sorted(names)
+
+
+def open_member(zf: zipfile.ZipFile, name: str):
+    """ Open the text of an hourly file in an archive, as binary """
+    members = set(zf.namelist())
+    if name in members:
+        return zf.open(name, "r")
+    require_zstd()
+    dictionaries = [n for n in members if DICT_PATTERN.match(n)]
+    if len(dictionaries) != 1:
+        raise ValueError(f"{zf.filename} has {len(dictionaries)} "
+                         f"dictionaries")
+    _, dctx = zstd_contexts(zf.read(dictionaries[0]))
+    return io.BufferedReader(dctx.stream_reader(
+        zf.open(name + ZSTD_SUFFIX, "r"), read_across_frames = True,
+        closefd = True))
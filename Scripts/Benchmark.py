@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+import zlib
+from functools import partial
+
+from ArchiveCodec import ZSTD_LEVEL, FrameWriter, hour_members, \
+    open_member, sample_lines, train_dictionary, zstd_contexts
+from SegmentWriter import MmapSegmentWriter
+from TweetNormalizer import get_profile, is_valid_tweet, normalize_tweet, \
+    parse_created_at, project_json, read_profiles, scan_raw_tweet, trim_json
+
+# Fields Twitter always returns, whatever is requested
+DEFAULT_FIELDS = {
+    "tweet_fields": ["id", "text", "edit_history_tweet_ids"],
+    "user_fields": ["id", "name", "username"],
+    "media_fields": ["media_key", "type"],
+    "place_fields": ["id", "full_name"],
+    "poll_fields": ["id", "options"],
+}
+
+# Objects under "includes", the fields option describing them and the
+# expansions that bring them in
+INCLUDES = {
+    "users": ("user_fields", ["author_id", "in_reply_to_user_id",
+                              "entities.mentions.username",
+                              "referenced_tweets.id.author_id"]),
+    "media": ("media_fields", ["attachments.media_keys"]),
+    "places": ("place_fields", ["geo.place_id"]),
+    "polls": ("poll_fields", ["attachments.poll_ids"]),
+    "tweets": ("tweet_fields", ["referenced_tweets.id"]),
+}
+
+
+def usage() -> None:
+    name = os.path.basename(__file__)
+    print(f"Usage: {name} profiles CRAWLER_SETTINGS_FILE REPLAY_FILE")
+    print(f"       {name} ingest CRAWLER_SETTINGS_FILE REPLAY_FILE")
+    print(f"       {name} writer REPLAY_FILE [DIRECTORY [NUM_TWEETS]]")
+    print(f"       {name} startup [CRAWLER_SETTINGS_FILE "
+          f"UPLOADER_SETTINGS_FILE]")
+    print(f"       {name} archive ZIP_FILE [ZIP_FILE ...]")
+    print()
+    print("REPLAY_FILE has one tweet per line, either raw stream payloads or")
+    print("an hourly file written by the crawler. ZIP_FILE is a day archived")
+    print("by the uploader, with any codec.")
+    sys.exit(0)
+
+
+def read_replay(path: str):
+    with open(path, "r") as inf:
+        for line in inf:
+            line = line.rstrip("\n")
+            if len(line) > 0:
+                yield line
+
+
+def strip_object(jobj, fields: set) -> None:
+    if type(jobj) is not dict:
+        return
+    for key in list(jobj.keys()):
+        if key not in fields:
+            del jobj[key]
+
+
+def emulate_request(tweet: dict, profile: dict) -> None:
+    """ Remove what the stream would not send for the requested fields and
+    expansions of a profile """
+    strip_object(tweet.get("data"), set(profile["tweet_fields"]) |
+                 set(DEFAULT_FIELDS["tweet_fields"]))
+    includes = tweet.get("includes", {})
+    for name, (option, expansions) in INCLUDES.items():
+        if name not in includes:
+            continue
+        if not any(e in profile["expansions"] for e in expansions):
+            del includes[name]
+            continue
+        fields = set(profile[option]) | set(DEFAULT_FIELDS[option])
+        for obj in includes[name]:
+            strip_object(obj, fields)
+
+
+def bench_profiles(settings_path: str, replay_path: str) -> None:
+    """ Report received and stored bytes per tweet, and the time spent on
+    parsing, projecting and serializing, for every profile """
+    profiles, _ = read_profiles(settings_path)
+    rows = []
+    for name in sorted(profiles.keys(), key = lambda n: (n != "full", n)):
+        profile = get_profile(profiles, name)
+        num_tweets = 0
+        num_invalid = 0
+        received = 0
+        stored = 0
+        elapsed = 0.0
+        for line in read_replay(replay_path):
+            tweet = json.loads(line)
+            emulate_request(tweet, profile)
+            payload = json.dumps(tweet, separators = (",", ":"))
+            received += len(payload.encode("utf-8"))
+
+            t = time.perf_counter()
+            tweet = json.loads(payload)
+            if not is_valid_tweet(tweet):
+                elapsed += time.perf_counter() - t
+                num_invalid += 1
+                continue
+            tweet.pop("matching_rules", None)
+            project_json(tweet, profile)
+            trim_json(tweet)
+            data = json.dumps(tweet, separators = (",", ":"),
+                              sort_keys = True) + "\n"
+            elapsed += time.perf_counter() - t
+            stored += len(data.encode("utf-8"))
+            num_tweets += 1
+        rows.append((name, num_tweets, num_invalid, received, stored, elapsed))
+
+    full = rows[0]
+    print(f"{'profile':<16}{'tweets':>9}{'invalid':>9}{'recv B/tw':>11}"
+          f"{'saved':>8}{'store B/tw':>12}{'saved':>8}{'us/tw':>9}")
+    for name, num_tweets, num_invalid, received, stored, elapsed in rows:
+        total = max(1, num_tweets + num_invalid)
+        recv_avg = received / total
+        store_avg = stored / max(1, num_tweets)
+        recv_saved = 1 - received / max(1, full[3])
+        store_saved = 1 - stored / max(1, full[4])
+        print(f"{name:<16}{num_tweets:>9}{num_invalid:>9}{recv_avg:>11.0f}"
+              f"{recv_saved:>8.1%}{store_avg:>12.0f}{store_saved:>8.1%}"
+              f"{elapsed / total * 1e6:>9.1f}")
+
+
+def bench_ingest(settings_path: str, replay_path: str) -> None:
+    """ Compare the time spent on each tweet by the crawler in parsed and
+    raw ingest modes, with the profile in use """
+    profile = get_profile(*read_profiles(settings_path))
+    lines = list(read_replay(replay_path))
+    t = time.perf_counter()
+    for line in lines:
+        tweet = json.loads(line)
+        parse_created_at(tweet["data"]["created_at"])
+        normalize_tweet(tweet, profile)
+    parsed = time.perf_counter() - t
+    t = time.perf_counter()
+    missed = 0
+    for line in lines:
+        tweet_id, created_at = scan_raw_tweet(line)
+        if tweet_id is None or created_at is None:
+            missed += 1
+    raw = time.perf_counter() - t
+    num = max(1, len(lines))
+    print(f"{'mode':<8}{'tweets':>9}{'us/tw':>9}{'tweets/s':>11}")
+    for mode, elapsed in (("parsed", parsed), ("raw", raw)):
+        print(f"{mode:<8}{len(lines):>9}{elapsed / num * 1e6:>9.1f}"
+              f"{num / max(elapsed, 1e-9):>11.0f}")
+    if missed > 0:
+        print(f"{missed} tweets fall back to the parsed mode")
+
+
+def count_extents(path: str):
+    if shutil.which("filefrag") is None:
+        return None
+    try:
+        out = subprocess.run(["filefrag", path], capture_output = True,
+                             text = True, check = True).stdout
+        return int(out.rsplit(":", 1)[1].split()[0])
+    except (OSError, ValueError, IndexError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_writer(replay_path: str, directory: str, num_tweets: int) -> None:
+    """ Compare the text file and the mmap writers of the hourly files,
+    writing the replayed tweets until num_tweets """
+    lines = [line + "\n" for line in read_replay(replay_path)]
+    if len(lines) == 0:
+        return
+    print(f"{'writer':<8}{'tweets':>9}{'MB':>8}{'us/tw':>9}{'MB/s':>8}"
+          f"{'extents':>9}")
+    for name in ("file", "mmap"):
+        path = os.path.join(directory, f"bench-{name}-{os.getpid()}")
+        t = time.perf_counter()
+        if name == "mmap":
+            outf = MmapSegmentWriter(path)
+        else:
+            outf = open(path, "a")
+        for i in range(num_tweets):
+            outf.write(lines[i % len(lines)])
+        outf.close()
+        fd = os.open(path, os.O_RDONLY)
+        os.fsync(fd)
+        os.close(fd)
+        elapsed = time.perf_counter() - t
+        size = os.path.getsize(path) / 1048576
+        extents = count_extents(path)
+        os.remove(path)
+        print(f"{name:<8}{num_tweets:>9}{size:>8.1f}"
+              f"{elapsed / num_tweets * 1e6:>9.2f}{size / elapsed:>8.1f}"
+              f"{'-' if extents is None else extents:>9}")
+
+
+# Hourly files in the archives
+MEMBER_PATTERN = re.compile(
+    r"^([A-Za-z0-9_]+)-(20\d\d[01]\d[0-3]\d)-([0-2]\d)$")
+# Levels of zstd compared with a dictionary
+ZSTD_BENCH_LEVELS = (3, ZSTD_LEVEL, 19)
+
+
+def deflate(data: bytes) -> bytes:
+    """ Compress as a DEFLATE member of the zip codec """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def inflate(data: bytes) -> bytes:
+    return zlib.decompress(data, -15)
+
+
+def compress_frames(cctx, data: bytes) -> bytes:
+    """ Compress as a member of the zstd codec """
+    outf = io.BytesIO()
+    writer = FrameWriter(outf, cctx)
+    writer.write(data)
+    outf.close = lambda: None  # Keep the frames readable
+    writer.close()
+    return outf.getvalue()
+
+
+def decompress_frames(dctx, data: bytes) -> bytes:
+    return dctx.stream_reader(io.BytesIO(data),
+                              read_across_frames = True).read()
+
+
+def bench_archive(zip_paths: list) -> None:
+    """ Compare the zip codec with zstd, with and without a dictionary, on
+    the hours of archived days, compressed in frames as by the zstd codec.
+    The dictionary is trained on the first day and used on the following
+    ones, as the uploader trains it on the hours before; with a single day,
+    it is trained on that day, which flatters it. """
+    with zipfile.ZipFile(zip_paths[0], "r") as zf:
+        t = time.perf_counter()
+        samples = sample_lines(hour_members(zf, MEMBER_PATTERN),
+                               lambda n: open_member(zf, n))
+        dict_id, dictionary = train_dictionary(samples)
+        trained = time.perf_counter() - t
+    print(f"Dictionary {dict_id}: {len(dictionary)} bytes, trained on "
+          f"{len(samples)} tweets of {os.path.basename(zip_paths[0])} in "
+          f"{trained:.1f} s")
+    codecs = [("deflate-9", deflate, inflate)]
+    for level, use_dict in [(ZSTD_LEVEL, False)] + \
+            [(level, True) for level in ZSTD_BENCH_LEVELS]:
+        cctx, dctx = zstd_contexts(dictionary if use_dict else None, level)
+        codecs.append((f"zstd-{level}{'+dict' if use_dict else ''}",
+                       partial(compress_frames, cctx),
+                       partial(decompress_frames, dctx)))
+    test_paths = zip_paths[1:] if len(zip_paths) > 1 else zip_paths
+    # Input bytes, output bytes, compression and decompression seconds
+    totals = {name: [0, 0, 0.0, 0.0] for name, _, _ in codecs}
+    for path in test_paths:
+        with zipfile.ZipFile(path, "r") as zf:
+            for member in hour_members(zf, MEMBER_PATTERN):
+                with open_member(zf, member) as inf:
+                    data = inf.read()
+                for name, compress, decompress in codecs:
+                    t = time.perf_counter()
+                    frame = compress(data)
+                    t2 = time.perf_counter()
+                    if decompress(frame) != data:
+                        raise ValueError(f"{name} changed {member}")
+                    total = totals[name]
+                    total[0] += len(data)
+                    total[1] += len(frame)
+                    total[2] += t2 - t
+                    total[3] += time.perf_counter() - t2
+        for name in totals:
+            if name.endswith("+dict"):
+                # The dictionary is stored in every archive
+                totals[name][1] += len(dictionary)
+    print(f"{'codec':<14}{'MB':>9}{'archive MB':>12}{'ratio':>8}"
+          f"{'comp MB/s':>11}{'decomp MB/s':>13}")
+    for name, (size_in, size_out, comp, decomp) in totals.items():
+        mb = size_in / 1048576
+        print(f"{name:<14}{mb:>9.1f}{size_out / 1048576:>12.1f}"
+              f"{size_in / max(1, size_out):>8.2f}"
+              f"{mb / max(comp, 1e-9):>11.1f}{mb / max(decomp, 1e-9):>13.1f}")
+
+
+# Scripts run by hand or by cron
+ENTRY_POINTS = ("TweetCrawler", "UploaderAndSweeper", "Reprocess",
+                "Benchmark")
+# Run in a new process, prints the seconds spent on the import and setup
+STARTUP_CODE = """
+import sys, time
+t = time.perf_counter()
+import {name} as entry
+imported = time.perf_counter() - t
+t = time.perf_counter()
+setting_path = {setting_path!r}
+if setting_path is not None:
+    entry.setup(setting_path)
+print(imported, time.perf_counter() - t, file = sys.stderr)
+"""
+
+
+def throwaway_settings(path: str, tmp_dir: str) -> str:
+    """ Copy of a settings file in tmp_dir, with the working_dir, the log
+    and the manifest of the copy in tmp_dir too """
+    if path is None:
+        return None
+    out_dir = tempfile.mkdtemp(dir = tmp_dir)
+    working_dir = os.path.join(out_dir, "tweets")
+    os.mkdir(working_dir)
+    copy = os.path.join(out_dir, os.path.basename(path))
+    replaced = {"working_dir": working_dir,
+                "log_file": os.path.join(out_dir, "log.txt"),
+                "manifest_path": ""}
+    with open(path, "r") as inf, open(copy, "w") as outf:
+        for line in inf:
+            if line.split("=", 1)[0].strip() not in replaced:
+                outf.write(line.rstrip("\n") + "\n")
+        for key, val in replaced.items():
+            outf.write(f"{key}={val}\n")
+    return copy
+
+
+def bench_startup(crawler_settings: str, uploader_settings: str,
+                  runs: int = 5) -> None:
+    """ Time the start of each entry point in new processes: the whole
+    process, the import of the script and its setup with the settings
+    given. The setup runs on a throwaway copy of the settings, so it
+    leaves the files of the settings alone. The medians of the runs are
+    reported. """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        time_startup({"TweetCrawler": throwaway_settings(crawler_settings,
+                                                         tmp_dir),
+                      "UploaderAndSweeper": throwaway_settings(
+                          uploader_settings, tmp_dir)}, runs)
+
+
+def time_startup(setting_paths: dict, runs: int) -> None:
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    print(f"{'entry point':<20}{'process ms':>12}{'import ms':>11}"
+          f"{'setup ms':>10}")
+    for name in ENTRY_POINTS:
+        setting_path = setting_paths.get(name)
+        code = STARTUP_CODE.format(name = name, setting_path = setting_path)
+        totals = []
+        imports = []
+        setups = []
+        for _ in range(runs):
+            t = time.perf_counter()
+            result = subprocess.run([sys.executable, "-c", code],
+                                    cwd = script_dir, capture_output = True,
+                                    text = True)
+            totals.append(time.perf_counter() - t)
+            if result.returncode != 0:
+                print(f"{name} failed to start:", file = sys.stderr)
+                print(result.stderr, file = sys.stderr)
+                break
+            imported, setup = result.stderr.strip().splitlines()[-1].split()
+            imports.append(float(imported))
+            setups.append(float(setup))
+        if len(imports) == 0:
+            continue
+        setup_ms = "-" if setting_path is None else \
+            f"{statistics.median(setups) * 1000:.1f}"
+        print(f"{name:<20}{statistics.median(totals) * 1000:>12.1f}"
+              f"{statistics.median(imports) * 1000:>11.1f}{setup_ms:>10}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        usage()
+    if sys.argv[1] == "profiles" and len(sys.argv) == 4:
+        bench_profiles(os.path.abspath(sys.argv[2]),
+                       os.path.abspath(sys.argv[3]))
+    elif sys.argv[1] == "ingest" and len(sys.argv) == 4:
+        bench_ingest(os.path.abspath(sys.argv[2]),
+                     os.path.abspath(sys.argv[3]))
+    elif sys.argv[1] == "writer" and 3 <= len(sys.argv) <= 5:
+        bench_writer(os.path.abspath(sys.argv[2]),
+                     os.path.abspath(sys.argv[3]) if len(sys.argv) > 3
+                     else tempfile.gettempdir(),
+                     int(sys.argv[4]) if len(sys.argv) > 4 else 200000)
+    elif sys.argv[1] == "archive" and len(sys.argv) >= 3:
+        bench_archive([os.path.abspath(p) for p in sys.argv[2:]])
+    elif sys.argv[1] == "startup" and len(sys.argv) in (2, 4):
+        bench_startup(os.path.abspath(sys.argv[2]) if len(sys.argv) > 2
+                      else None,
+                      os.path.abspath(sys.argv[3]) if len(sys.argv) > 3
+                      else None)
+    else:
+        usage()
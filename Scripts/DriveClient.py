@@ -0,0 +1,113 @@
+""" Layer over the Google Drive service of the uploader: it executes single
+requests and batches of metadata requests (get, list, update, delete) over
+the HTTP client of the service, and counts the calls and the time they
+take. Importing this module has no side effects, the Google client
+libraries are only imported when a batch is first sent. """
+
+import time
+import urllib.parse
+
+# Drive accepts at most 100 requests in a batch
+BATCH_SIZE = 100
+BATCH_PATH = "batch/drive/v3"
+# Requests of a batch refused for the rate limit or a server error are sent
+# again in the next batch, up to this many times
+BATCH_RETRIES = 3
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_REASONS = (b"rateLimitExceeded", b"userRateLimitExceeded")
+
+
+def should_retry(e: BaseException) -> bool:
+    status = getattr(getattr(e, "resp", None), "status", None)
+    if status in RETRY_STATUSES:
+        return True
+    content = getattr(e, "content", None) or b""
+    return status == 403 and any(r in content for r in RETRY_REASONS)
+
+
+class DriveClient:
+    """ Execute the requests of a Drive service, alone or in batches, and
+    count them. A batch is one HTTP call whatever the number of requests
+    in it. """
+
+    def __init__(self, service, api_root: str = None):
+        """ Keyword arguments:
+        api_root -- root URL of the API the service was built with, e.g. of
+        a local stand-in, whose batch endpoint is used then
+        """
+        self.service = service
+        self.__api_root = None if api_root is None else \
+            urllib.parse.urlparse(api_root)
+        self.__batch_uri = None if api_root is None else \
+            urllib.parse.urljoin(api_root.rstrip("/") + "/", BATCH_PATH)
+        self.reset()
+
+    def reset(self) -> None:
+        self.requests = 0
+        self.calls = 0
+        self.batches = 0
+        self.seconds = 0.0
+
+    def report(self) -> str:
+        return f"{self.requests} requests in {self.calls} calls " \
+            f"({self.batches} batched), {self.seconds:.3f} s"
+
+    def execute(self, request):
+        """ Execute a single request, e.g. an upload, which cannot be
+        batched """
+        self.requests += 1
+        self.calls += 1
+        if self.__api_root is not None:
+            # The client library moves the host of upload URLs to another
+            # API root, but keeps their https scheme
+            request.uri = urllib.parse.urlparse(request.uri)._replace(
+                scheme = self.__api_root.scheme,
+                netloc = self.__api_root.netloc).geturl()
+        t = time.perf_counter()
+        try:
+            return request.execute()
+        finally:
+            self.seconds += time.perf_counter() - t
+
+    def __new_batch(self, callback):
+        if self.__batch_uri is None:
+            return self.service.new_batch_http_request(callback = callback)
+        from googleapiclient.http import BatchHttpRequest
+        return BatchHttpRequest(callback = callback,
+                                batch_uri = self.__batch_uri)
+
+    def execute_batch(self, requests: list) -> list:
+        """ Execute requests in batches of at most BATCH_SIZE, return the
+        (response, exception) of each one, in order. A batch failing as a
+        whole raises its exception. """
+        results = [(None, None)] * len(requests)
+        pending = list(range(len(requests)))
+        for attempt in range(BATCH_RETRIES + 1):
+            if attempt > 0:
+                time.sleep(min(2 ** attempt, 30))
+            retry = []
+            for start in range(0, len(pending), BATCH_SIZE):
+                chunk = pending[start:start + BATCH_SIZE]
+
+                def callback(request_id, response, exception):
+                    i = int(request_id)
+                    results[i] = (response, exception)
+                    if exception is not None and attempt < BATCH_RETRIES \
+                            and should_retry(exception):
+                        retry.append(i)
+
+                batch = self.__new_batch(callback)
+                for i in chunk:
+                    batch.add(requests[i], request_id = str(i))
+                self.requests += len(chunk)
+                self.calls += 1
+                self.batches += 1
+                t = time.perf_counter()
+                try:
+                    batch.execute()
+                finally:
+                    self.seconds += time.perf_counter() - t
+            if len(retry) == 0:
+                break
+            pending = sorted(retry)
+        return results
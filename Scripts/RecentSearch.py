@@ -0,0 +1,159 @@
+""" Client of the recent search endpoint of the Twitter API, used by the
+uploader to backfill the hours the crawler missed. Importing this module has
+no side effects. """
+
+import json
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+API_ROOT = "https://api.twitter.com"
+SEARCH_PATH = "/2/tweets/search/recent"
+# Only the tweets of the last 7 days can be searched
+SEARCH_DAYS = 7
+MAX_RESULTS = 100
+SEARCH_TIMEOUT = 60
+# Seconds of a rate-limit window, when a refusal does not tell its end
+RATE_LIMIT_WINDOW = 15 * 60
+# Options of a projection profile and the parameters requesting them
+FIELD_PARAMS = {
+    "expansions": "expansions",
+    "media_fields": "media.fields",
+    "place_fields": "place.fields",
+    "poll_fields": "poll.fields",
+    "tweet_fields": "tweet.fields",
+    "user_fields": "user.fields",
+}
+
+
+class RateLimited(Exception):
+    """ No request is left until the rate-limit window resets """
+
+    def __init__(self, reset: float):
+        super().__init__(f"Rate limited until "
+                         f"{datetime.fromtimestamp(reset):%Y-%m-%d %H:%M:%S}")
+        self.reset = reset
+
+
+class InvalidQuery(ValueError):
+    """ The request was refused for its query or parameters """
+
+
+class SearchClient:
+    """ Page through the recent search with the bearer token of the crawler.
+    The requests left in the current rate-limit window are kept from the
+    headers of every response, so the caller can stop before it is refused
+    and carry the budget over to its next run. """
+
+    def __init__(self, bearer_token: str, api_root: str = None,
+                 remaining: int = None, reset: float = 0.0):
+        """ Keyword arguments:
+        api_root -- root URL of the API, e.g. of a local stand-in
+        remaining -- requests left in the window, None if not known
+        reset -- time the window resets, in seconds since the epoch
+        """
+        self.__token = bearer_token
+        self.__url = (api_root or API_ROOT).rstrip("/") + SEARCH_PATH
+        self.remaining = remaining
+        self.reset = reset
+        self.requests = 0
+
+    def can_request(self) -> bool:
+        return self.remaining is None or self.remaining > 0 or \
+            time.time() >= self.reset
+
+    def __update_budget(self, headers) -> None:
+        try:
+            self.remaining = int(headers["x-rate-limit-remaining"])
+            self.reset = float(headers["x-rate-limit-reset"])
+        except (KeyError, TypeError, ValueError):
+            pass
+
+    def search(self, query: str, start_time: datetime, end_time: datetime,
+               fields: dict, next_token: str = None) -> dict:
+        """ Request a page of the tweets matching a query between two UTC
+        times, with the fields and expansions of a profile """
+        params = {"query": query,
+                  "start_time": start_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                  "end_time": end_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                  "max_results": MAX_RESULTS}
+        for option, param in FIELD_PARAMS.items():
+            if len(fields.get(option, [])) > 0:
+                params[param] = ",".join(fields[option])
+        if next_token is not None:
+            params["next_token"] = next_token
+        request = urllib.request.Request(
+            f"{self.__url}?{urllib.parse.urlencode(params)}",
+            headers = {"Authorization": f"Bearer {self.__token}"})
+        self.requests += 1
+        if self.remaining is not None and self.remaining > 0:
+            self.remaining -= 1
+        try:
+            with urllib.request.urlopen(request,
+                                        timeout = SEARCH_TIMEOUT) as response:
+                self.__update_budget(response.headers)
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            self.__update_budget(e.headers)
+            if e.code == 429:
+                self.remaining = 0
+                if self.reset <= time.time():
+                    self.reset = time.time() + RATE_LIMIT_WINDOW
+                raise RateLimited(self.reset)
+            if e.code == 400:
+                detail = e.read().decode("utf-8", "replace")
+                raise InvalidQuery(f"{e}: {detail}")
+            raise
+
+
+def pick(objects: dict, keys: list) -> list:
+    """ The objects of the keys found, in order, without repeats """
+    picked = []
+    for key in keys:
+        obj = objects.get(key)
+        if obj is not None and not any(obj is p for p in picked):
+            picked.append(obj)
+    return picked
+
+
+def page_payloads(page: dict) -> list:
+    """ Split a page of results into one payload per tweet with the objects
+    of "includes" it refers to, as the stream sends them """
+    includes = page.get("includes", {})
+    index = {name: {} for name in ("users", "usernames", "tweets", "media",
+                                   "places", "polls")}
+    for user in includes.get("users", []):
+        index["users"][user.get("id")] = user
+        index["usernames"][user.get("username")] = user
+    for name, key in (("tweets", "id"), ("media", "media_key"),
+                      ("places", "id"), ("polls", "id")):
+        for obj in includes.get(name, []):
+            index[name][obj.get(key)] = obj
+
+    payloads = []
+    for tweet in page.get("data", []):
+        attachments = tweet.get("attachments", {})
+        referenced = pick(index["tweets"], [r.get("id") for r in
+                                            tweet.get("referenced_tweets", [])])
+        users = pick(index["users"], [tweet.get("author_id"),
+                                      tweet.get("in_reply_to_user_id")] +
+                     [r.get("author_id") for r in referenced])
+        for user in pick(index["usernames"], [
+                m.get("username") for m in
+                tweet.get("entities", {}).get("mentions", [])]):
+            if not any(user is u for u in users):
+                users.append(user)
+        tweet_includes = {
+            "users": users,
+            "tweets": referenced,
+            "media": pick(index["media"], attachments.get("media_keys", [])),
+            "places": pick(index["places"],
+                           [tweet.get("geo", {}).get("place_id")]),
+            "polls": pick(index["polls"], attachments.get("poll_ids", [])),
+        }
+        payloads.append({"data": tweet, "includes": {
+            name: objs for name, objs in tweet_includes.items()
+            if len(objs) > 0}})
+    return payloads
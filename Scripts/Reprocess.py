@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+import zipfile
+
+from ArchiveCodec import DICT_PATTERN, hour_members, open_member, \
+    open_member_writer
+from TweetNormalizer import get_profile, normalize_lines, read_profiles
+
+ZIP_PATTERN = re.compile(r"^([A-Za-z0-9_]+)-(20\d\d[01]\d[0-3]\d)\.zip$")
+MEMBER_PATTERN = re.compile(
+    r"^([A-Za-z0-9_]+)-(20\d\d[01]\d[0-3]\d)-([0-2]\d)$")
+# Members and days already reprocessed, in OUTPUT_DIR
+CHECKPOINT_NAME = "reprocess-checkpoint.json"
+
+
+def usage() -> None:
+    name = os.path.basename(__file__)
+    print(f"Usage: {name} CRAWLER_SETTINGS_FILE ARCHIVE_DIR OUTPUT_DIR "
+          f"[PROCESSES]")
+    print()
+    print("Normalize every hour of the PREFIX-YYYYMMDD.zip archives in")
+    print("ARCHIVE_DIR again with the projection profile of the crawler")
+    print("settings, and write the new archives to OUTPUT_DIR. An")
+    print("interrupted run resumes where it stopped.")
+    sys.exit(0)
+
+
+def read_checkpoint(path: str) -> dict:
+    try:
+        with open(path, "r") as inf:
+            return json.load(inf)
+    except FileNotFoundError:
+        return {"days": [], "members": {}}
+
+
+def write_checkpoint(path: str, checkpoint: dict) -> None:
+    with open(f"{path}.new", "w") as outf:
+        json.dump(checkpoint, outf, indent = 1, sort_keys = True)
+    os.replace(f"{path}.new", path)
+
+
+def reprocess_member(zip_path: str, member: str, output_dir: str,
+                     profile: dict) -> tuple:
+    """ Normalize one hour of an archive into an hourly file of OUTPUT_DIR,
+    as the crawler saves it. Return the process id, the tweets read and
+    written and the time spent. """
+    t = time.perf_counter()
+    out_path = os.path.join(output_dir, member)
+    with zipfile.ZipFile(zip_path, "r") as zf, open_member(zf, member) as zm, \
+            open(f"{out_path}.part", "w") as outf:
+        stats_in, stats_out, _ = normalize_lines(
+            io.TextIOWrapper(zm, encoding = "utf-8"), outf, profile)
+    os.replace(f"{out_path}.part", out_path)
+    return os.getpid(), stats_in.lines, stats_out.lines, \
+        time.perf_counter() - t
+
+
+def run_task(task: tuple) -> tuple:
+    """ Run a task of the pool, return its error instead of raising it """
+    try:
+        return task, reprocess_member(*task), None
+    except Exception as ex:
+        return task, None, f"{type(ex).__name__}: {ex}"
+
+
+def zip_day(output_dir: str, zn: str, members: list,
+            source_path: str) -> None:
+    """ Zip the reprocessed hours of a day as the uploader does, with the
+    codec and dictionary of the source archive """
+    with zipfile.ZipFile(source_path, "r") as zf:
+        dictionaries = [n for n in zf.namelist() if DICT_PATTERN.match(n)]
+        dictionary = zf.read(dictionaries[0]) if dictionaries else None
+    zip_path = os.path.join(output_dir, zn)
+    with zipfile.ZipFile(f"{zip_path}.part", "w", zipfile.ZIP_DEFLATED,
+                         compresslevel = 9) as zf:
+        if dictionary is not None:
+            zf.writestr(dictionaries[0], dictionary)
+        for member in members:
+            path = os.path.join(output_dir, member)
+            with open(path, "rb") as inf, open_member_writer(
+                    zf, member, dictionary,
+                    os.path.getsize(path) >= zipfile.ZIP64_LIMIT) as zm:
+                while True:
+                    chunk = inf.read(1048576)
+                    if not chunk:
+                        break
+                    zm.write(chunk)
+    os.replace(f"{zip_path}.part", zip_path)
+    for member in members:
+        os.remove(os.path.join(output_dir, member))
+
+
+def reprocess(settings_path: str, archive_dir: str, output_dir: str,
+              processes: int) -> None:
+    """ Reprocess the archives with a pool of processes, one hour of a day
+    per task, and report the throughput of each process """
+    profile = get_profile(*read_profiles(settings_path))
+    checkpoint_path = os.path.join(output_dir, CHECKPOINT_NAME)
+    checkpoint = read_checkpoint(checkpoint_path)
+    days = {}
+    tasks = []
+    for zn in sorted(os.listdir(archive_dir)):
+        if not ZIP_PATTERN.match(zn) or zn in checkpoint["days"]:
+            continue
+        zip_path = os.path.join(archive_dir, zn)
+        with zipfile.ZipFile(zip_path, "r") as zf:
+            days[zn] = hour_members(zf, MEMBER_PATTERN)
+        # Hours done before an interruption, unless their file was lost
+        done = {m for m in checkpoint["members"].get(zn, [])
+                if os.path.isfile(os.path.join(output_dir, m))}
+        checkpoint["members"][zn] = sorted(done)
+        tasks.extend((zip_path, member, output_dir, profile)
+                     for member in days[zn] if member not in done)
+    print(f"{len(days)} days to reprocess, {len(tasks)} hours left, "
+          f"{processes} processes")
+    if len(days) == 0:
+        return
+
+    workers = {}
+    failed = 0
+    t = time.perf_counter()
+    with multiprocessing.Pool(processes) as pool:
+        for task, result, error in pool.imap_unordered(run_task, tasks):
+            zn = os.path.basename(task[0])
+            member = task[1]
+            if error is not None:
+                failed += 1
+                print(f"Failed {zn}/{member}: {error}", file = sys.stderr)
+                continue
+            pid, num_in, num_out, elapsed = result
+            worker = workers.setdefault(pid, [0, 0, 0.0])
+            worker[0] += 1
+            worker[1] += num_in
+            worker[2] += elapsed
+            print(f"{zn}/{member}: {num_in} read, {num_out} written, "
+                  f"{num_in / max(elapsed, 1e-9):.0f} tweets/s (process "
+                  f"{pid})")
+            checkpoint["members"].setdefault(zn, []).append(member)
+            if len(checkpoint["members"][zn]) == len(days[zn]):
+                zip_day(output_dir, zn, days[zn],
+                        os.path.join(archive_dir, zn))
+                del checkpoint["members"][zn]
+                checkpoint["days"].append(zn)
+                print(f"Created {zn}")
+            write_checkpoint(checkpoint_path, checkpoint)
+    # Days whose hours were all done before an interruption
+    for zn in sorted(checkpoint["members"].keys()):
+        if zn in days and len(checkpoint["members"][zn]) == len(days[zn]):
+            zip_day(output_dir, zn, days[zn],
+                    os.path.join(archive_dir, zn))
+            del checkpoint["members"][zn]
+            checkpoint["days"].append(zn)
+            write_checkpoint(checkpoint_path, checkpoint)
+            print(f"Created {zn}")
+    elapsed = time.perf_counter() - t
+
+    print()
+    print(f"{'process':<10}{'hours':>7}{'tweets':>11}{'seconds':>10}"
+          f"{'tweets/s':>11}")
+    total = 0
+    for pid, (num_members, num_tweets, busy) in sorted(workers.items()):
+        total += num_tweets
+        print(f"{pid:<10}{num_members:>7}{num_tweets:>11}{busy:>10.1f}"
+              f"{num_tweets / max(busy, 1e-9):>11.0f}")
+    print(f"{'all':<10}{sum(w[0] for w in workers.values()):>7}{total:>11}"
+          f"{elapsed:>10.1f}{total / max(elapsed, 1e-9):>11.0f}")
+    if failed > 0:
+        print(f"{failed} hours failed, run again to retry them",
+              file = sys.stderr)
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (4, 5):
+        usage()
+    output = os.path.abspath(sys.argv[3])
+    if not os.path.isdir(output):
+        print(f"Cannot find {output}", file = sys.stderr)
+        sys.exit(-1)
+    reprocess(os.path.abspath(sys.argv[1]), os.path.abspath(sys.argv[2]),
+              output,
+              int(sys.argv[4]) if len(sys.argv) > 4 else os.cpu_count() or 1)
@@ -0,0 +1,190 @@
+""" Writers and integrity records of the hourly files, shared by the
+crawler, the uploader and the benchmark. Importing this module has no side
+effects. """
+
+import json
+import mmap
+import os
+import zlib
+
+# Size of the extents preallocated for a segment
+SEGMENT_EXTENT = 32 * 1024 * 1024
+# Sidecar of an hourly file with the statistics of what the crawler wrote
+INTEGRITY_SUFFIX = ".integrity"
+CRC32_SUM_MASK = 0xFFFFFFFFFFFFFFFF
+
+
+def data_length(fd: int, size: int) -> int:
+    """ Length of a file without the NUL padding left by a segment that was
+    not closed """
+    end = size
+    while end > 0:
+        start = max(0, end - 65536)
+        chunk = os.pread(fd, end - start, start).rstrip(b"\0")
+        if len(chunk) > 0:
+            return start + len(chunk)
+        end = start
+    return 0
+
+
+def trim_padding(path: str) -> int:
+    """ Remove the NUL padding at the end of a file, return the bytes
+    removed """
+    fd = os.open(path, os.O_RDWR)
+    try:
+        size = os.fstat(fd).st_size
+        length = data_length(fd, size)
+        if length < size:
+            os.ftruncate(fd, length)
+    finally:
+        os.close(fd)
+    return size - length
+
+
+class MmapSegmentWriter:
+    """ Append text to a file preallocated in large extents with fallocate,
+    by copying it into a memory map. The file is truncated to the length of
+    the text when closed. It can be used in place of the text file opened in
+    append mode. """
+
+    def __init__(self, path: str, extent: int = SEGMENT_EXTENT):
+        self.__extent = extent
+        self.__fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self.__fd).st_size
+        # Append after the text of a segment left by a crash
+        self.__pos = data_length(self.__fd, size)
+        self.__map = None
+        self.__reserve(max(size, self.__pos + 1))
+
+    @property
+    def closed(self) -> bool:
+        return self.__fd < 0
+
+    def __reserve(self, size: int) -> None:
+        capacity = 0 if self.__map is None else len(self.__map)
+        if size <= capacity:
+            return
+        size = (size + self.__extent - 1) // self.__extent * self.__extent
+        os.posix_fallocate(self.__fd, capacity, size - capacity)
+        if self.__map is None:
+            self.__map = mmap.mmap(self.__fd, size)
+        else:
+            self.__map.resize(size)
+
+    def write(self, data: str) -> int:
+        raw = data.encode("utf-8")
+        end = self.__pos + len(raw)
+        self.__reserve(end)
+        self.__map[self.__pos:end] = raw
+        self.__pos = end
+        return len(data)
+
+    def tell(self) -> int:
+        return self.__pos
+
+    def flush(self) -> None:
+        # The page cache keeps the text if the process dies, msync is only
+        # needed against power loss and is left to close()
+        pass
+
+    def close(self) -> None:
+        if self.__fd < 0:
+            return
+        self.__map.flush()
+        self.__map.close()
+        self.__map = None
+        os.ftruncate(self.__fd, self.__pos)
+        os.close(self.__fd)
+        self.__fd = -1
+
+
+class HourStats:
+    """ Line count, byte count, smallest and largest tweet ids and the sum of
+    the CRC32 of each line of an hourly file. The sum does not depend on the
+    order of the lines, so the statistics of files appended to each other
+    can be merged. """
+
+    FIELDS = ("lines", "bytes", "min_id", "max_id", "crc32_sum")
+
+    def __init__(self, values: dict = None):
+        self.lines = 0
+        self.bytes = 0
+        self.min_id = None
+        self.max_id = None
+        self.crc32_sum = 0
+        self.__partial = b""
+        if values is not None:
+            for key in HourStats.FIELDS:
+                setattr(self, key, values.get(key))
+
+    def add(self, line: bytes, tweet_id: int = None) -> None:
+        """ Add a line, with its trailing newline """
+        self.lines += 1
+        self.bytes += len(line)
+        self.crc32_sum = (self.crc32_sum + zlib.crc32(line)) & CRC32_SUM_MASK
+        if tweet_id is not None:
+            if self.min_id is None or tweet_id < self.min_id:
+                self.min_id = tweet_id
+            if self.max_id is None or tweet_id > self.max_id:
+                self.max_id = tweet_id
+
+    def add_chunk(self, chunk: bytes) -> None:
+        """ Add a chunk of a file read in pieces, without tweet ids. Call
+        with an empty chunk at the end of the file. """
+        if len(chunk) == 0:
+            if len(self.__partial) > 0:
+                self.add(self.__partial)
+                self.__partial = b""
+            return
+        lines = (self.__partial + chunk).split(b"\n")
+        self.__partial = lines.pop()
+        for line in lines:
+            self.add(line + b"\n")
+
+    def merge(self, other) -> None:
+        """ Add the statistics of the lines appended from another file """
+        self.lines += other.lines
+        self.bytes += other.bytes
+        self.crc32_sum = (self.crc32_sum + other.crc32_sum) & CRC32_SUM_MASK
+        for value in (other.min_id, other.max_id):
+            if value is None:
+                continue
+            if self.min_id is None or value < self.min_id:
+                self.min_id = value
+            if self.max_id is None or value > self.max_id:
+                self.max_id = value
+
+    def mismatches(self, expected, check_ids: bool = True) -> list:
+        """ Describe how these statistics differ from the expected ones """
+        fields = HourStats.FIELDS if check_ids else \
+            ("lines", "bytes", "crc32_sum")
+        return [f"{key} {getattr(self, key)} != {getattr(expected, key)}"
+                for key in fields
+                if getattr(self, key) != getattr(expected, key)]
+
+    def to_dict(self) -> dict:
+        return {key: getattr(self, key) for key in HourStats.FIELDS}
+
+
+def read_integrity(path: str):
+    """ Read the integrity sidecar of an hourly file, None if it has none """
+    try:
+        with open(path + INTEGRITY_SUFFIX, "r") as inf:
+            return HourStats(json.load(inf))
+    except (OSError, ValueError):
+        return None
+
+
+def write_integrity(path: str, stats: HourStats) -> None:
+    """ Write the integrity sidecar of an hourly file """
+    tmp_path = f"{path}{INTEGRITY_SUFFIX}.new"
+    with open(tmp_path, "w") as outf:
+        json.dump(stats.to_dict(), outf, sort_keys = True)
+    os.replace(tmp_path, path + INTEGRITY_SUFFIX)
+
+
+def remove_integrity(path: str) -> None:
+    try:
+        os.remove(path + INTEGRITY_SUFFIX)
+    except FileNotFoundError:
+        pass
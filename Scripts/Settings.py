@@ -0,0 +1,104 @@
+""" Typed reader of the KEY=VALUE settings files of the crawler and the
+uploader. Importing this module has no side effects. """
+
+import os
+import sys
+from typing import Callable
+
+
+class SettingsError(ValueError):
+    pass
+
+
+def read_setting(line: str):
+    if not line or line.startswith("#"):
+        return None, None
+    try:
+        idx = line.index("=")
+        if idx > -1:
+            key = line[:idx].strip()
+            val = line[idx + 1:].strip()
+            return key, val
+        else:
+            return None, None
+    except ValueError:
+        return None, None
+
+
+def parse_bool(val: str) -> bool:
+    """ Anything but "false" is true, as the settings always did """
+    return val.lower() != "false"
+
+
+def parse_path(val: str) -> str:
+    return os.path.abspath(val)
+
+
+def parse_dir(val: str) -> str:
+    path = os.path.abspath(val)
+    if not os.path.isdir(path):
+        raise ValueError(f"Cannot find {path}")
+    return path
+
+
+def parse_file(val: str) -> str:
+    path = os.path.abspath(val)
+    if not os.path.isfile(path):
+        raise ValueError(f"Cannot find {path}")
+    return path
+
+
+def parse_list(separator: str, item: Callable = str) -> Callable:
+    """ Parser of a list of values, each one parsed by item """
+    def parse(val: str) -> list:
+        return [item(v.strip()) for v in val.split(separator)
+                if len(v.strip()) > 0]
+    return parse
+
+
+class Setting:
+    """ A key of a settings file: the function parsing its value, raising
+    ValueError if it is invalid, the value when it is missing or empty, and
+    its bounds or choices """
+
+    def __init__(self, key: str, parse: Callable = str, default = None,
+                 minimum = None, maximum = None, choices: tuple = None):
+        self.key = key
+        self.parse = parse
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum
+        self.choices = choices
+
+    def value(self, val: str):
+        if len(val) == 0:
+            return self.default
+        if self.choices is not None and val.lower() not in self.choices:
+            raise ValueError(f"Must be one of {', '.join(self.choices)}")
+        value = self.parse(val)
+        if self.minimum is not None and value < self.minimum:
+            raise ValueError(f"Must be at least {self.minimum}")
+        if self.maximum is not None and value > self.maximum:
+            raise ValueError(f"Must be at most {self.maximum}")
+        return value
+
+
+def read_settings(path: str, settings: list, strict: bool = True) -> dict:
+    """ Read the settings of a file, return their values by key, the default
+    of the missing ones. An invalid value raises SettingsError if strict,
+    otherwise it is reported and replaced with the default. """
+    by_key = {s.key: s for s in settings}
+    values = {s.key: s.default for s in settings}
+    with open(path, "r") as inf:
+        for line in inf:
+            key, val = read_setting(line.rstrip("\n").rstrip("\r"))
+            setting = by_key.get(key)
+            if setting is None:
+                continue
+            try:
+                values[key] = setting.value(val)
+            except ValueError as e:
+                if strict:
+                    raise SettingsError(f"Invalid setting ({key}): {e}")
+                print(f"Invalid setting ({key}): {e}", file = sys.stderr)
+    return values
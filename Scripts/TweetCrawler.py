@@ -2,124 +2,36 @@
 
 import json
 import os
+import pickle
+import signal
 import smtplib
 import socket
 import sys
 import time
 import traceback
+import tracemalloc
 import zipfile
+import zlib
+from collections import Counter, deque
 from datetime import datetime, timezone
 from email.mime.text import MIMEText
+from functools import partial
 from http.client import IncompleteRead as http_incompleteRead
 from io import StringIO
 from subprocess import call
-from threading import Lock, Thread
+from threading import Condition, Event, Lock, Thread, \
+    enumerate as all_threads, get_ident
 from typing import Callable, TextIO
 from urllib.request import urlopen
 
-import tweepy  # Requires Tweepy 4.0.0+
-from urllib3.exceptions import IncompleteRead as urllib3_incompleteRead
-
-# https://developer.twitter.com/en/docs/twitter-api/expansions
-FIELDS_EXPANSIONS = [
-    "author_id",
-    "referenced_tweets.id",
-    "in_reply_to_user_id",
-    "attachments.media_keys",
-    "attachments.poll_ids",
-    "geo.place_id",
-    "entities.mentions.username",
-    "referenced_tweets.id.author_id",
-]
-
-# https://developer.twitter.com/en/docs/twitter-api/data-dictionary/object-model/media
-FIELDS_MEDIA = [
-    "media_key",
-    "type",
-    "url",
-    "duration_ms",
-    "height",
-    # "non_public_metrics",
-    # "organic_metrics",
-    "preview_image_url",
-    # "promoted_metrics",
-    "public_metrics",
-    "width",
-    "alt_text",
-    "variants",
-]
-
-# https://developer.twitter.com/en/docs/twitter-api/data-dictionary/object-model/place
-FIELDS_PLACE = [
-    "full_name",
-    "id",
-    "contained_within",
-    "country",
-    "country_code",
-    "geo",
-    "name",
-    "place_type",
-]
-
-# https://developer.twitter.com/en/docs/twitter-api/data-dictionary/object-model/poll
-FIELDS_POLL = [
-    "id",
-    "options",
-    "duration_minutes",
-    "end_datetime",
-    "voting_status",
-]
-
-# https://developer.twitter.com/en/docs/twitter-api/data-dictionary/object-model/tweet
-FIELDS_TWEET = [
-    "id",
-    "text",
-    "attachments",
-    "author_id",
-    "context_annotations",
-    "conversation_id",
-    "created_at",
-    "entities",
-    "geo",
-    "in_reply_to_user_id",
-    "lang",
-    "non_public_metrics",
-    "organic_metrics",
-    "possibly_sensitive",
-    "promoted_metrics",
-    "public_metrics",
-    "referenced_tweets",
-    "reply_settings",
-    "source",
-    "withheld",
-]
-
-# https://developer.twitter.com/en/docs/twitter-api/data-dictionary/object-model/user
-FIELDS_USER = [
-    "id",
-    "name",
-    "username",
-    "created_at",
-    "description",
-    "entities",
-    "location",
-    "pinned_tweet_id",
-    "profile_image_url",
-    "protected",
-    "public_metrics",
-    "url",
-    "verified",
-    "withheld",
-]
-
-if len(sys.argv) != 2:
-    print("Usage: {0} SETTINGS_FILE".format(os.path.basename(__file__)))
-    sys.exit(0)
-
-__setting_path = os.path.abspath(sys.argv[1])
-if not os.path.isfile(__setting_path):
-    print("Cannot find {0}".format(__setting_path), file = sys.stderr)
-    sys.exit(-1)
+from SegmentWriter import HourStats, MmapSegmentWriter, read_integrity, \
+    remove_integrity, trim_padding, write_integrity
+from Settings import Setting, parse_bool, parse_list, parse_path, \
+    read_settings
+from TweetNormalizer import PROFILE_FIELDS, HourSummary, get_profile, \
+    is_valid_tweet, normalize_tweet, read_profiles, read_streams, \
+    scan_raw_geo, scan_raw_tags, scan_raw_tweet, tweet_facts, write_summary
+from TweetSinks import FanoutSink, TweetSink
 
 KEY_WORKING_DIR = "working_dir"
 KEY_NUM_THREADS = "num_threads"
@@ -132,28 +44,48 @@ KEY_EMAIL_SMTP = "email_smtp"
 KEY_EMAIL_PORT = "email_port"
 KEY_EMAIL_SSL = "email_ssl"
 KEY_EMAIL_RECIPIENTS = "email_recipients"
+KEY_FANOUT_ADDRESS = "fanout_address"
+KEY_INGEST_MODE = "ingest_mode"
+KEY_FANOUT_BUFFER = "fanout_buffer"
+KEY_PROFILE_SECONDS = "profile_seconds"
+KEY_WRITER = "writer"
+KEY_SHED_LATENCY_MS = "shed_latency_ms"
+KEY_SHED_KEEP_RATE = "shed_keep_rate"
+KEY_SHED_OVERFLOW_MB = "shed_overflow_mb"
+KEY_CONTROL_SOCKET = "control_socket"
 
-
-def read_setting(line: str):
-    if not line or line.startswith("#"):
-        return None, None
-    try:
-        idx = line.index("=")
-        if idx > -1:
-            key = line[:idx].strip()
-            val = line[idx + 1:].strip()
-            return key, val
-        else:
-            return None, None
-    except ValueError:
-        return None, None
+# Invalid values are reported and replaced with the default
+CRAWLER_SETTINGS = [
+    Setting(KEY_WORKING_DIR, parse_path),
+    Setting(KEY_NUM_THREADS, int, 1, minimum = 1),
+    Setting(KEY_LOG_File, parse_path),
+    Setting(KEY_TWITTER_BEAR_TOKEN),
+    Setting(KEY_EMAIL_ADDRESS),
+    Setting(KEY_EMAIL_NAME),
+    Setting(KEY_EMAIL_PASSWORD),
+    Setting(KEY_EMAIL_SMTP),
+    Setting(KEY_EMAIL_PORT, int, -1, minimum = 1),
+    Setting(KEY_EMAIL_SSL, parse_bool, True),
+    Setting(KEY_EMAIL_RECIPIENTS, parse_list(";")),
+    Setting(KEY_FANOUT_ADDRESS),
+    Setting(KEY_INGEST_MODE, str.lower, "parsed", choices = ("parsed", "raw")),
+    Setting(KEY_FANOUT_BUFFER, int, 10000, minimum = 1),
+    Setting(KEY_PROFILE_SECONDS, int, 60, minimum = 1),
+    Setting(KEY_WRITER, str.lower, "file", choices = ("file", "mmap")),
+    Setting(KEY_SHED_LATENCY_MS, float, 0.0, minimum = 0),
+    Setting(KEY_SHED_KEEP_RATE, float, 0.1, minimum = 0, maximum = 1),
+    Setting(KEY_SHED_OVERFLOW_MB, int, 64, minimum = 0),
+    Setting(KEY_CONTROL_SOCKET, parse_path),
+]
 
 
+# Values read by setup()
+__setting_path = None
 __working_dir = None
 __num_threads = 1
 __log_path = None
 __log_file = None
-__log_lock = None
+__log_lock = Lock()
 __twitter_bear_token = None
 __email_address = None
 __email_name = None
@@ -162,89 +94,22 @@ __email_smtp = None
 __email_port = -1
 __email_ssl = True
 __email_recipients = None
-
-try:
-    with open(__setting_path, "r") as inf:
-        for line in inf:
-            key, val = read_setting(line.rstrip("\n").rstrip("\r"))
-            if key == KEY_WORKING_DIR:
-                __working_dir = os.path.abspath(val)
-            elif key == KEY_NUM_THREADS:
-                try:
-                    __num_threads = int(val)
-                except ValueError:
-                    print(f"Incorrect number of threads: {val}",
-                          file = sys.stderr)
-                if __num_threads < 1:
-                    print(f"Incorrect number of threads: {val}",
-                          file = sys.stderr)
-                    __num_threads = 1
-            elif key == KEY_LOG_File:
-                try:
-                    __log_path = os.path.abspath(val)
-                    __log_file = open(__log_path, "a")
-                    __log_lock = Lock()
-                except BaseException as fe:
-                    print(f"Failed to write to {__log_path}", file = sys.stderr)
-                    __log_path = None
-                    __log_file = None
-                    __log_lock = None
-            elif key == KEY_TWITTER_BEAR_TOKEN:
-                __twitter_bear_token = val
-            elif key == KEY_EMAIL_ADDRESS:
-                __email_address = val
-            elif key == KEY_EMAIL_NAME:
-                __email_name = val
-            elif key == KEY_EMAIL_PASSWORD:
-                __email_password = val
-            elif key == KEY_EMAIL_SMTP:
-                __email_smtp = val
-            elif key == KEY_EMAIL_PORT:
-                try:
-                    __email_port = int(val)
-                except ValueError:
-                    print(f"Incorrect SMTP port: {val}", file = sys.stderr)
-                if __num_threads < 1:
-                    print(f"Incorrect SMTP port: {val}", file = sys.stderr)
-                    __num_threads = -1
-            elif key == KEY_EMAIL_SSL:
-                __email_ssl = (val.lower() != "false")
-            elif key == KEY_EMAIL_RECIPIENTS:
-                __email_recipients = [v.strip() for v in val.split(";")]
-            else:
-                continue
-    inf.close()
-except BaseException as e:
-    print(f"Cannot read {__setting_path}: {e}", file = sys.stderr)
-    sys.exit(-1)
-
-if __working_dir is None or len(__working_dir) == 0:
-    print(f"{KEY_WORKING_DIR} is not set", file = sys.stderr)
-    sys.exit(-1)
-
-if not os.path.isdir(__working_dir):
-    try:
-        os.mkdir(__working_dir)
-    except BaseException as e:
-        print(f"Failed to create directory {__working_dir}: {e}",
-              file = sys.stderr)
-        sys.exit(-1)
-
-if __twitter_bear_token is None or len(__twitter_bear_token) == 0:
-    print(f"{KEY_TWITTER_BEAR_TOKEN} is not set", file = sys.stderr)
-    sys.exit(-1)
-
-# Email
-if __email_address is None or len(__email_address) == 0 \
-        or __email_smtp is None or len(__email_smtp) == 0 \
-        or __email_port < 1 \
-        or __email_recipients is None or len(__email_recipients) == 0:
-    __email_address = None
-    __email_name = None
-    __email_password = None
-    __email_smtp = None
-    __email_port = -1
-    __email_recipients = None
+__fanout_address = None
+__fanout_buffer = 10000
+__raw_ingest = False
+__profile_seconds = 60
+__mmap_writer = False
+__shed_latency = 0.0
+__shed_keep_rate = 0.1
+__shed_overflow_mb = 64
+__control_socket = None
+__profiles = None
+__projection_profile = None
+__profile = None
+__streams = {}
+__streams_mtime = None
+__sinks = []
+__shedder = None
 
 
 def write_log(msg: str, error: bool = False):
@@ -289,6 +154,11 @@ def write_log(msg: str, error: bool = False):
 
 
 __open_files = {}
+__file_counts = {}
+__raw_ids = {}
+__file_stats = {}
+__file_summaries = {}
+__file_shed = {}
 __file_lock = Lock()
 
 
@@ -327,22 +197,52 @@ def merge_saved_file(tmp_path: str, saved_path: str) -> None:
     os.remove(tmp_path)
 
 
-def create_or_get_file(timestamp: datetime) -> (TextIO, Lock):
+def is_finished(hour_key: int) -> bool:
+    """ If the current time is at least 2 hours and 5 minutes later than the
+    hour of a file, which is then finished """
+    current_key = int(datetime.now(tz = timezone.utc).strftime("%y%m%d%H%M"))
+    return current_key - hour_key >= 205
+
+
+def is_hour_finished(timestamp: datetime) -> bool:
+    return is_finished(int(timestamp.strftime("%y%m%d%H00")))
+
+
+def create_or_get_file(timestamp: datetime, prefix: str = "tweets",
+                       suffix: str = "") -> (TextIO, Lock):
     global __open_files
-    """ Get a file to write for given date and time, create if not exists """
-    target_key = int(timestamp.strftime("%y%m%d%H00"))
+    """ Get a file to write for given date and time, create if not exists.
+    Return None for an hour already finished, or after a handoff. """
+    target_key = (prefix + suffix, int(timestamp.strftime("%y%m%d%H00")))
     created = False
 
     __file_lock.acquire()
+    if target_key not in __open_files and (
+            __handed_off or is_finished(target_key[1])):
+        # Its file is finished, and maybe compressed or zipped already, or
+        # the new crawler writes it
+        __file_lock.release()
+        return None, None
     if target_key in __open_files.keys():
         # Get file and lock
         target_file, target_lock, target_name, target_tmp = __open_files[
             target_key]
     else:
         # Create file and lock
-        target_name = timestamp.strftime("tweets-%Y%m%d-%H")
+        target_name = timestamp.strftime(f"{prefix}-%Y%m%d-%H") + suffix
         target_tmp = f"{target_name}.tmp"
-        target_file = open(os.path.join(__working_dir, target_tmp), "a")
+        tmp_path = os.path.join(__working_dir, target_tmp)
+        if target_key not in __file_stats:
+            # The tweets already in a file left by a crash are unknown
+            __file_stats[target_key] = None if os.path.isfile(tmp_path) \
+                and os.path.getsize(tmp_path) > 0 else HourStats()
+        if __mmap_writer:
+            target_file = MmapSegmentWriter(tmp_path)
+        else:
+            if os.path.isfile(tmp_path):
+                # Left by a crash of the mmap writer
+                trim_padding(tmp_path)
+            target_file = open(tmp_path, "a")
         target_lock = Lock()
         __open_files[target_key] = (
             target_file, target_lock, target_name, target_tmp)
@@ -355,13 +255,9 @@ def create_or_get_file(timestamp: datetime) -> (TextIO, Lock):
     __file_lock.acquire()
     if len(__open_files) > 1:
         # Clean some outdated files and locks
-        current_key = int(datetime.now(tz = timezone.utc)
-                          .strftime("%y%m%d%H%M"))
         keys = sorted(list(__open_files.keys()))
         for old_key in keys:
-            if current_key - old_key >= 205:
-                # Current is at least 2 hour and 5 minutes later than the
-                # timestamp of the file
+            if is_finished(old_key[1]):
                 old_file, old_lock, old_name, old_tmp = __open_files[
                     old_key]
                 if old_lock.acquire(blocking = False):
@@ -370,20 +266,52 @@ def create_or_get_file(timestamp: datetime) -> (TextIO, Lock):
                     del old_file
                     tmp_path = os.path.join(__working_dir, old_tmp)
                     saved_path = os.path.join(__working_dir, old_name)
-                    if os.path.isfile(saved_path):
+                    stats = __file_stats.pop(old_key, None)
+                    summary = __file_summaries.pop(old_key, None)
+                    shed, spilled = __file_shed.pop(old_key, (0, 0))
+                    if shed > 0 or spilled > 0:
+                        if summary is None:
+                            summary = HourSummary()
+                        summary.shed += shed
+                        summary.spilled += spilled
+                    if summary is not None:
+                        write_summary(saved_path, summary)
+                    saved = os.path.isfile(saved_path)
+                    if saved or os.path.isfile(f"{saved_path}.gz"):
+                        # The sidecar covers the tweets of the hour already
+                        # saved, compressed or not
+                        saved_stats = read_integrity(saved_path)
+                        if stats is not None and saved_stats is not None:
+                            saved_stats.merge(stats)
+                            write_integrity(saved_path, saved_stats)
+                        else:
+                            remove_integrity(saved_path)
+                    elif stats is not None:
+                        # Before the rename, which the uploader watches
+                        write_integrity(saved_path, stats)
+                    if saved:
                         merge_saved_file(tmp_path, saved_path)
                         merged.append((old_tmp, old_name))
                     else:
+                        # The uploader appends the file to the gzip of the
+                        # hour if it was compressed
                         os.rename(tmp_path, saved_path)
                     del __open_files[old_key]
                     old_lock.release()
                     del old_lock
-                    finished.append(old_name)
+                    finished.append((old_name,
+                                     __file_counts.pop(old_key, 0),
+                                     shed, spilled))
+                    __raw_ids.pop(old_key, None)
     __file_lock.release()
     for old_tmp, old_name in merged:
         write_log(f"Merged {old_tmp} to {old_name}", False)
-    for old_name in finished:
-        write_log(f"Finished {old_name}", False)
+    for old_name, old_count, shed, spilled in finished:
+        if shed > 0 or spilled > 0:
+            write_log(f"Finished {old_name} ({old_count} tweets, {shed} "
+                      f"shed, {spilled} spilled)", False)
+        else:
+            write_log(f"Finished {old_name} ({old_count} tweets)", False)
     return target_file, target_lock
 
 
@@ -406,41 +334,291 @@ def close_all_files() -> None:
     __file_lock.release()
 
 
-def trim_json(jobj) -> bool:
-    """ Remove any empty fields in a json object recursively. Return True if
-    the trimmed object is None or empty. """
-    if jobj is None:
-        return True
-    if type(jobj) is dict:
-        keys = list(jobj.keys())
-        for key in keys:
-            if trim_json(jobj[key]):
-                del jobj[key]
-        return len(jobj) == 0
-    if type(jobj) is list:
-        for i in range(len(jobj) - 1, -1, -1):
-            if trim_json(jobj[i]):
-                del jobj[i]
-        return len(jobj) == 0
-    if type(jobj) is str:
-        return len(jobj) == 0
-    return False
-
-
-def is_valid_tweet(tweet) -> bool:
-    if ("data" not in tweet) or ("includes" not in tweet):
+def matched_streams(tweet) -> list:
+    """ Names of the streams whose rules a filtered tweet matched """
+    streams = []
+    for rule in tweet.get("matching_rules", []):
+        name = rule.get("tag", "").split(":", 1)[0]
+        if name in __streams and name not in streams:
+            streams.append(name)
+    return streams
+
+
+def write_tweet(timestamp: datetime, prefix: str, data: str,
+                suffix: str = "", tweet_id: str = None,
+                unique: bool = False, summary: tuple = None) -> bool:
+    """ Append a serialized tweet to its hourly file in thread-safe way, and
+    count it in the statistics of the file, and in its summary with the facts
+    and the delay of the tweet. If unique, a tweet already in the file is
+    skipped. """
+    file, lock = create_or_get_file(timestamp, prefix, suffix)
+    if file is None:
         return False
-    if ("id" not in tweet["data"]) or \
-            ("text" not in tweet["data"]) or \
-            ("author_id" not in tweet["data"]) or \
-            ("created_at" not in tweet["data"]) or \
-            ("users" not in tweet["includes"]):
+    key = (prefix + suffix, int(timestamp.strftime("%y%m%d%H00")))
+    lock.acquire()
+    if file.closed:
+        lock.release()
         return False
+    try:
+        if unique:
+            ids = __raw_ids.setdefault(key, set())
+            if tweet_id in ids:
+                lock.release()
+                return False
+            ids.add(tweet_id)
+        file.write(data)  # Save the crawled tweet
+        __file_counts[key] = __file_counts.get(key, 0) + 1
+        stats = __file_stats.get(key)
+        if stats is not None:
+            stats.add(data.encode("utf-8"),
+                      None if tweet_id is None else int(tweet_id))
+        if summary is not None:
+            if key not in __file_summaries:
+                __file_summaries[key] = HourSummary()
+            __file_summaries[key].add(*summary)
+    except BaseException as ex:
+        lock.release()
+        write_log(f"Error on_data: {ex}", True)
+        return False
+    lock.release()
+    return True
+
+
+class HourlyFileSink(TweetSink):
+    """ Append tweets to the hourly files of their stream """
+
+    def write(self, timestamp: datetime, prefix: str, data: str,
+              tweet_id: str = None, summary: tuple = None) -> bool:
+        return write_tweet(timestamp, prefix, data, tweet_id = tweet_id,
+                           summary = summary)
+
+    def close(self) -> None:
+        close_all_files()
+
+
+def count_shed(timestamp: datetime, prefix: str, suffix: str, shed: int,
+               spilled: int) -> None:
+    """ Count tweets shed or spilled in the hour of their file, or in its
+    summary once it is finished """
+    key = (prefix + suffix, int(timestamp.strftime("%y%m%d%H00")))
+    with __file_lock:
+        if key not in __open_files and is_finished(key[1]):
+            summary = HourSummary()
+            summary.shed = shed
+            summary.spilled = spilled
+            # The summary of a .raw file is merged into the hourly one
+            write_summary(os.path.join(__working_dir, timestamp.strftime(
+                f"{prefix}-%Y%m%d-%H")), summary)
+            return
+        counts = __file_shed.get(key, (0, 0))
+        __file_shed[key] = (counts[0] + shed, counts[1] + spilled)
+
+
+def write_entry(timestamp: datetime, prefix: str, data: str, suffix: str,
+                tweet_id: str, summary: tuple) -> bool:
+    """ Write a tweet to the sinks, or to its .raw file. After a rolling
+    restart, the tweets the old crawler wrote are skipped. """
+    if __handed_off:
+        return False  # The new crawler writes it
+    if len(__handed_ids) > 0:
+        if tweet_id in __handed_ids:
+            return False
+        if int(tweet_id) > __handed_until:
+            __handed_ids.clear()  # Nothing the old crawler wrote is left
+    if suffix == ".raw":
+        saved = write_tweet(timestamp, prefix, data, suffix, tweet_id, True)
+    else:
+        saved = False
+        for sink in __sinks:
+            if sink.write(timestamp, prefix, data, tweet_id, summary):
+                saved = True
+    if saved and __control_socket is not None:
+        __recent_ids.append(tweet_id)
+    return saved
+
+
+class LoadShedder:
+    """ When the average write gets slower than a latency, keep writing the
+    tweets with a location, and spill the others to a compressed buffer in
+    memory, written back by a thread of its own once the writes are fast
+    again. Spilled tweets of an hour finished meanwhile are shed instead.
+    When the buffer is full, only a share of the others is written and the
+    rest is shed. """
+
+    BATCH_SIZE = 256  # Tweets compressed together
+    PROBE_INTERVAL = 1.0  # Write at least a tweet every second to measure
+
+    def __init__(self, latency: float, keep_rate: float, max_bytes: int,
+                 write_func: Callable, count_func: Callable,
+                 finished_func: Callable, log_func: Callable,
+                 clock: Callable = time.monotonic):
+        self.__latency = latency
+        self.__keep_every = 0 if keep_rate <= 0 else round(1 / keep_rate)
+        self.__max_bytes = max_bytes
+        self.__write = write_func
+        self.__count = count_func
+        self.__finished = finished_func
+        self.__log = log_func
+        self.__clock = clock
+        self.__lock = Lock()
+        self.__backlog = Condition(self.__lock)
+        self.__closed = False
+        self.__average = 0.0
+        self.__shedding = False
+        self.__last_write = clock()
+        self.__num_others = 0
+        self.__pending = []
+        self.__pending_bytes = 0
+        self.__batches = deque()
+        self.__batch_bytes = 0
+        self.__thread = Thread(target = self.__write_back,
+                               name = "write-back", daemon = True)
+        self.__thread.start()
+
+    def __spill(self, entry: tuple) -> None:
+        self.__pending.append(entry)
+        self.__pending_bytes += len(entry[2])
+        if len(self.__pending) >= LoadShedder.BATCH_SIZE:
+            batch = zlib.compress(pickle.dumps(self.__pending), 1)
+            self.__batches.append(batch)
+            self.__batch_bytes += len(batch)
+            self.__pending = []
+            self.__pending_bytes = 0
+
+    def __take(self, everything: bool = False) -> list:
+        """ Entries to write back, the oldest batch first """
+        entries = []
+        while len(self.__batches) > 0:
+            batch = self.__batches.popleft()
+            self.__batch_bytes -= len(batch)
+            entries.extend(pickle.loads(zlib.decompress(batch)))
+            if not everything:
+                return entries
+        entries.extend(self.__pending)
+        self.__pending = []
+        self.__pending_bytes = 0
+        return entries
+
+    def __has_backlog(self) -> bool:
+        return len(self.__batches) > 0 or len(self.__pending) > 0
+
+    def __measure(self, elapsed: float) -> None:
+        with self.__lock:
+            self.__average = 0.95 * self.__average + 0.05 * elapsed
+            self.__last_write = self.__clock()
+            if not self.__shedding and self.__average > self.__latency:
+                self.__shedding = True
+                message = f"Shedding, writes take " \
+                          f"{self.__average * 1000:.1f} ms"
+            elif self.__shedding and self.__average < self.__latency / 2:
+                self.__shedding = False
+                self.__backlog.notify()
+                message = f"Stopped shedding, {self.__batch_bytes} " \
+                          f"compressed bytes to write back"
+            else:
+                return
+        self.__log(message, False)
+
+    def __write_spilled(self, entries: list) -> None:
+        """ Write back spilled tweets, and shed those of finished hours """
+        counts = Counter()
+        for entry in entries:
+            hour = entry[0].replace(minute = 0, second = 0, microsecond = 0)
+            saved = False
+            if not self.__finished(entry[0]):
+                t = self.__clock()
+                saved = self.__write(*entry)
+                self.__measure(self.__clock() - t)
+            if saved:
+                counts[(hour, entry[1], entry[3], 0, 1)] += 1
+            elif self.__finished(entry[0]):
+                # Its file may be compressed or archived already
+                counts[(hour, entry[1], entry[3], 1, 0)] += 1
+        for (hour, prefix, suffix, shed, spilled), n in counts.items():
+            self.__count(hour, prefix, suffix, shed * n, spilled * n)
+
+    def __write_back(self) -> None:
+        """ Write back a batch at a time while the writes are fast """
+        while True:
+            with self.__lock:
+                while not self.__closed and (self.__shedding or
+                                             not self.__has_backlog()):
+                    self.__backlog.wait()
+                if self.__closed:
+                    return
+                backlog = self.__take()
+            self.__write_spilled(backlog)
+
+    def write(self, priority: bool, entry: tuple) -> bool:
+        """ Write, spill or shed a tweet, entry is the arguments of the write
+        function """
+        action = "write"
+        with self.__lock:
+            if self.__shedding and not priority and \
+                    self.__clock() - self.__last_write < \
+                    LoadShedder.PROBE_INTERVAL:
+                if self.__batch_bytes + self.__pending_bytes < \
+                        self.__max_bytes:
+                    action = "spill"
+                    self.__spill(entry)
+                else:
+                    self.__num_others += 1
+                    if self.__keep_every == 0 or \
+                            self.__num_others % self.__keep_every != 0:
+                        action = "shed"
+        if action == "spill":
+            return True  # Counted once written back
+        if action == "shed":
+            self.__count(entry[0], entry[1], entry[3], 1, 0)
+            return False
+        t = self.__clock()
+        saved = self.__write(*entry)
+        self.__measure(self.__clock() - t)
+        return saved
+
+    def close(self) -> None:
+        """ Stop the thread writing back, and write back everything
+        spilled """
+        with self.__lock:
+            self.__closed = True
+            self.__backlog.notify()
+        self.__thread.join()
+        with self.__lock:
+            backlog = self.__take(True)
+        self.__write_spilled(backlog)
+
+
+def begin_write() -> bool:
+    """ Count a tweet being saved, which a handoff waits for. Return False
+    once a handoff has started. """
+    global __writes_in_flight
+    with __write_gate:
+        if __handing_off:
+            return False
+        __writes_in_flight += 1
     return True
 
 
-def save_tweet(data: str) -> bool:
-    """ Save crawled tweets to file in thread-safe way """
+def end_write() -> None:
+    global __writes_in_flight
+    with __write_gate:
+        __writes_in_flight -= 1
+        __write_gate.notify_all()
+
+
+def save_tweet(data: str, streams: list = None) -> bool:
+    """ Save crawled tweets to file in thread-safe way. Without streams, a
+    tweet of the filtered stream is saved to every stream it matched. """
+    if not begin_write():
+        return False  # The new crawler saves it
+    try:
+        return write_parsed(data, streams)
+    finally:
+        end_write()
+
+
+def write_parsed(data: str, streams: list) -> bool:
+    """ Parse, check and normalize a tweet, then write it """
     try:
         tweet = json.loads(data)
     except ValueError:
@@ -450,65 +628,671 @@ def save_tweet(data: str) -> bool:
         non_tweet = json.dumps(tweet, separators = (",", ":"), sort_keys = True)
         write_log(f"Non-tweet: {non_tweet}", True)
         return False
-    if "matching_rules" in tweet:
-        del tweet["matching_rules"]
-    if trim_json(tweet):
-        return False
-    data = json.dumps(tweet, separators = (",", ":"), sort_keys = True) + "\n"
+    if streams is None:
+        streams = matched_streams(tweet)
     timestamp = datetime.strptime(tweet["data"]["created_at"],
                                   "%Y-%m-%dT%H:%M:%S.%fZ")
-    file, lock = create_or_get_file(timestamp)
-    lock.acquire()
-    if file.closed:
-        lock.release()
+    tweet_id = tweet["data"]["id"]
+    lag = time.time() - timestamp.replace(tzinfo = timezone.utc).timestamp()
+    summary = (tweet_facts(tweet), lag)
+    data = normalize_tweet(tweet, __profile)
+    if data is None:
         return False
+    saved = False
+    for name in streams:
+        stream = __streams.get(name)
+        if stream is None:
+            continue
+        entry = (timestamp, stream["prefix"], data, "", tweet_id, summary)
+        if __shedder is None:
+            saved = write_entry(*entry) or saved
+        elif __shedder.write(summary[0][3], entry):
+            saved = True
+    return saved
+
+
+def save_raw_tweet(data: str, streams: list = None) -> bool:
+    """ Save a raw payload to the hourly .raw file of its streams, without
+    parsing it. The uploader normalizes the .raw files later. Without
+    streams, the streams are found from the tags of the matching rules. """
+    if not begin_write():
+        return False  # The new crawler saves it
     try:
-        file.write(data)  # Save the crawled tweet
-    except BaseException as ex:
-        lock.release()
-        write_log(f"Error on_data: {ex}", True)
-        return False
-    lock.release()
-    return True
+        return write_raw(data, streams)
+    finally:
+        end_write()
+
+
+def write_raw(data: str, streams: list) -> bool:
+    """ Write a raw payload as it is, once its id and time are found """
+    tweet_id, created_at = scan_raw_tweet(data)
+    if tweet_id is None or created_at is None:
+        # Not a tweet, or an unusual payload, take the slow way
+        return write_parsed(data, streams)
+    if streams is None:
+        streams = []
+        for tag in scan_raw_tags(data):
+            name = tag.split(":", 1)[0]
+            if name in __streams and name not in streams:
+                streams.append(name)
+    try:
+        timestamp = datetime(int(created_at[0:4]), int(created_at[5:7]),
+                             int(created_at[8:10]), int(created_at[11:13]))
+    except ValueError:
+        return write_parsed(data, streams)
+    data = data.rstrip("\r\n") + "\n"
+    saved = False
+    for name in streams:
+        stream = __streams.get(name)
+        if stream is None:
+            continue
+        entry = (timestamp, stream["prefix"], data, ".raw", tweet_id, None)
+        if __shedder is None:
+            saved = write_entry(*entry) or saved
+        elif __shedder.write(scan_raw_geo(data), entry):
+            saved = True
+    return saved
+
+
+# Rolling restart: a new crawler started with --takeover holds the tweets it
+# receives, and sends "HANDOFF FIRST_ID" to the control socket of the old
+# one. The old crawler stops writing, closes its files and replies with the
+# ids it wrote from FIRST_ID on and the state of its open files, then exits.
+# The new crawler writes what it holds, without these ids, and goes on.
+HANDOFF_TIMEOUT = 60
+# Tweets may arrive slightly out of order, the old crawler also reports the
+# ids up to 10 s (in the timestamp bits of the ids) older than FIRST_ID
+HANDOFF_MARGIN = 10000 << 22
+__recent_ids = deque(maxlen = 65536)  # Ids written last, oldest first
+# Set once a handoff has started, no tweet is saved after, and the tweets
+# being saved are counted until they are written
+__handing_off = False
+__writes_in_flight = 0
+__write_gate = Condition()
+# Set once the files are closed for the new crawler, none is opened after
+__handed_off = False
+# Ids the old crawler wrote, skipped until the tweets saved are past the
+# margin after the last of them
+__handed_ids = set()
+__handed_until = 0
+
+
+def export_file_state() -> list:
+    """ Counts, statistics, summaries and raw ids of the open hours """
+    keys = set(__file_counts) | set(__file_stats) | set(__file_summaries) | \
+        set(__file_shed) | set(__raw_ids)
+    files = []
+    for key in sorted(keys):
+        entry = {"key": list(key), "count": __file_counts.get(key, 0),
+                 "shed": list(__file_shed.get(key, (0, 0))),
+                 "raw_ids": sorted(__raw_ids.get(key, set()))}
+        if key in __file_stats:
+            stats = __file_stats[key]
+            entry["stats"] = None if stats is None else stats.to_dict()
+        if key in __file_summaries:
+            entry["summary"] = __file_summaries[key].to_dict()
+        files.append(entry)
+    return files
+
+
+def import_file_state(files: list, ids: list) -> None:
+    """ Go on counting the open hours of the old crawler, and skip the
+    tweets it wrote """
+    global __handed_until
+    __handed_ids.update(ids)
+    if len(ids) > 0:
+        __handed_until = max(int(i) for i in ids) + HANDOFF_MARGIN
+    with __file_lock:
+        for entry in files:
+            key = (entry["key"][0], entry["key"][1])
+            __file_counts[key] = entry["count"]
+            __file_shed[key] = tuple(entry["shed"])
+            if len(entry["raw_ids"]) > 0:
+                __raw_ids[key] = set(entry["raw_ids"])
+            if "stats" in entry:
+                __file_stats[key] = None if entry["stats"] is None \
+                    else HourStats(entry["stats"])
+            if "summary" in entry:
+                __file_summaries[key] = HourSummary(entry["summary"])
+
 
+def hand_off(conn: socket.socket, first_id: int) -> None:
+    """ Stop writing, close the files and tell the new crawler what it needs
+    to go on, then exit """
+    global __handing_off, __handed_off
+    write_log(f"Handing off to a new crawler from tweet {first_id}", False)
+    with __write_gate:
+        __handing_off = True
+        __write_gate.wait_for(lambda: __writes_in_flight == 0)
+    if __shedder is not None:
+        __shedder.close()
+    with __file_lock:
+        __handed_off = True
+    for sink in __sinks:
+        sink.close()
+    with __file_lock:
+        files = export_file_state()
+    ids = sorted({i for i in list(__recent_ids)
+                  if int(i) >= first_id - HANDOFF_MARGIN}, key = int)
+    reply = json.dumps({"ids": ids, "files": files},
+                       separators = (",", ":"))
+    try:
+        conn.sendall(reply.encode("utf-8") + b"\n")
+        conn.close()
+    except OSError as e:
+        write_log(f"Failed to hand off: {e}", True)
+    write_log(f"Handed off {len(files)} open hours, {len(ids)} tweets "
+              f"written since {first_id}", False)
+    # The streams and their threads are left to the exit, and may still log
+    # until then, the log file is closed by the exit
+    if __log_file is not None:
+        with __log_lock:
+            __log_file.flush()
+    os._exit(0)
+
+
+def serve_control(path: str) -> None:
+    """ Listen on the control socket for a new crawler taking over """
+    try:
+        os.remove(path)  # Left by the crawler that was replaced
+    except FileNotFoundError:
+        pass
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    write_log(f"Listening for a rolling restart on {path}", False)
+    while True:
+        conn, _ = server.accept()
+        try:
+            conn.settimeout(10)
+            request = conn.makefile("r").readline().split()
+            if len(request) == 2 and request[0] == "HANDOFF":
+                hand_off(conn, int(request[1]))
+            conn.close()
+        except (OSError, ValueError) as e:
+            write_log(f"Invalid control request: {e}", True)
+            conn.close()
 
-class CrawlerStream(tweepy.StreamingClient):
-    """ Custom class for steaming Tweets """
 
-    def __init__(self, bearer_token: str,
-                 save_func: Callable, log_func: Callable):
+class HandoffBuffer:
+    """ Hold the tweets of a crawler taking over until the old one has
+    stopped, then save them without those the old one wrote """
+
+    def __init__(self, save_func: Callable, path: str,
+                 on_take_over: Callable, log_func: Callable):
         """ Keyword arguments:
-        save_func -- thread-safe function to write tweet to file
+        save_func -- function saving a tweet once the old crawler stopped
+        path -- control socket of the old crawler
+        on_take_over -- called when the old crawler stopped
         log_func -- thread-safe function to write to log
         """
-        super(CrawlerStream, self).__init__(bearer_token,
-                                            wait_on_rate_limit = True)
-        self.__saveFunc = save_func
-        self.__logFunc = log_func
+        self.__save_func = save_func
+        self.__path = path
+        self.__on_take_over = on_take_over
+        self.__log_func = log_func
+        self.__lock = Lock()
+        self.__held = []
+        self.__done = False
+        self.finished = Event()
+
+    def save(self, data: str, streams: list = None) -> bool:
+        if not self.__done:
+            with self.__lock:
+                if not self.__done:
+                    self.__held.append((data, streams))
+                    if len(self.__held) == 1 and not self.finished.is_set():
+                        tweet_id, _ = scan_raw_tweet(data)
+                        Thread(target = self.__take_over,
+                               args = (int(tweet_id or 0),),
+                               daemon = True).start()
+                    return True
+        return self.__save_func(data, streams)
 
-    def on_exception(self, exception):
-        time.sleep(5)
-        raise Exception(f"Encountered error with exception: {exception}")
+    def __request(self, first_id: int) -> dict:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(HANDOFF_TIMEOUT)
+            conn.connect(self.__path)
+            conn.sendall(f"HANDOFF {first_id}\n".encode("utf-8"))
+            return json.loads(conn.makefile("r").readline())
 
-    def on_data(self, raw_data: bytes) -> bool:
+    def __take_over(self, first_id: int) -> None:
         try:
-            self.__saveFunc(raw_data.decode("utf-8"))
-        except (http_incompleteRead, urllib3_incompleteRead):
+            reply = self.__request(first_id)
+            import_file_state(reply["files"], reply["ids"])
+            self.__log_func(f"Took over from tweet {first_id}, "
+                            f"{len(reply['ids'])} tweets already written",
+                            False)
+        except (OSError, ValueError, KeyError) as e:
+            self.__log_func(f"No crawler to take over from: {e}", True)
+        self.__on_take_over()
+        self.finished.set()
+        while True:
+            with self.__lock:
+                held = self.__held
+                self.__held = []
+                if len(held) == 0:
+                    self.__done = True
+                    break
+            for data, streams in held:
+                self.__save_func(data, streams)
+        self.__log_func("Writing tweets", False)
+
+
+def sync_rules(client) -> None:
+    """ Make the rules of the filtered stream match the streams """
+    from tweepy import StreamingRule
+    wanted = {}
+    for stream in __streams.values():
+        wanted.update(stream["rules"])
+    current = client.get_rules().data or []
+    stale = [r.id for r in current if wanted.get(r.tag) != r.value]
+    kept = set(r.tag for r in current if wanted.get(r.tag) == r.value)
+    if len(stale) > 0:
+        client.delete_rules(stale)
+        write_log(f"Deleted {len(stale)} stream rules", False)
+    added = [StreamingRule(value, tag) for tag, value in wanted.items()
+             if tag not in kept]
+    if len(added) > 0:
+        response = client.add_rules(added)
+        for error in response.errors or []:
+            write_log(f"Failed to add stream rule: {error}", True)
+        write_log(f"Added {len(added)} stream rules", False)
+
+
+__filter_stream = None
+
+
+def watch_rules() -> None:
+    """ Apply rule changes of the settings file to the filtered stream
+    without restarting """
+    global __streams, __streams_mtime
+    while True:
+        time.sleep(60)
+        try:
+            mtime = os.path.getmtime(__setting_path)
+            if mtime == __streams_mtime:
+                continue
+            __streams_mtime = mtime
+            streams = read_streams(__setting_path)
+            old_sample = [n for n, s in __streams.items()
+                          if len(s["rules"]) == 0]
+            new_sample = [n for n, s in streams.items()
+                          if len(s["rules"]) == 0]
+            if old_sample != new_sample or \
+                    [s["prefix"] for n, s in __streams.items()
+                     if n in old_sample] != \
+                    [s["prefix"] for n, s in streams.items()
+                     if n in new_sample]:
+                write_log("The sample stream changed, restart to apply it",
+                          True)
+                continue
+            if __filter_stream is None:
+                if any(len(s["rules"]) > 0 for s in streams.values()):
+                    write_log("Filtered streams added, restart to apply them",
+                              True)
+                continue
+            __streams = streams
+            sync_rules(__filter_stream)
+            write_log(f"Reloaded streams: {', '.join(__streams.keys())}",
+                      False)
+        except Exception as ex:
+            write_log(f"Failed to reload streams: {ex}", True)
+
+
+def run_streams(streams: list) -> None:
+    """ Run every stream in its own thread, return or raise as soon as one
+    of them stops """
+    stopped = Event()
+    errors = []
+
+    def run(stream) -> None:
+        try:
+            stream.start_stream()
+        except BaseException as be:
+            errors.append(be)
+        finally:
+            stopped.set()
+
+    for stream in streams:
+        Thread(target = run, args = (stream,), daemon = True).start()
+    try:
+        while not stopped.wait(1):
+            pass
+    finally:
+        for stream in streams:
+            stream.disconnect()
+    if len(errors) > 0:
+        raise errors[0]
+
+
+__stream_class = None
+
+
+def stream_class() -> type:
+    """ The class of the stream clients. Tweepy is only imported and the
+    class only defined when the first client is created, so importing the
+    crawler does not need Tweepy. """
+    global __stream_class
+    if __stream_class is not None:
+        return __stream_class
+    import tweepy  # Requires Tweepy 4.0.0+
+    from urllib3.exceptions import IncompleteRead as urllib3_incompleteRead
+
+    class CrawlerStream(tweepy.StreamingClient):
+        """ Custom class for steaming Tweets """
+
+        def __init__(self, bearer_token: str,
+                     save_func: Callable, log_func: Callable,
+                     fields: dict = None, filtered: bool = False):
+            """ Keyword arguments:
+            save_func -- thread-safe function to write tweet to file
+            log_func -- thread-safe function to write to log
+            fields -- fields and expansions to request, all if not set
+            filtered -- connect to the filtered stream instead of the sample
+            """
+            super(CrawlerStream, self).__init__(bearer_token,
+                                                wait_on_rate_limit = True)
+            self.__saveFunc = save_func
+            self.__logFunc = log_func
+            self.__fields = fields if fields is not None else PROFILE_FIELDS
+            self.__filtered = filtered
+
+        def on_exception(self, exception):
+            time.sleep(5)
+            raise Exception(f"Encountered error with exception: {exception}")
+
+        def on_data(self, raw_data: bytes) -> bool:
+            try:
+                self.__saveFunc(raw_data.decode("utf-8"))
+            except (http_incompleteRead, urllib3_incompleteRead):
+                time.sleep(5)
+            return True  # Continue crawling
+
+        def on_limit(self, track: int):
             time.sleep(5)
-        return True  # Continue crawling
+            raise Exception(f"Encountered rate limited {track}")
+
+        def start_sample(self, threaded: bool = False):
+            self.sample(media_fields = self.__fields["media_fields"],
+                        place_fields = self.__fields["place_fields"],
+                        poll_fields = self.__fields["poll_fields"],
+                        tweet_fields = self.__fields["tweet_fields"],
+                        user_fields = self.__fields["user_fields"],
+                        expansions = self.__fields["expansions"],
+                        threaded = threaded)
+
+        def start_filter(self, threaded: bool = False):
+            self.filter(media_fields = self.__fields["media_fields"],
+                        place_fields = self.__fields["place_fields"],
+                        poll_fields = self.__fields["poll_fields"],
+                        tweet_fields = self.__fields["tweet_fields"],
+                        user_fields = self.__fields["user_fields"],
+                        expansions = self.__fields["expansions"],
+                        threaded = threaded)
+
+        def start_stream(self, threaded: bool = False):
+            if self.__filtered:
+                self.start_filter(threaded)
+            else:
+                self.start_sample(threaded)
+
+    __stream_class = CrawlerStream
+    return __stream_class
+
+
+def create_stream(bearer_token: str, save_func: Callable, log_func: Callable,
+                  fields: dict = None, filtered: bool = False):
+    """ A new stream client, see CrawlerStream """
+    return stream_class()(bearer_token, save_func, log_func, fields,
+                          filtered)
+
+
+__diag_lock = Lock()
+# Functions of the file layer, to tell which threads may hold its locks
+FILE_LAYER_FUNCTIONS = ("create_or_get_file", "close_all_files", "write_tweet")
+
+
+def dump_state() -> str:
+    """ Snapshot of the thread stacks, the file locks and the open files """
+    lines = [f"Open files: {len(__open_files)}",
+             f"__file_lock: {'locked' if __file_lock.locked() else 'free'}"]
+    for key, (_, lock, _, tmp) in sorted(list(__open_files.items())):
+        state = "locked" if lock.locked() else "free"
+        lines.append(f"  {tmp}: {state}, {__file_counts.get(key, 0)} tweets")
+    names = {t.ident: t.name for t in all_threads()}
+    for ident, frame in sys._current_frames().items():
+        stack = traceback.extract_stack(frame)
+        inside = [f.name for f in stack if f.name in FILE_LAYER_FUNCTIONS]
+        lines.append("")
+        lines.append(f"Thread {names.get(ident, '?')} ({ident})"
+                     + (f", in {' > '.join(inside)}" if inside else ""))
+        lines.extend(line.rstrip("\n")
+                     for line in traceback.format_list(stack))
+    return "\n".join(lines) + "\n"
+
+
+def write_dump(kind: str, state: str, report: str) -> None:
+    name = datetime.now().strftime(f"crawler-{kind}-%Y%m%d-%H%M%S.txt")
+    path = os.path.join(__working_dir, name)
+    with open(path, "w") as outf:
+        outf.write(report)
+        outf.write("\n=== State when profiling started ===\n")
+        outf.write(state)
+    outf.close()
+    write_log(f"Wrote {path}", False)
 
-    def on_limit(self, track: int):
-        time.sleep(5)
-        raise Exception(f"Encountered rate limited {track}")
 
-    def start_sample(self, threaded: bool = False):
-        self.sample(media_fields = FIELDS_MEDIA,
-                    place_fields = FIELDS_PLACE,
-                    poll_fields = FIELDS_POLL,
-                    tweet_fields = FIELDS_TWEET,
-                    user_fields = FIELDS_USER,
-                    expansions = FIELDS_EXPANSIONS,
-                    threaded = threaded)
+def sample_cpu(seconds: int, interval: float = 0.005) -> None:
+    """ Sample the stacks of all other threads for some seconds, and dump the
+    functions seen most often """
+    state = dump_state()
+    me = get_ident()
+    own = Counter()
+    total = Counter()
+    stacks = Counter()
+    num_samples = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            code = frame.f_code
+            own[(code.co_filename, frame.f_lineno, code.co_name)] += 1
+            names = []
+            seen = set()
+            while frame is not None:
+                code = frame.f_code
+                func = (code.co_filename, code.co_firstlineno, code.co_name)
+                if func not in seen:
+                    seen.add(func)
+                    total[func] += 1
+                names.append(code.co_name)
+                frame = frame.f_back
+            stacks[";".join(reversed(names))] += 1
+        num_samples += 1
+        time.sleep(interval)
+
+    lines = [f"CPU samples: {num_samples} in {seconds}s, "
+             f"every {interval * 1000:.0f}ms", "",
+             "Most frequent lines (own):"]
+    for (fn, lineno, name), n in own.most_common(40):
+        lines.append(f"{n:>8} {n / max(1, num_samples):>7.1%}  "
+                     f"{name} {fn}:{lineno}")
+    lines += ["", "Most frequent functions (total):"]
+    for (fn, lineno, name), n in total.most_common(40):
+        lines.append(f"{n:>8} {n / max(1, num_samples):>7.1%}  "
+                     f"{name} {fn}:{lineno}")
+    lines += ["", "Collapsed stacks:"]
+    for stack, n in stacks.most_common():
+        lines.append(f"{stack} {n}")
+    write_dump("cpu", state, "\n".join(lines) + "\n")
+
+
+def trace_memory(seconds: int) -> None:
+    """ Trace the allocations for some seconds, and dump the largest ones """
+    state = dump_state()
+    tracemalloc.start(16)
+    try:
+        time.sleep(seconds)
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),))
+    lines = [f"Traced for {seconds}s, current {current} B, peak {peak} B", "",
+             "Largest allocations by line:"]
+    for stat in snapshot.statistics("lineno")[:40]:
+        lines.append(str(stat))
+    lines += ["", "Largest allocations by traceback:"]
+    for stat in snapshot.statistics("traceback")[:10]:
+        lines.append(str(stat))
+        lines.extend(f"    {line}" for line in stat.traceback.format())
+    write_dump("memory", state, "\n".join(lines) + "\n")
+
+
+def run_diagnostic(func: Callable, acquired: bool) -> None:
+    if not acquired:
+        write_log("Profiling is already running", True)
+        return
+    try:
+        write_log(f"Running {func.__name__} for {__profile_seconds}s", False)
+        func(__profile_seconds)
+    except Exception as e:
+        write_log(f"Profiling failed: {e}", True)
+    finally:
+        __diag_lock.release()
+
+
+def on_diagnostic_signal(signum, frame) -> None:
+    """ SIGUSR1 samples the CPU and SIGUSR2 traces the memory, in a thread of
+    their own. Nothing runs in the crawler until one is received. The
+    handler may interrupt the main thread while it holds the log lock, so
+    it only starts the thread, which logs. """
+    acquired = __diag_lock.acquire(blocking = False)
+    func = sample_cpu if signum == signal.SIGUSR1 else trace_memory
+    Thread(target = run_diagnostic, args = (func, acquired),
+           name = func.__name__, daemon = True).start()
+
+
+def start_fanout() -> None:
+    """ Add the fan-out sink, if enabled """
+    if __fanout_address is not None and __raw_ingest:
+        write_log("Tweets are not parsed in raw ingest mode, fan-out is "
+                  "disabled", True)
+    elif __fanout_address is not None:
+        try:
+            __sinks.append(FanoutSink(__fanout_address, __fanout_buffer,
+                                      write_log))
+        except (OSError, ValueError) as e:
+            write_log(f"Failed to start fan-out on {__fanout_address}: {e}",
+                      True)
+            sys.exit(-1)
+
+
+def setup(setting_path: str, takeover: bool = False) -> None:
+    """ Read the settings, open the log, and create the sinks and the load
+    shedder. Exit if the settings cannot be used. Nothing connects to
+    Twitter before the streams are started, and no socket is bound before
+    main() starts the fan-out and the control socket. """
+    global __setting_path, __working_dir, __num_threads, __log_path, \
+        __log_file, __twitter_bear_token, __email_address, __email_name, \
+        __email_password, __email_smtp, __email_port, __email_ssl, \
+        __email_recipients, __fanout_address, __fanout_buffer, \
+        __raw_ingest, __profile_seconds, __mmap_writer, __shed_latency, \
+        __shed_keep_rate, __shed_overflow_mb, __control_socket, __profiles, \
+        __projection_profile, __profile, __streams, __streams_mtime, \
+        __sinks, __shedder
+    __setting_path = setting_path
+    try:
+        settings = read_settings(__setting_path, CRAWLER_SETTINGS, False)
+    except OSError as e:
+        print(f"Cannot read {__setting_path}: {e}", file = sys.stderr)
+        sys.exit(-1)
+    __working_dir = settings[KEY_WORKING_DIR]
+    __num_threads = settings[KEY_NUM_THREADS]
+    __twitter_bear_token = settings[KEY_TWITTER_BEAR_TOKEN]
+    __email_address = settings[KEY_EMAIL_ADDRESS]
+    __email_name = settings[KEY_EMAIL_NAME]
+    __email_password = settings[KEY_EMAIL_PASSWORD]
+    __email_smtp = settings[KEY_EMAIL_SMTP]
+    __email_port = settings[KEY_EMAIL_PORT]
+    __email_ssl = settings[KEY_EMAIL_SSL]
+    __email_recipients = settings[KEY_EMAIL_RECIPIENTS]
+    __fanout_address = settings[KEY_FANOUT_ADDRESS]
+    __fanout_buffer = settings[KEY_FANOUT_BUFFER]
+    __raw_ingest = settings[KEY_INGEST_MODE] == "raw"
+    __profile_seconds = settings[KEY_PROFILE_SECONDS]
+    __mmap_writer = settings[KEY_WRITER] == "mmap"
+    __shed_latency = settings[KEY_SHED_LATENCY_MS] / 1000
+    __shed_keep_rate = settings[KEY_SHED_KEEP_RATE]
+    __shed_overflow_mb = settings[KEY_SHED_OVERFLOW_MB]
+    __control_socket = settings[KEY_CONTROL_SOCKET]
+
+    if settings[KEY_LOG_File] is not None:
+        __log_path = settings[KEY_LOG_File]
+        try:
+            __log_file = open(__log_path, "a")
+        except OSError:
+            print(f"Failed to write to {__log_path}", file = sys.stderr)
+            __log_path = None
+            __log_file = None
+
+    if __working_dir is None:
+        print(f"{KEY_WORKING_DIR} is not set", file = sys.stderr)
+        sys.exit(-1)
+
+    if not os.path.isdir(__working_dir):
+        try:
+            os.mkdir(__working_dir)
+        except BaseException as e:
+            print(f"Failed to create directory {__working_dir}: {e}",
+                  file = sys.stderr)
+            sys.exit(-1)
+
+    if __twitter_bear_token is None:
+        print(f"{KEY_TWITTER_BEAR_TOKEN} is not set", file = sys.stderr)
+        sys.exit(-1)
+
+    try:
+        __profiles, __projection_profile = read_profiles(__setting_path)
+        __profile = get_profile(__profiles, __projection_profile)
+    except (OSError, ValueError) as e:
+        print(f"Cannot read profiles from {__setting_path}: {e}",
+              file = sys.stderr)
+        sys.exit(-1)
+
+    try:
+        __streams = read_streams(__setting_path)
+        __streams_mtime = os.path.getmtime(__setting_path)
+    except (OSError, ValueError) as e:
+        print(f"Cannot read streams from {__setting_path}: {e}",
+              file = sys.stderr)
+        sys.exit(-1)
+
+    # Email
+    if __email_address is None or __email_smtp is None \
+            or __email_port < 1 \
+            or __email_recipients is None or len(__email_recipients) == 0:
+        __email_address = None
+        __email_name = None
+        __email_password = None
+        __email_smtp = None
+        __email_port = -1
+        __email_recipients = None
+
+    if takeover and __control_socket is None:
+        print(f"{KEY_CONTROL_SOCKET} is not set, cannot take over",
+              file = sys.stderr)
+        sys.exit(-1)
+
+    __sinks = [HourlyFileSink()]
+
+    __shedder = None
+    if __shed_latency > 0:
+        __shedder = LoadShedder(__shed_latency, __shed_keep_rate,
+                                __shed_overflow_mb * 1048576, write_entry,
+                                count_shed, is_hour_finished, write_log)
 
 
 def get_time() -> bool:
@@ -538,23 +1322,77 @@ def get_time() -> bool:
     return True
 
 
-if __name__ == "__main__":
+def start_control() -> None:
+    """ Start the fan-out and the control socket after taking over """
+    start_fanout()
+    Thread(target = serve_control, args = (__control_socket,),
+           daemon = True).start()
+
+
+def main() -> None:
+    global __filter_stream
+    from urllib3.exceptions import IncompleteRead as urllib3_incompleteRead
+    if len(sys.argv) not in (2, 3) or \
+            (len(sys.argv) == 3 and sys.argv[2] != "--takeover"):
+        print("Usage: {0} SETTINGS_FILE [--takeover]".format(
+            os.path.basename(__file__)))
+        sys.exit(0)
+    setting_path = os.path.abspath(sys.argv[1])
+    if not os.path.isfile(setting_path):
+        print("Cannot find {0}".format(setting_path), file = sys.stderr)
+        sys.exit(-1)
+    takeover = len(sys.argv) == 3
+    t = time.perf_counter()
+    setup(setting_path, takeover)
+    write_log(f"Started in {time.perf_counter() - t:.3f} s", False)
+
     silent_start = False
     host = socket.gethostname()
+    __save_func = save_raw_tweet if __raw_ingest else save_tweet
+    if takeover:
+        # Hold the tweets until the running crawler stopped, the fan-out is
+        # only started then
+        __save_func = HandoffBuffer(__save_func, __control_socket,
+                                    start_control, write_log).save
+    else:
+        start_fanout()
+        if __control_socket is not None:
+            Thread(target = serve_control, args = (__control_socket,),
+                   daemon = True).start()
+    signal.signal(signal.SIGUSR1, on_diagnostic_signal)
+    signal.signal(signal.SIGUSR2, on_diagnostic_signal)
+    Thread(target = watch_rules, daemon = True).start()
     while True:
         if not silent_start:
             now_str = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
             content = f"Started at {now_str} on {host}"
             send_email(f"[TweetCrawler]: {content}", content)
-        cs = None
+        css = []
         try:
-            cs = CrawlerStream(__twitter_bear_token, save_tweet, write_log)
-            for _ in range(__num_threads):
-                cs.start_sample(__num_threads > 1)
+            for name, stream in __streams.items():
+                if len(stream["rules"]) == 0:
+                    css.append(create_stream(__twitter_bear_token,
+                                             partial(__save_func,
+                                                     streams = [name]),
+                                             write_log, __profile))
+            if any(len(s["rules"]) > 0 for s in __streams.values()):
+                __filter_stream = create_stream(__twitter_bear_token,
+                                                __save_func, write_log,
+                                                __profile, True)
+                sync_rules(__filter_stream)
+                css.append(__filter_stream)
+            if len(css) == 1:
+                for _ in range(__num_threads):
+                    css[0].start_stream(__num_threads > 1)
+            else:
+                run_streams(css)
         except (KeyboardInterrupt, SystemExit):
-            if cs is not None:
+            for cs in css:
                 cs.disconnect()
-            close_all_files()
+            if __shedder is not None:
+                __shedder.close()
+            for sink in __sinks:
+                sink.close()
             if __log_file is not None:
                 __log_file.close()
             raise
@@ -590,3 +1428,7 @@ if __name__ == "__main__":
                 else:
                     time.sleep(240)
                 silent_start = False
+
+
+if __name__ == "__main__":
+    main()
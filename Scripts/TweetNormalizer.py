@@ -0,0 +1,574 @@
+""" Tweet normalization shared by the crawler and the uploader. Importing
+this module has no side effects. """
+
+import json
+import os
+import re
+import sys
+from array import array
+from datetime import datetime
+
+from SegmentWriter import HourStats
+from Settings import read_setting
+
+# https://developer.twitter.com/en/docs/twitter-api/expansions
+FIELDS_EXPANSIONS = [
+    "author_id",
+    "referenced_tweets.id",
+    "in_reply_to_user_id",
+    "attachments.media_keys",
+    "attachments.poll_ids",
+    "geo.place_id",
+    "entities.mentions.username",
+    "referenced_tweets.id.author_id",
+]
+
+# https://developer.twitter.com/en/docs/twitter-api/data-dictionary/object-model/media
+FIELDS_MEDIA = [
+    "media_key",
+    "type",
+    "url",
+    "duration_ms",
+    "height",
+    # "non_public_metrics",
+    # "organic_metrics",
+    "preview_image_url",
+    # "promoted_metrics",
+    "public_metrics",
+    "width",
+    "alt_text",
+    "variants",
+]
+
+# https://developer.twitter.com/en/docs/twitter-api/data-dictionary/object-model/place
+FIELDS_PLACE = [
+    "full_name",
+    "id",
+    "contained_within",
+    "country",
+    "country_code",
+    "geo",
+    "name",
+    "place_type",
+]
+
+# https://developer.twitter.com/en/docs/twitter-api/data-dictionary/object-model/poll
+FIELDS_POLL = [
+    "id",
+    "options",
+    "duration_minutes",
+    "end_datetime",
+    "voting_status",
+]
+
+# https://developer.twitter.com/en/docs/twitter-api/data-dictionary/object-model/tweet
+FIELDS_TWEET = [
+    "id",
+    "text",
+    "attachments",
+    "author_id",
+    "context_annotations",
+    "conversation_id",
+    "created_at",
+    "entities",
+    "geo",
+    "in_reply_to_user_id",
+    "lang",
+    "non_public_metrics",
+    "organic_metrics",
+    "possibly_sensitive",
+    "promoted_metrics",
+    "public_metrics",
+    "referenced_tweets",
+    "reply_settings",
+    "source",
+    "withheld",
+]
+
+# https://developer.twitter.com/en/docs/twitter-api/data-dictionary/object-model/user
+FIELDS_USER = [
+    "id",
+    "name",
+    "username",
+    "created_at",
+    "description",
+    "entities",
+    "location",
+    "pinned_tweet_id",
+    "profile_image_url",
+    "protected",
+    "public_metrics",
+    "url",
+    "verified",
+    "withheld",
+]
+
+KEY_PROJECTION_PROFILE = "projection_profile"
+KEY_PROFILE_PREFIX = "profile."
+
+# Options of a projection profile, "profile.NAME.OPTION=a,b,c". The field
+# options are passed to the stream as is, drop and keep are dotted paths
+# applied to each tweet before it is saved.
+PROFILE_FIELDS = {
+    "expansions": FIELDS_EXPANSIONS,
+    "media_fields": FIELDS_MEDIA,
+    "place_fields": FIELDS_PLACE,
+    "poll_fields": FIELDS_POLL,
+    "tweet_fields": FIELDS_TWEET,
+    "user_fields": FIELDS_USER,
+}
+PROFILE_PATHS = ["drop", "keep"]
+# Fields a profile cannot leave out, is_valid_tweet refuses tweets without
+PROFILE_REQUIRED = {
+    "expansions": ["author_id"],
+    "tweet_fields": ["author_id", "created_at"],
+}
+
+# Streams to capture, "streams=a,b,c", with options "stream.NAME.prefix",
+# "stream.NAME.rule.TAG=RULE" and "stream.NAME.backfill_query". A stream
+# with rules is captured from the filtered stream, the stream without rules
+# from the sample stream.
+KEY_STREAMS = "streams"
+KEY_STREAM_PREFIX = "stream."
+STREAM_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_]+$")
+
+
+def read_profiles(path: str) -> (dict, str):
+    """ Read the projection profiles of a settings file, return them and the
+    name of the profile in use """
+    name = "full"
+    profiles = {"full": {}}
+    with open(path, "r") as inf:
+        for line in inf:
+            key, val = read_setting(line.rstrip("\n").rstrip("\r"))
+            if key == KEY_PROJECTION_PROFILE:
+                if len(val) > 0:
+                    name = val
+            elif key is not None and key.startswith(KEY_PROFILE_PREFIX):
+                parts = key.split(".", 2)
+                if len(parts) != 3 or (parts[2] not in PROFILE_FIELDS and
+                                       parts[2] not in PROFILE_PATHS):
+                    print(f"Incorrect profile option: {key}",
+                          file = sys.stderr)
+                    continue
+                _, profile_name, option = parts
+                profiles.setdefault(profile_name, {})[option] = \
+                    [v.strip() for v in val.split(",") if len(v.strip()) > 0]
+    if name not in profiles:
+        raise ValueError(f"Cannot find profile {name}")
+    for profile_name, profile in profiles.items():
+        for option, required in PROFILE_REQUIRED.items():
+            missing = [f for f in required if option in profile and
+                       f not in profile[option]]
+            if len(missing) > 0:
+                raise ValueError(f"Profile {profile_name} needs "
+                                 f"{', '.join(missing)} in {option}")
+    return profiles, name
+
+
+def read_streams(path: str) -> dict:
+    """ Read the streams of a settings file. Rules are keyed by their tag on
+    the filtered stream, "NAME:TAG". """
+    names = ["sample"]
+    options = {}
+    with open(path, "r") as inf:
+        for line in inf:
+            key, val = read_setting(line.rstrip("\n").rstrip("\r"))
+            if key == KEY_STREAMS:
+                names = [v.strip() for v in val.split(",")
+                         if len(v.strip()) > 0]
+            elif key is not None and key.startswith(KEY_STREAM_PREFIX):
+                options[key] = val
+    streams = {}
+    prefixes = set()
+    for name in names:
+        if not STREAM_NAME_PATTERN.match(name):
+            raise ValueError(f"Incorrect stream name: {name}")
+        prefix = options.get(f"{KEY_STREAM_PREFIX}{name}.prefix", "")
+        if len(prefix) == 0:
+            prefix = "tweets" if name == "sample" else name
+        if not STREAM_NAME_PATTERN.match(prefix) or prefix in prefixes:
+            raise ValueError(f"Incorrect prefix of stream {name}: {prefix}")
+        prefixes.add(prefix)
+        rule_key = f"{KEY_STREAM_PREFIX}{name}.rule."
+        rules = {}
+        for key, val in options.items():
+            if key.startswith(rule_key) and len(val) > 0:
+                rules[f"{name}:{key[len(rule_key):]}"] = val
+        query = options.get(f"{KEY_STREAM_PREFIX}{name}.backfill_query", "")
+        streams[name] = {"prefix": prefix, "rules": rules,
+                         "backfill_query": query or None}
+    if len([s for s in streams.values() if len(s["rules"]) == 0]) > 1:
+        raise ValueError("Only one stream can be without rules")
+    return streams
+
+
+def trim_json(jobj) -> bool:
+    """ Remove any empty fields in a json object recursively. Return True if
+    the trimmed object is None or empty. """
+    if jobj is None:
+        return True
+    if type(jobj) is dict:
+        keys = list(jobj.keys())
+        for key in keys:
+            if trim_json(jobj[key]):
+                del jobj[key]
+        return len(jobj) == 0
+    if type(jobj) is list:
+        for i in range(len(jobj) - 1, -1, -1):
+            if trim_json(jobj[i]):
+                del jobj[i]
+        return len(jobj) == 0
+    if type(jobj) is str:
+        return len(jobj) == 0
+    return False
+
+
+def compile_paths(paths: list) -> dict:
+    """ Turn dotted paths into a tree of dicts, leaves are empty dicts """
+    tree = {}
+    for path in paths:
+        node = tree
+        for part in path.split("."):
+            node = node.setdefault(part, {})
+    return tree
+
+
+def get_profile(profiles: dict, name: str) -> dict:
+    """ Resolve a projection profile, fields not set in the profile are
+    all requested """
+    profile = {}
+    for option, fields in PROFILE_FIELDS.items():
+        profile[option] = profiles[name].get(option, fields)
+    for option in PROFILE_PATHS:
+        profile[option] = compile_paths(profiles[name].get(option, []))
+    return profile
+
+
+def drop_paths(jobj, tree: dict) -> None:
+    """ Remove the paths of the tree from a json object, lists are walked
+    through """
+    if type(jobj) is list:
+        for item in jobj:
+            drop_paths(item, tree)
+    elif type(jobj) is dict:
+        for key, subtree in tree.items():
+            if key in jobj:
+                if len(subtree) == 0:
+                    del jobj[key]
+                else:
+                    drop_paths(jobj[key], subtree)
+
+
+def keep_paths(jobj, tree: dict) -> None:
+    """ Remove everything but the paths of the tree from a json object,
+    lists are walked through """
+    if type(jobj) is list:
+        for item in jobj:
+            keep_paths(item, tree)
+    elif type(jobj) is dict:
+        for key in list(jobj.keys()):
+            if key not in tree:
+                del jobj[key]
+            elif len(tree[key]) > 0:
+                keep_paths(jobj[key], tree[key])
+
+
+def project_json(jobj, profile: dict) -> None:
+    """ Apply the keep and drop paths of a profile to a json object """
+    if len(profile["keep"]) > 0:
+        keep_paths(jobj, profile["keep"])
+    if len(profile["drop"]) > 0:
+        drop_paths(jobj, profile["drop"])
+
+
+def is_valid_tweet(tweet) -> bool:
+    if ("data" not in tweet) or ("includes" not in tweet):
+        return False
+    if ("id" not in tweet["data"]) or \
+            ("text" not in tweet["data"]) or \
+            ("author_id" not in tweet["data"]) or \
+            ("created_at" not in tweet["data"]) or \
+            ("users" not in tweet["includes"]):
+        return False
+    return True
+
+
+def normalize_tweet(tweet: dict, profile: dict):
+    """ Canonical json line of a stream payload as saved by the crawler, None
+    if it is not a tweet or nothing is left of it """
+    if not is_valid_tweet(tweet):
+        return None
+    if "matching_rules" in tweet:
+        del tweet["matching_rules"]
+    project_json(tweet, profile)
+    if trim_json(tweet):
+        return None
+    return json.dumps(tweet, separators = (",", ":"), sort_keys = True) + "\n"
+
+
+# Sidecar of an hourly file with the aggregates of its tweets
+SUMMARY_SUFFIX = ".summary"
+SUMMARY_DIMENSIONS = ("lang", "country", "source")
+
+
+def tweet_facts(tweet: dict) -> tuple:
+    """ Language, country code of the place, source and whether it has a
+    location, of a valid tweet before it is projected """
+    data = tweet["data"]
+    country = None
+    geo = data.get("geo")
+    if geo is not None:
+        place_id = geo.get("place_id")
+        for place in tweet.get("includes", {}).get("places", []):
+            if place.get("id") == place_id or country is None:
+                country = place.get("country_code")
+    return data.get("lang"), country, data.get("source"), geo is not None
+
+
+class HourSummary:
+    """ Counts of the tweets of an hour by language, country and source, with
+    and without a location, and the smallest and largest delay between the
+    creation of a tweet and its reception. The counts of each dimension are
+    kept in an array, indexed by the order each value was first seen. Shed
+    tweets were dropped under load, spilled ones were written late. """
+
+    def __init__(self, values: dict = None):
+        self.tweets = 0
+        self.shed = 0
+        self.spilled = 0
+        self.values = {d: {} for d in SUMMARY_DIMENSIONS}
+        self.counts = {d: array("Q") for d in SUMMARY_DIMENSIONS}
+        self.geo = array("Q", [0, 0])  # Without and with a location
+        self.min_lag = None
+        self.max_lag = None
+        if values is not None:
+            self.tweets = values["tweets"]
+            for d in SUMMARY_DIMENSIONS:
+                keys, counts = values[d]
+                self.values[d] = {k: i for i, k in enumerate(keys)}
+                self.counts[d] = array("Q", counts)
+            self.geo = array("Q", values["geo"])
+            self.min_lag, self.max_lag = values["lag"]
+            self.shed = values.get("shed", 0)
+            self.spilled = values.get("spilled", 0)
+
+    def __count(self, dimension: str, value, n: int = 1) -> None:
+        index = self.values[dimension].get(value)
+        if index is None:
+            index = len(self.counts[dimension])
+            self.values[dimension][value] = index
+            self.counts[dimension].append(0)
+        self.counts[dimension][index] += n
+
+    def add(self, facts: tuple, lag: float = None) -> None:
+        """ Count a tweet from its facts, and the seconds between its creation
+        and its reception if known """
+        lang, country, source, has_geo = facts
+        self.tweets += 1
+        self.__count("lang", lang or "")
+        self.__count("country", country or "")
+        self.__count("source", source or "")
+        self.geo[1 if has_geo else 0] += 1
+        if lag is not None:
+            if self.min_lag is None or lag < self.min_lag:
+                self.min_lag = lag
+            if self.max_lag is None or lag > self.max_lag:
+                self.max_lag = lag
+
+    def merge(self, other) -> None:
+        self.tweets += other.tweets
+        self.shed += other.shed
+        self.spilled += other.spilled
+        for d in SUMMARY_DIMENSIONS:
+            for value, index in other.values[d].items():
+                self.__count(d, value, other.counts[d][index])
+        self.geo[0] += other.geo[0]
+        self.geo[1] += other.geo[1]
+        for lag in (other.min_lag, other.max_lag):
+            if lag is None:
+                continue
+            if self.min_lag is None or lag < self.min_lag:
+                self.min_lag = lag
+            if self.max_lag is None or lag > self.max_lag:
+                self.max_lag = lag
+
+    def top(self, dimension: str, n: int) -> list:
+        """ The n most frequent values of a dimension, with their counts """
+        counts = self.counts[dimension]
+        return sorted(((value, counts[i]) for value, i in
+                       self.values[dimension].items()),
+                      key = lambda vc: (-vc[1], vc[0]))[:n]
+
+    def to_dict(self) -> dict:
+        values = {"tweets": self.tweets, "geo": list(self.geo),
+                  "lag": [self.min_lag, self.max_lag], "shed": self.shed,
+                  "spilled": self.spilled}
+        for d in SUMMARY_DIMENSIONS:
+            keys = sorted(self.values[d], key = self.values[d].get)
+            values[d] = [keys, list(self.counts[d])]
+        return values
+
+
+def read_summary(path: str):
+    """ Read the summary sidecar of an hourly file, None if it has none """
+    try:
+        with open(path + SUMMARY_SUFFIX, "r") as inf:
+            return HourSummary(json.load(inf))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def write_summary(path: str, summary: HourSummary) -> None:
+    """ Write the summary sidecar of an hourly file, adding the tweets of the
+    summary already there """
+    saved = read_summary(path)
+    if saved is not None:
+        saved.merge(summary)
+        summary = saved
+    tmp_path = f"{path}{SUMMARY_SUFFIX}.new"
+    with open(tmp_path, "w") as outf:
+        json.dump(summary.to_dict(), outf, separators = (",", ":"))
+    os.replace(tmp_path, path + SUMMARY_SUFFIX)
+
+
+# A json string, possibly followed by ":" when it is a key, or a bracket
+RAW_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"(\s*:)?|[{}\[\]]')
+RAW_MATCHING_RULES = '"matching_rules"'
+RAW_COLON = re.compile(r"\s*:\s*")
+
+
+def scan_raw_tweet(data: str) -> (str, str):
+    """ Find the id and created_at of a raw stream payload without parsing
+    it, by only looking at the strings and brackets of its "data" object.
+    Return None for anything not found. """
+    tweet_id = None
+    created_at = None
+    depth = 0
+    data_key = False
+    in_data = False
+    value_of = None
+    for m in RAW_TOKEN.finditer(data):
+        token = m.group(0)
+        if token[0] == '"':
+            if m.group(1) is not None:
+                key = token[1:token.rindex('"')]
+                if depth == 1:
+                    data_key = (key == "data")
+                elif in_data and depth == 2 and \
+                        (key == "id" or key == "created_at"):
+                    value_of = key
+                    continue
+            elif value_of == "id":
+                tweet_id = token[1:-1]
+            elif value_of == "created_at":
+                created_at = token[1:-1]
+            value_of = None
+            if tweet_id is not None and created_at is not None:
+                break
+            continue
+        value_of = None
+        if token == "{" or token == "[":
+            depth += 1
+            if depth == 2 and data_key and token == "{":
+                in_data = True
+            data_key = False
+        else:
+            depth -= 1
+            if in_data and depth == 1:
+                break  # End of "data"
+    return tweet_id, created_at
+
+
+def scan_raw_geo(data: str) -> bool:
+    """ If the "data" object of a raw stream payload has a "geo" object, as
+    tweet_facts tells for a parsed one """
+    depth = 0
+    data_key = False
+    in_data = False
+    geo_key = False
+    for m in RAW_TOKEN.finditer(data):
+        token = m.group(0)
+        if token[0] == '"':
+            if m.group(1) is not None:
+                key = token[1:token.rindex('"')]
+                if depth == 1:
+                    data_key = (key == "data")
+                geo_key = in_data and depth == 2 and key == "geo"
+            else:
+                geo_key = False
+            continue
+        if token == "{" or token == "[":
+            if geo_key and token == "{":
+                return True
+            depth += 1
+            if depth == 2 and data_key and token == "{":
+                in_data = True
+            data_key = False
+            geo_key = False
+        else:
+            depth -= 1
+            if in_data and depth == 1:
+                return False  # End of "data"
+    return False
+
+
+def scan_raw_tags(data: str) -> list:
+    """ Tags of the matching rules of a raw payload of the filtered stream.
+    Followed by ":", "matching_rules" can only be the top level key, since
+    any quote inside a string is escaped. """
+    idx = len(data)
+    while True:
+        idx = data.rfind(RAW_MATCHING_RULES, 0, idx)
+        if idx < 0:
+            return []
+        m = RAW_COLON.match(data, idx + len(RAW_MATCHING_RULES))
+        if m is not None:
+            break
+    try:
+        rules, _ = json.JSONDecoder().raw_decode(data, m.end())
+    except ValueError:
+        return []
+    if type(rules) is not list:
+        return []
+    return [r.get("tag", "") for r in rules if type(r) is dict]
+
+
+def parse_created_at(created_at: str) -> datetime:
+    return datetime.strptime(created_at, "%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def normalize_raw_file(raw_path: str, out_path: str, profile: dict) -> tuple:
+    """ Normalize a file of raw payloads, one per line, as the crawler does
+    online. Return the statistics of the lines read and written, and the
+    summary of the tweets written. """
+    with open(raw_path, "r") as inf, open(out_path, "a") as outf:
+        return normalize_lines(inf, outf, profile)
+
+
+def normalize_lines(inf, outf, profile: dict) -> tuple:
+    """ Normalize tweets read from a text file into another, as
+    normalize_raw_file does """
+    stats_in = HourStats()
+    stats_out = HourStats()
+    summary = HourSummary()
+    for line in inf:
+        if len(line.rstrip("\n")) == 0:
+            continue
+        try:
+            tweet = json.loads(line)
+            tweet_id = int(tweet["data"]["id"])
+        except (ValueError, TypeError, KeyError):
+            tweet = None
+            tweet_id = None
+        stats_in.add(line.encode("utf-8"), tweet_id)
+        facts = None
+        if tweet is not None and is_valid_tweet(tweet):
+            facts = tweet_facts(tweet)
+        data = normalize_tweet(tweet, profile) if tweet is not None \
+            else None
+        if data is not None:
+            outf.write(data)
+            stats_out.add(data.encode("utf-8"), tweet_id)
+            summary.add(facts)  # The delay is only known online
+    return stats_in, stats_out, summary
@@ -0,0 +1,195 @@
+""" Destinations of the tweets saved by the crawler, besides its hourly
+files. Importing this module has no side effects. """
+
+import os
+import selectors
+import socket
+from collections import deque
+from datetime import datetime
+from threading import Lock, Thread
+from typing import Callable
+
+
+class TweetSink:
+    """ Destination of the saved tweets, each one a canonical json line """
+
+    def write(self, timestamp: datetime, prefix: str, data: str,
+              tweet_id: str = None, summary: tuple = None) -> bool:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class FanoutSink(TweetSink):
+    """ Broadcast tweets to the consumers connected to a Unix domain socket
+    ("unix:PATH") or a TCP socket ("tcp:HOST:PORT"). A consumer may send one
+    line of comma-separated prefixes to receive only these streams.
+
+    Every consumer has a buffer of at most max_lines lines. A consumer whose
+    buffer is full is disconnected, so a slow consumer never blocks the
+    crawler. """
+
+    def __init__(self, address: str, max_lines: int, log_func: Callable):
+        self.__logFunc = log_func
+        self.__max_lines = max_lines
+        self.__lock = Lock()
+        self.__subscribers = {}
+        self.__dropped = 0
+        self.__closed = False
+        if address.startswith("unix:"):
+            self.__path = address[5:]
+            if os.path.exists(self.__path):
+                os.remove(self.__path)
+            self.__server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.__server.bind(self.__path)
+        elif address.startswith("tcp:"):
+            self.__path = None
+            host, port = address[4:].rsplit(":", 1)
+            self.__server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.__server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.__server.bind((host, int(port)))
+        else:
+            raise ValueError(f"Incorrect fan-out address: {address}")
+        self.__server.listen(16)
+        self.__server.setblocking(False)
+        self.__wake_r, self.__wake_w = socket.socketpair()
+        self.__wake_r.setblocking(False)
+        self.__wake_w.setblocking(False)
+        self.__selector = selectors.DefaultSelector()
+        self.__selector.register(self.__server, selectors.EVENT_READ)
+        self.__selector.register(self.__wake_r, selectors.EVENT_READ)
+        self.__thread = Thread(target = self.__serve, daemon = True)
+        self.__thread.start()
+        self.__logFunc(f"Fan-out listening on {address}", False)
+
+    @property
+    def address(self):
+        return self.__server.getsockname()
+
+    @property
+    def dropped(self) -> int:
+        return self.__dropped
+
+    def write(self, timestamp: datetime, prefix: str, data: str,
+              tweet_id: str = None, summary: tuple = None) -> bool:
+        line = None
+        with self.__lock:
+            for conn, sub in self.__subscribers.items():
+                if sub["prefixes"] is not None and \
+                        prefix not in sub["prefixes"]:
+                    continue
+                if line is None:
+                    line = data.encode("utf-8")
+                if len(sub["queue"]) >= self.__max_lines:
+                    sub["dropped"] = True
+                else:
+                    sub["queue"].append(line)
+        if line is not None:
+            try:
+                self.__wake_w.send(b"\0")
+            except (BlockingIOError, OSError):
+                pass  # Already woken up
+        return True
+
+    def close(self) -> None:
+        self.__closed = True
+        try:
+            self.__wake_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+        self.__thread.join(5)
+
+    def __drop(self, conn: socket.socket, reason: str) -> None:
+        with self.__lock:
+            sub = self.__subscribers.pop(conn, None)
+        self.__selector.unregister(conn)
+        conn.close()
+        if sub is not None and reason is not None:
+            self.__dropped += 1
+            self.__logFunc(f"Fan-out dropped {sub['name']}: {reason}", True)
+
+    def __flush(self, conn: socket.socket, sub: dict) -> None:
+        """ Send as much of the buffer as the consumer can take """
+        while True:
+            if len(sub["pending"]) == 0:
+                with self.__lock:
+                    chunk = []
+                    size = 0
+                    while len(sub["queue"]) > 0 and size < 65536:
+                        line = sub["queue"].popleft()
+                        chunk.append(line)
+                        size += len(line)
+                if len(chunk) == 0:
+                    break
+                sub["pending"] = b"".join(chunk)
+            try:
+                sent = conn.send(sub["pending"])
+            except BlockingIOError:
+                break
+            sub["pending"] = sub["pending"][sent:]
+        events = selectors.EVENT_READ
+        if len(sub["pending"]) > 0:
+            events |= selectors.EVENT_WRITE
+        self.__selector.modify(conn, events)
+
+    def __serve(self) -> None:
+        while not self.__closed:
+            for key, _ in self.__selector.select(1):
+                if key.fileobj is self.__server:
+                    try:
+                        conn, addr = self.__server.accept()
+                    except BlockingIOError:
+                        continue
+                    conn.setblocking(False)
+                    name = str(addr) if addr else f"consumer {conn.fileno()}"
+                    with self.__lock:
+                        self.__subscribers[conn] = {
+                            "name": name, "prefixes": None, "request": b"",
+                            "queue": deque(), "pending": b"",
+                            "dropped": False}
+                    self.__selector.register(conn, selectors.EVENT_READ)
+                    self.__logFunc(f"Fan-out connected {name}", False)
+                elif key.fileobj is self.__wake_r:
+                    try:
+                        while self.__wake_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif key.fileobj in self.__subscribers:
+                    conn = key.fileobj
+                    try:
+                        data = conn.recv(4096)
+                    except BlockingIOError:
+                        continue
+                    except OSError:
+                        data = b""
+                    if len(data) == 0:
+                        self.__drop(conn, None)
+                        continue
+                    sub = self.__subscribers[conn]
+                    if sub["prefixes"] is None and len(sub["request"]) < 4096:
+                        sub["request"] += data
+                        if b"\n" in sub["request"]:
+                            line = sub["request"].split(b"\n", 1)[0]
+                            prefixes = set(p.strip() for p in line.decode(
+                                "utf-8", "replace").split(",") if p.strip())
+                            with self.__lock:
+                                sub["prefixes"] = prefixes
+            for conn, sub in list(self.__subscribers.items()):
+                if sub["dropped"]:
+                    self.__drop(conn, f"more than {self.__max_lines} lines "
+                                      f"behind")
+                    continue
+                try:
+                    self.__flush(conn, sub)
+                except OSError:
+                    self.__drop(conn, None)
+        for conn in list(self.__subscribers.keys()):
+            self.__drop(conn, None)
+        self.__selector.close()
+        self.__server.close()
+        self.__wake_r.close()
+        self.__wake_w.close()
+        if self.__path is not None and os.path.exists(self.__path):
+            os.remove(self.__path)
@@ -1,31 +1,46 @@
 #!/usr/bin/env python3
 
-import glob
+import ctypes
+import ctypes.util
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
+import multiprocessing
 import os
 import pathlib
 import pickle
+import re
+import select
+import shutil
 import smtplib
+import sqlite3
+import statistics
+import struct
 import sys
+import tempfile
+import time
+import traceback
 import zipfile
 from datetime import datetime, timedelta, timezone
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from threading import Lock, Thread
 
-from apiclient.http import MediaFileUpload
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-
-if len(sys.argv) != 2:
-    print(f"Usage: {os.path.basename(__file__)} SETTINGS_FILE")
-    sys.exit(0)
-
-__setting_path = os.path.abspath(sys.argv[1])
-if not os.path.isfile(__setting_path):
-    print(f"Cannot find {__setting_path}", file = sys.stderr)
-    sys.exit(-1)
+from ArchiveCodec import CODECS, dictionary_name, open_member_writer, \
+    require_zstd, sample_lines, train_dictionary
+from DriveClient import DriveClient
+from RecentSearch import SEARCH_DAYS, InvalidQuery, RateLimited, \
+    SearchClient, page_payloads
+from SegmentWriter import HourStats, read_integrity, remove_integrity, \
+    trim_padding, write_integrity
+from Settings import Setting, SettingsError, parse_bool, parse_dir, \
+    parse_file, parse_list, parse_path, read_settings
+from TweetNormalizer import SUMMARY_DIMENSIONS, SUMMARY_SUFFIX, HourSummary, \
+    get_profile, normalize_raw_file, normalize_tweet, read_profiles, \
+    read_streams, read_summary, tweet_facts, write_summary
 
 KEY_WORKING_DIR = "working_dir"
 KEY_LOG_File = "log_file"
@@ -33,8 +48,22 @@ KEY_GOOGLE_DRIVE_CLIENT_SECRETS_JSON = "google_drive_client_secrets_json"
 # KEY_GOOGLE_DRIVE_SETTINGS_YAML = "google_drive_settings_yaml"
 KEY_GOOGLE_DRIVE_TOKEN_PICKLE = "google_drive_token_pickle"
 KEY_GOOGLE_DRIVE_FOLDER_ID = "google_drive_folder_id"
+KEY_GOOGLE_DRIVE_API_ROOT = "google_drive_api_root"
 KEY_KEEP_FILES_FOR_DAYS = "keep_files_for_days"
+KEY_REMOTE_KEEP_DAYS = "remote_keep_days"
 KEY_DEDUPLICATE = "deduplicate"
+KEY_MANIFEST_PATH = "manifest_path"
+KEY_DAEMON_INTERVAL = "daemon_interval"
+KEY_CRAWLER_SETTINGS = "crawler_settings"
+KEY_NORMALIZE_PROCESSES = "normalize_processes"
+KEY_SECONDARY_DIR = "secondary_dir"
+KEY_SOURCE_DIRS = "source_dirs"
+KEY_BACKFILL_BELOW = "backfill_below"
+KEY_TWITTER_API_ROOT = "twitter_api_root"
+KEY_ARCHIVE_CODEC = "archive_codec"
+KEY_COMPRESS_BELOW_GB = "compress_below_gb"
+KEY_MOVE_BELOW_GB = "move_below_gb"
+KEY_ALERT_BELOW_GB = "alert_below_gb"
 KEY_EMAIL_ADDRESS = "email_address"
 KEY_EMAIL_NAME = "email_name"
 KEY_EMAIL_PASSWORD = "email_password"
@@ -42,31 +71,73 @@ KEY_EMAIL_SMTP = "email_smtp"
 KEY_EMAIL_PORT = "email_port"
 KEY_EMAIL_SSL = "email_ssl"
 KEY_EMAIL_RECIPIENTS = "email_recipients"
+# Of the crawler settings
+KEY_TWITTER_BEAR_TOKEN = "twitter_bear_token"
 
 
-def read_setting(line: str):
-    if not line or line.startswith("#"):
-        return None, None
-    try:
-        idx = line.index("=")
-        if idx > -1:
-            key = line[:idx].strip()
-            val = line[idx + 1:].strip()
-            return key, val
-        else:
-            return None, None
-    except ValueError:
-        return None, None
-
+# Invalid values stop the uploader
+UPLOADER_SETTINGS = [
+    Setting(KEY_WORKING_DIR, parse_dir),
+    Setting(KEY_LOG_File, parse_path),
+    Setting(KEY_GOOGLE_DRIVE_CLIENT_SECRETS_JSON, parse_file),
+    Setting(KEY_GOOGLE_DRIVE_TOKEN_PICKLE, parse_path),
+    Setting(KEY_GOOGLE_DRIVE_FOLDER_ID),
+    Setting(KEY_GOOGLE_DRIVE_API_ROOT),
+    Setting(KEY_KEEP_FILES_FOR_DAYS, int, minimum = 0),
+    Setting(KEY_REMOTE_KEEP_DAYS, int, 0, minimum = 0),
+    Setting(KEY_DEDUPLICATE, parse_bool, False),
+    Setting(KEY_MANIFEST_PATH, parse_path),
+    Setting(KEY_DAEMON_INTERVAL, int, 60, minimum = 1),
+    Setting(KEY_CRAWLER_SETTINGS, parse_path),
+    Setting(KEY_NORMALIZE_PROCESSES, int, os.cpu_count() or 1, minimum = 1),
+    Setting(KEY_SECONDARY_DIR, parse_dir),
+    Setting(KEY_SOURCE_DIRS, parse_list(",", parse_dir), []),
+    Setting(KEY_BACKFILL_BELOW, float, 0.0, minimum = 0, maximum = 1),
+    Setting(KEY_TWITTER_API_ROOT),
+    Setting(KEY_ARCHIVE_CODEC, str.lower, "zip", choices = CODECS),
+    Setting(KEY_COMPRESS_BELOW_GB, float, 0.0, minimum = 0),
+    Setting(KEY_MOVE_BELOW_GB, float, 0.0, minimum = 0),
+    Setting(KEY_ALERT_BELOW_GB, float, 0.0, minimum = 0),
+    Setting(KEY_EMAIL_ADDRESS),
+    Setting(KEY_EMAIL_NAME),
+    Setting(KEY_EMAIL_PASSWORD),
+    Setting(KEY_EMAIL_SMTP),
+    Setting(KEY_EMAIL_PORT, int, -1, minimum = 1),
+    Setting(KEY_EMAIL_SSL, parse_bool, True),
+    Setting(KEY_EMAIL_RECIPIENTS, parse_list(";")),
+]
 
+# Values read by setup()
+__setting_path = None
+__daemon = False
 __working_dir = None
 __log_path = None
 __log_file = sys.stdout
+# Held while the log is written or rotated, the space manager logs from a
+# thread of its own
+__log_lock = Lock()
 __gdrive_client_secret = None
 __gdrive_settings = None
 __gdrive_folder_id = None
+__gdrive_api_root = None
 __keep_days = None
+__remote_keep_days = 0
 __dedup = False
+__manifest_path = None
+__daemon_interval = 60
+__crawler_settings = None
+__normalize_processes = os.cpu_count() or 1
+__secondary_dir = None
+__source_dirs = []
+__backfill_below = 0.0
+__twitter_api_root = None
+# Recent search client and queries of each prefix, when backfill is enabled
+__search = None
+__backfill_queries = {}
+__archive_codec = "zip"
+# Free space thresholds of working_dir, 0 to disable
+__space_thresholds = {KEY_COMPRESS_BELOW_GB: 0.0, KEY_MOVE_BELOW_GB: 0.0,
+                      KEY_ALERT_BELOW_GB: 0.0}
 __email_address = None
 __email_name = None
 __email_password = None
@@ -74,115 +145,50 @@ __email_smtp = None
 __email_port = -1
 __email_ssl = True
 __email_recipients = None
+__profile = None
 
-try:
-    with open(__setting_path, "r") as inf:
-        for line in inf:
-            key, val = read_setting(line.replace("\r", "").replace("\n", ""))
-            if key == KEY_WORKING_DIR:
-                __working_dir = os.path.abspath(val)
-            elif key == KEY_LOG_File:
-                if len(val) > 0:
-                    __log_path = os.path.abspath(val)
-            elif key == KEY_GOOGLE_DRIVE_CLIENT_SECRETS_JSON:
-                __gdrive_client_secret = os.path.abspath(val)
-                if not os.path.isfile(__gdrive_client_secret):
-                    print(
-                        f"Invalid setting ("
-                        f"{KEY_GOOGLE_DRIVE_CLIENT_SECRETS_JSON}): Cannot "
-                        f"find {__gdrive_client_secret}",
-                        file = sys.stderr)
-                    sys.exit(-1)
-            # elif key == KEY_GOOGLE_DRIVE_SETTINGS_YAML:
-            #     __gdrive_settings = os.path.abspath(val)
-            elif key == KEY_GOOGLE_DRIVE_TOKEN_PICKLE:
-                __gdrive_settings = os.path.abspath(val)
-            elif key == KEY_GOOGLE_DRIVE_FOLDER_ID:
-                if len(val) > 0:
-                    __gdrive_folder_id = val
-            elif key == KEY_KEEP_FILES_FOR_DAYS:
-                try:
-                    __keep_days = int(val)
-                except ValueError as e:
-                    print(f"Invalid setting ({KEY_KEEP_FILES_FOR_DAYS}): {e}",
-                          file = sys.stderr)
-                    sys.exit(-1)
-                if __keep_days < 0:
-                    print(
-                        f"Invalid setting ({KEY_KEEP_FILES_FOR_DAYS}): Must "
-                        f"be at least 0",
-                        file = sys.stderr)
-                    sys.exit(-1)
-            elif key == KEY_DEDUPLICATE:
-                __dedup = (val.lower() != "false")
-            elif key == KEY_EMAIL_ADDRESS:
-                __email_address = val
-            elif key == KEY_EMAIL_NAME:
-                __email_name = val
-            elif key == KEY_EMAIL_PASSWORD:
-                __email_password = val
-            elif key == KEY_EMAIL_SMTP:
-                __email_smtp = val
-            elif key == KEY_EMAIL_PORT:
-                try:
-                    __email_port = int(val)
-                except ValueError:
-                    print(f"Incorrect SMTP port: {val}",
-                          file = sys.stderr)
-                if __email_port < 1:
-                    print(f"Incorrect SMTP port: {val}",
-                          file = sys.stderr)
-                    __email_port = -1
-            elif key == KEY_EMAIL_SSL:
-                __email_ssl = (val.lower() != "false")
-            elif key == KEY_EMAIL_RECIPIENTS:
-                __email_recipients = [v.strip() for v in val.split(";")]
-            else:
-                continue
-    inf.close()
-except BaseException as e:
-    print(f"Cannot read {__setting_path}: {e}", file = sys.stderr)
-    sys.exit(-1)
-
-if __working_dir is None or len(__working_dir) == 0:
-    print(f"{KEY_WORKING_DIR} is not set", file = sys.stderr)
-    sys.exit(-1)
-
-if not os.path.isdir(__working_dir):
-    print(f"Cannot find {__working_dir}", file = sys.stderr)
-    sys.exit(-1)
-
-if __gdrive_client_secret is None or len(__gdrive_client_secret) == 0:
-    print(f"{KEY_GOOGLE_DRIVE_CLIENT_SECRETS_JSON} is not set",
-          file = sys.stderr)
-    sys.exit(-1)
-
-if __gdrive_settings is None or len(__gdrive_settings) == 0:
-    print(f"{KEY_GOOGLE_DRIVE_TOKEN_PICKLE} is not set",
-          file = sys.stderr)
-    sys.exit(-1)
-
-dt_today = datetime.today()
 weekly_digest_file = ""
-if len(__log_path) > 0:
-    if dt_today.isoweekday() == 7 and os.path.isfile(__log_path):
-        dt_start = dt_today - timedelta(days = 7)
-        str_start = dt_start.strftime("%Y%m%d")
-        str_today = dt_today.strftime("%Y%m%d")
-        log_name = os.path.basename(__log_path)
-        if "." in log_name:
-            log_ext = pathlib.Path(log_name).suffix
-            log_base = log_name[0:-len(log_ext)]
-            bak_name = f"{log_base}.{str_start}-{str_today}{log_ext}"
-        else:
-            bak_name = f"{log_name}.{str_start}-{str_today}"
-        bak_path = os.path.join(os.path.dirname(__log_path), bak_name)
-        if os.path.isfile(bak_path):
-            os.remove(__log_path)
-        else:
-            os.rename(__log_path, bak_path)
-        weekly_digest_file = bak_path
-    __log_file = open(__log_path, "a")
+__log_rotated_on = None
+
+
+def open_log() -> None:
+    """ Open the log file, unless it is open """
+    global __log_file
+    if __log_path is not None and (__log_file is sys.stdout or
+                                   __log_file.closed):
+        __log_file = open(__log_path, "a")
+
+
+def rotate_log() -> None:
+    """ Rotate the log file every Sunday, the rotated log is sent as the
+    weekly digest """
+    global __log_rotated_on, weekly_digest_file
+    if __log_path is None:
+        return
+    with __log_lock:
+        dt_today = datetime.today()
+        if dt_today.isoweekday() == 7 and __log_rotated_on != dt_today.date() \
+                and os.path.isfile(__log_path):
+            if __log_file is not sys.stdout:
+                __log_file.close()
+            dt_start = dt_today - timedelta(days = 7)
+            str_start = dt_start.strftime("%Y%m%d")
+            str_today = dt_today.strftime("%Y%m%d")
+            log_name = os.path.basename(__log_path)
+            if "." in log_name:
+                log_ext = pathlib.Path(log_name).suffix
+                log_base = log_name[0:-len(log_ext)]
+                bak_name = f"{log_base}.{str_start}-{str_today}{log_ext}"
+            else:
+                bak_name = f"{log_name}.{str_start}-{str_today}"
+            bak_path = os.path.join(os.path.dirname(__log_path), bak_name)
+            if os.path.isfile(bak_path):
+                os.remove(__log_path)
+            else:
+                os.rename(__log_path, bak_path)
+            weekly_digest_file = bak_path
+            __log_rotated_on = dt_today.date()
+        open_log()
 
 
 def now_to_str():
@@ -190,56 +196,221 @@ def now_to_str():
 
 
 def cout(msg: str):
-    if len(__log_path) > 0:
-        print(f"{now_to_str()} {msg}", file = __log_file)
-        __log_file.flush()
+    if __log_path is not None:
+        with __log_lock:
+            print(f"{now_to_str()} {msg}", file = __log_file)
+            __log_file.flush()
     print(msg, file = sys.stdout)
 
 
 def cerr(msg: str):
-    if len(__log_path) > 0:
-        print(f"{now_to_str()} {msg}", file = __log_file)
-        __log_file.flush()
+    if __log_path is not None:
+        with __log_lock:
+            print(f"{now_to_str()} {msg}", file = __log_file)
+            __log_file.flush()
     print(msg, file = sys.stderr)
 
 
-if __gdrive_folder_id is None or len(__gdrive_folder_id) == 0:
-    cout("Files will be uploaded to Google Drive's root")
+# PREFIX-YYYYMMDD-HH, PREFIX-YYYYMMDD-HH.raw (raw ingest mode), their .tmp
+# files, PREFIX-YYYYMMDD.zip, where PREFIX is "tweets" or the prefix of another
+# stream of the crawler, and the legacy flag files
+# tweets-YYYYMMDD.zip.{ready,uploading,uploaded}
+HOURLY_PATTERN = re.compile(
+    r"^([A-Za-z0-9_]+)-(20\d\d[01]\d[0-3]\d)-([0-2]\d)$")
+RAW_PATTERN = re.compile(r"^[A-Za-z0-9_]+-20\d\d[01]\d[0-3]\d-[0-2]\d\.raw$")
+TMP_PATTERN = re.compile(
+    r"^[A-Za-z0-9_]+-20\d\d[01]\d[0-3]\d-[0-2]\d(\.raw)?\.tmp$")
+ZIP_PATTERN = re.compile(r"^([A-Za-z0-9_]+)-(20\d\d[01]\d[0-3]\d)\.zip$")
+HOURLY_GZ_PATTERN = re.compile(
+    r"^([A-Za-z0-9_]+)-(20\d\d[01]\d[0-3]\d)-([0-2]\d)\.gz$")
+SUMMARY_PATTERN = re.compile(
+    r"^([A-Za-z0-9_]+)-(20\d\d[01]\d[0-3]\d)-([0-2]\d)\.summary$")
+# Days of summaries kept for the weekly digest
+SUMMARY_KEEP_DAYS = 14
+FLAG_PATTERN = re.compile(
+    r"^(tweets-20\d\d[01]\d[0-3]\d\.zip)\.(ready|uploading|uploaded)$")
+
+# Hourly files are "finished" until they are zipped, then "archived"; zips
+# go through "ready", "uploading", "uploaded" and "cleaned". The other tables
+# cache the Google Drive folder, and record merges, backfill jobs, zstd
+# dictionaries and the actions taken when the disk fills up.
+MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hourly (
+    name TEXT PRIMARY KEY,
+    prefix TEXT NOT NULL DEFAULT 'tweets',
+    day TEXT NOT NULL,
+    hour INTEGER NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    lines INTEGER,
+    checksum TEXT,
+    verified INTEGER,
+    stored TEXT,
+    state TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hourly_prefix_day_state
+    ON hourly (prefix, day, state);
+CREATE TABLE IF NOT EXISTS archives (
+    name TEXT PRIMARY KEY,
+    prefix TEXT NOT NULL DEFAULT 'tweets',
+    day TEXT NOT NULL,
+    size INTEGER,
+    lines INTEGER,
+    checksum TEXT,
+    remote_id TEXT,
+    location TEXT,
+    codec TEXT,
+    dictionary INTEGER,
+    state TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS remote_files (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    size INTEGER,
+    md5 TEXT,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS remote_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS merge_gaps (
+    name TEXT NOT NULL,
+    host TEXT NOT NULL,
+    first_id INTEGER NOT NULL,
+    last_id INTEGER NOT NULL,
+    tweets INTEGER NOT NULL,
+    supplied_by TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS merged_sources (
+    path TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    host TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    state TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS backfill (
+    name TEXT NOT NULL,
+    query TEXT NOT NULL,
+    lines INTEGER NOT NULL,
+    usual INTEGER NOT NULL,
+    next_token TEXT,
+    requests INTEGER NOT NULL DEFAULT 0,
+    found INTEGER NOT NULL DEFAULT 0,
+    complete INTEGER,
+    state TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (name, query)
+);
+CREATE TABLE IF NOT EXISTS dictionaries (
+    id INTEGER PRIMARY KEY,
+    prefix TEXT NOT NULL,
+    hours INTEGER NOT NULL,
+    samples INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS storage_actions (
+    time REAL NOT NULL,
+    action TEXT NOT NULL,
+    name TEXT,
+    detail TEXT
+);
+"""
 
-# Email
-if __email_address is None or len(__email_address) == 0 \
-        or __email_smtp is None or len(__email_smtp) == 0 \
-        or __email_port < 1 \
-        or __email_recipients is None or len(__email_recipients) == 0:
-    __email_address = None
-    __email_name = None
-    __email_password = None
-    __email_smtp = None
-    __email_port = -1
-    __email_recipients = None
 
-# Google Drive authentication
+__manifest = None
+# Google Drive, authorized and built on first use
 SCOPES = ["https://www.googleapis.com/auth/drive"]
-__creds = None
-if os.path.exists(__gdrive_settings):
-    with open(__gdrive_settings, "rb") as token:
-        __creds = pickle.load(token)
-if not __creds or not __creds.valid:
-    if __creds and __creds.expired and __creds.refresh_token:
-        __creds.refresh(Request())
-    else:
-        flow = InstalledAppFlow.from_client_secrets_file(__gdrive_client_secret,
-                                                         SCOPES)
-        __creds = flow.run_console()
-    # Save the credentials for the next run
-    with open(__gdrive_settings, "wb") as token:
-        pickle.dump(__creds, token)
+__drive = None
+__gdrive_dir_name = None
+
 
-__service = None
-try:
-    __service = build("drive", "v3", credentials = __creds)
-except BaseException as be:
-    cerr(f"Failed to initialize Google Drive: {be}")
+def get_drive() -> DriveClient:
+    """ The client of the Google Drive service, authorized and built on first
+    use. The Google client libraries are only imported then, the runs of
+    the cron job that find nothing to upload, check or trash never need
+    them. """
+    global __drive
+    if __drive is not None:
+        return __drive
+    import httplib2
+    from google.auth.transport.requests import Request
+    from google_auth_httplib2 import AuthorizedHttp
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from googleapiclient.discovery import build
+
+    creds = None
+    if os.path.exists(__gdrive_settings):
+        with open(__gdrive_settings, "rb") as token:
+            creds = pickle.load(token)
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            creds.refresh(Request())
+        else:
+            flow = InstalledAppFlow.from_client_secrets_file(
+                __gdrive_client_secret, SCOPES)
+            creds = flow.run_console()
+        # Save the credentials for the next run
+        with open(__gdrive_settings, "wb") as token:
+            pickle.dump(creds, token)
+
+    # One authorized HTTP client, its connections are kept alive and reused
+    # by every request of the process
+    # Another API root, e.g. a local stand-in of Google Drive for tests
+    options = None if __gdrive_api_root is None else {
+        "api_endpoint": __gdrive_api_root}
+    service = build("drive", "v3",
+                    http = AuthorizedHttp(creds,
+                                          http = httplib2.Http(timeout = 300)),
+                    client_options = options)
+    __drive = DriveClient(service, __gdrive_api_root)
+    return __drive
+
+
+def get_folder_name() -> str:
+    """ Name of the Google Drive folder, for the log """
+    global __gdrive_dir_name
+    if __gdrive_dir_name is None:
+        try:
+            df = get_drive().execute(get_drive().service.files().get(
+                fileId = __gdrive_folder_id, fields = "name"))
+            __gdrive_dir_name = df["name"]
+            cout(f"Name of {__gdrive_folder_id} is \"{__gdrive_dir_name}\"")
+        except BaseException as be:
+            cerr(f"Failed to get name of {__gdrive_folder_id}: {be}")
+            return __gdrive_folder_id
+    return __gdrive_dir_name
+
+
+def execute_with_folder(requests: list) -> list:
+    """ Execute metadata requests in a batch, with the request of the name
+    of the Google Drive folder while it is not known. Return their
+    responses, raise the first exception of one. """
+    global __gdrive_dir_name
+    drive = get_drive()
+    with_name = __gdrive_dir_name is None and bool(__gdrive_folder_id)
+    if with_name:
+        requests = requests + [drive.service.files().get(
+            fileId = __gdrive_folder_id, fields = "name")]
+    results = drive.execute_batch(requests)
+    if with_name:
+        # Asked again before uploading if it failed
+        df, exception = results.pop()
+        if exception is None:
+            __gdrive_dir_name = df["name"]
+            cout(f"Name of {__gdrive_folder_id} is \"{__gdrive_dir_name}\"")
+    for response, exception in results:
+        if exception is not None:
+            raise exception
+    return [response for response, _ in results]
 
 
 def send_email(subject: str, msg: str, attachments = None):
@@ -282,90 +453,605 @@ def send_email(subject: str, msg: str, attachments = None):
         cerr(f"Failed to send email: {e}")
 
 
-try:
-    df = __service.files().get(fileId = __gdrive_folder_id).execute()
-    gdrive_dir_name = df["name"]
-    cout(f"Name of {__gdrive_folder_id} is \"{gdrive_dir_name}\"")
-except BaseException as be:
-    cerr(f"Failed to get name of {__gdrive_folder_id}: {be}")
-    send_email(f"[TweetCrawler]: Failed to get name of {__gdrive_folder_id}",
-               str(be))
-    sys.exit(-1)
-
 current = datetime.now(tz = timezone.utc)  # Current UTC date
-if __keep_days is None or __keep_days == 0:
-    cout("All zip files will be kept")
-else:
-    last_date = (current - timedelta(days = __keep_days)).strftime("%Y-%m-%d")
-    cout(f"Zip files older than {last_date} "
-         f"(excluding {last_date}) will be removed")
+
+
+def get_archive_state(name: str):
+    """ Return the manifest state of a zip file, None if unknown """
+    row = __manifest.execute("SELECT state FROM archives WHERE name = ?",
+                             (name,)).fetchone()
+    return None if row is None else row[0]
+
+
+def set_archive_state(name: str, state: str, expected: str) -> bool:
+    """ Move a zip file from the expected state to a new state atomically """
+    with __manifest:
+        cur = __manifest.execute(
+            "UPDATE archives SET state = ?, updated = ? "
+            "WHERE name = ? AND state = ?",
+            (state, time.time(), name, expected))
+    return cur.rowcount == 1
+
+
+def import_flag_files(save_path: str, flags: list) -> None:
+    """ One-time import of the legacy .ready, .uploading and .uploaded flag
+    files into the manifest. Flags are removed once the manifest has
+    committed them. """
+    # A zip may carry more than one flag after a crash, keep the furthest
+    rank = {"ready": 0, "uploading": 1, "uploaded": 2}
+    states = {}
+    for zn, flag in flags:
+        if zn not in states or rank[flag] > rank[states[zn]]:
+            states[zn] = flag
+    now = time.time()
+    with __manifest:
+        for zn, state in states.items():
+            zp = os.path.join(save_path, zn)
+            if not os.path.isfile(zp):
+                continue
+            __manifest.execute(
+                "INSERT OR IGNORE INTO archives (name, prefix, day, size, "
+                "lines, checksum, state, created, updated) "
+                "VALUES (?, ?, ?, ?, NULL, NULL, ?, ?, ?)",
+                (zn, *ZIP_PATTERN.match(zn).groups(), os.path.getsize(zp),
+                 state, now, now))
+    for zn, flag in flags:
+        os.remove(os.path.join(save_path, f"{zn}.{flag}"))
+        cout(f"Imported {zn}.{flag}")
+
+
+def hourly_path(save_path: str, name: str, stored: str = None) -> str:
+    """ Path of an hourly file, as it is stored """
+    return os.path.join(save_path, f"{name}.gz" if stored == "gzip" else name)
+
+
+def open_hourly(path: str, mode: str):
+    """ Open an hourly file, compressed or not """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def archive_path(save_path: str, zn: str) -> str:
+    """ Path of a zip file, in working_dir or where it was moved """
+    row = __manifest.execute("SELECT location FROM archives WHERE name = ?",
+                             (zn,)).fetchone()
+    if row is None or row[0] is None:
+        return os.path.join(save_path, zn)
+    return os.path.join(row[0], zn)
+
+
+def file_digest(path: str, skip: int = 0) -> (int, str):
+    """ Size and MD5 of the content of an hourly file, compressed or not,
+    after the first skip bytes """
+    md5 = hashlib.md5()
+    size = 0
+    with open_hourly(path, "rb") as inf:
+        inf.seek(skip)
+        while True:
+            chunk = inf.read(1048576)
+            if not chunk:
+                break
+            md5.update(chunk)
+            size += len(chunk)
+    return size, md5.hexdigest()
+
+
+def gzip_ends_with(gz_path: str, path: str) -> bool:
+    """ If the content of a file is the end of the content of a gzip """
+    size = os.path.getsize(path)
+    with gzip.open(gz_path, "rb") as inf:
+        total = inf.seek(0, os.SEEK_END)
+    return total >= size and \
+        file_digest(gz_path, total - size) == file_digest(path)
+
+
+def append_to_gzip(path: str) -> None:
+    """ Append an hourly file to the gzip of its hour, as a member of its
+    own, and remove it """
+    part_path = f"{path}.gz.part"
+    shutil.copyfile(f"{path}.gz", part_path)
+    with open(path, "rb") as inf, gzip.open(part_path, "ab",
+                                            compresslevel = 6) as outf:
+        shutil.copyfileobj(inf, outf, 1048576)
+    os.rename(part_path, f"{path}.gz")
+    os.remove(path)
+
+
+def is_archived_copy(path: str, name: str) -> bool:
+    """ If an hourly file has the content its zip member was made from """
+    row = __manifest.execute("SELECT size, checksum FROM hourly "
+                             "WHERE name = ?", (name,)).fetchone()
+    return row is not None and file_digest(path) == tuple(row)
+
+
+def reconcile(save_path: str) -> (list, list, list):
+    """ Bring the manifest in line with the directory with a single scan.
+    Return the names of the tmp files, raw files and summaries found. """
+    tmp_names = []
+    raw_names = []
+    summary_names = []
+    hourly = {}
+    hourly_gz = {}
+    zips = set()
+    flags = []
+    with os.scandir(save_path) as it:
+        for entry in it:
+            name = entry.name
+            if TMP_PATTERN.match(name):
+                tmp_names.append(name)
+            elif HOURLY_PATTERN.match(name):
+                st = entry.stat()
+                hourly[name] = (st.st_size, st.st_mtime, None)
+            elif HOURLY_GZ_PATTERN.match(name):
+                st = entry.stat()
+                hourly_gz[name[:-3]] = (st.st_size, st.st_mtime, "gzip")
+            elif name.endswith(".gz.part"):
+                # Left by an interrupted compression
+                os.remove(entry.path)
+            elif ZIP_PATTERN.match(name):
+                zips.add(name)
+            elif RAW_PATTERN.match(name):
+                raw_names.append(name)
+            elif SUMMARY_PATTERN.match(name):
+                summary_names.append(name)
+            else:
+                m = FLAG_PATTERN.match(name)
+                if m is not None:
+                    flags.append((m.group(1), m.group(2)))
+    if len(flags) > 0:
+        import_flag_files(save_path, flags)
+
+    known = {}
+    for name, size, mtime, stored in __manifest.execute(
+            "SELECT name, size, mtime, stored FROM hourly "
+            "WHERE state = 'finished'"):
+        known[name] = (size, mtime, stored)
+    for name in set(hourly.keys()) & set(hourly_gz.keys()):
+        path = os.path.join(save_path, name)
+        if name not in known or known[name][2] != "gzip":
+            # The compression was interrupted before the manifest knew it,
+            # the file has all the tweets of the gzip
+            os.remove(f"{path}.gz")
+            del hourly_gz[name]
+            continue
+        if gzip_ends_with(f"{path}.gz", path):
+            # The compression, or the append, was interrupted before the
+            # removal of the file
+            os.remove(path)
+        else:
+            # Finished by the crawler after the hour was compressed
+            append_to_gzip(path)
+            cout(f"Appended {name} to {name}.gz")
+        del hourly[name]
+        st = os.stat(f"{path}.gz")
+        hourly_gz[name] = (st.st_size, st.st_mtime, "gzip")
+    hourly.update(hourly_gz)
+
+    leftovers = []
+    now = time.time()
+    with __manifest:
+        for name, (size, mtime, stored) in hourly.items():
+            if name in known:
+                if known[name] != (size, mtime, stored):
+                    __manifest.execute(
+                        "UPDATE hourly SET size = ?, mtime = ?, stored = ?, "
+                        "updated = ? WHERE name = ?",
+                        (size, mtime, stored, now, name))
+                continue
+            m = HOURLY_PATTERN.match(name)
+            cur = __manifest.execute(
+                "INSERT OR IGNORE INTO hourly (name, prefix, day, hour, size, "
+                "mtime, lines, checksum, stored, state, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, ?, 'finished', ?, ?)",
+                (name, m.group(1), m.group(2), int(m.group(3)), size, mtime,
+                 stored, now, now))
+            if cur.rowcount == 0:
+                path = hourly_path(save_path, name, stored)
+                if is_archived_copy(path, name):
+                    # The removal after the zip was interrupted
+                    leftovers.append(path)
+                else:
+                    cerr(f"Kept {os.path.basename(path)}, its tweets are "
+                         f"not in the zip of its day")
+        for name in known:
+            if name not in hourly:
+                __manifest.execute("DELETE FROM hourly WHERE name = ?",
+                                   (name,))
+        for name, state, location in __manifest.execute(
+                "SELECT name, state, location FROM archives").fetchall():
+            if location is None:
+                exists = name in zips
+            else:
+                exists = os.path.isfile(os.path.join(location, name))
+            if state == "cleaned":
+                if exists:
+                    # The sweeper was interrupted before removing it
+                    leftovers.append(os.path.join(location or save_path, name))
+            elif not exists:
+                # The zip file does not exist anymore
+                __manifest.execute("DELETE FROM archives WHERE name = ?",
+                                   (name,))
+                cout(f"Cleaned {name}.{state}")
+    for path in leftovers:
+        os.remove(path)
+        remove_integrity(path[:-3] if path.endswith(".gz") else path)
+        cout(f"Removed {os.path.basename(path)}")
+    return tmp_names, raw_names, summary_names
+
+
+# Files of the Google Drive folder by name, as (id, size, md5), or None if the
+# inventory cannot be listed
+__remote_files = None
+REMOTE_FILE_FIELDS = "id,name,size,md5Checksum"
+# Id of My Drive, the folder without google_drive_folder_id
+__gdrive_root_id = None
+# If the inventory was refreshed in this run of worker()
+__remote_files_fresh = False
+
+
+def remote_folder_id() -> str:
+    """ Id of the Google Drive folder. The parents of a file are listed by id,
+    never as the "root" alias of My Drive, so the alias is resolved once. """
+    global __gdrive_root_id
+    if __gdrive_folder_id:
+        return __gdrive_folder_id
+    if __gdrive_root_id is None:
+        __gdrive_root_id = get_drive().execute(
+            get_drive().service.files().get(fileId = "root",
+                                            fields = "id"))["id"]
+    return __gdrive_root_id
+
+
+def rebuild_remote_files() -> None:
+    """ List the whole Google Drive folder into the manifest """
+    folder = remote_folder_id()
+    files = get_drive().service.files()
+
+    def list_page(page_token: str):
+        return files.list(
+            q = f"'{folder}' in parents and trashed = false",
+            fields = f"nextPageToken,files({REMOTE_FILE_FIELDS})",
+            pageSize = 1000, pageToken = page_token)
+
+    # The token is taken in the same batch as the first page, so what
+    # changes while listing is not missed
+    start, result = execute_with_folder([
+        get_drive().service.changes().getStartPageToken(), list_page(None)])
+    token = start["startPageToken"]
+    listed = result.get("files", [])
+    while result.get("nextPageToken") is not None:
+        result = get_drive().execute(list_page(result["nextPageToken"]))
+        listed.extend(result.get("files", []))
+    now = time.time()
+    with __manifest:
+        __manifest.execute("DELETE FROM remote_files")
+        __manifest.executemany(
+            "INSERT INTO remote_files (id, name, size, md5, updated) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(f["id"], f["name"], f.get("size"), f.get("md5Checksum"), now)
+             for f in listed])
+        __manifest.executemany(
+            "INSERT OR REPLACE INTO remote_state (key, value) VALUES (?, ?)",
+            [("folder", folder), ("page_token", token)])
+    cout(f"Listed {len(listed)} files on Google Drive")
+
+
+def update_remote_files(token: str) -> None:
+    """ Apply the changes of Google Drive since the page token to the
+    manifest """
+    folder = remote_folder_id()
+    changes = []
+    for page in itertools.count():
+        request = get_drive().service.changes().list(
+            pageToken = token, pageSize = 1000,
+            fields = f"nextPageToken,newStartPageToken,changes(fileId,removed,"
+                     f"file({REMOTE_FILE_FIELDS},parents,trashed))")
+        # The first page comes with the name of the folder
+        result = execute_with_folder([request])[0] if page == 0 \
+            else get_drive().execute(request)
+        changes.extend(result.get("changes", []))
+        if "newStartPageToken" in result:
+            token = result["newStartPageToken"]
+            break
+        token = result["nextPageToken"]
+    now = time.time()
+    with __manifest:
+        for c in changes:
+            f = c.get("file")
+            if c.get("removed", False) or f is None or \
+                    f.get("trashed", False) or \
+                    folder not in f.get("parents", []):
+                __manifest.execute("DELETE FROM remote_files WHERE id = ?",
+                                   (c["fileId"],))
+            else:
+                __manifest.execute(
+                    "INSERT OR REPLACE INTO remote_files (id, name, size, md5, "
+                    "updated) VALUES (?, ?, ?, ?, ?)",
+                    (f["id"], f["name"], f.get("size"), f.get("md5Checksum"),
+                     now))
+        __manifest.execute(
+            "UPDATE remote_state SET value = ? WHERE key = 'page_token'",
+            (token,))
+    if len(changes) > 0:
+        cout(f"Applied {len(changes)} changes of Google Drive")
+
+
+def refresh_remote_files() -> None:
+    """ Bring the cached inventory of the Google Drive folder up to date, and
+    load it """
+    global __remote_files, __remote_files_fresh
+    __remote_files_fresh = True
+    state = dict(__manifest.execute("SELECT key, value FROM remote_state"))
+    try:
+        if state.get("folder") == remote_folder_id() and \
+                state.get("page_token") is not None:
+            try:
+                update_remote_files(state["page_token"])
+            except BaseException as be:
+                # The token may have expired
+                cerr(f"Failed to get changes of Google Drive: {be}")
+                rebuild_remote_files()
+        else:
+            rebuild_remote_files()
+    except BaseException as be:
+        cerr(f"Failed to list Google Drive: {be}")
+        __remote_files = None
+        return
+    __remote_files = {}
+    for fid, name, size, md5 in __manifest.execute(
+            "SELECT id, name, size, md5 FROM remote_files"):
+        __remote_files.setdefault(name, []).append(
+            (fid, None if size is None else int(size), md5))
+
+
+def load_remote_files() -> None:
+    """ Refresh the inventory once per run of worker(), when it is first
+    needed """
+    if not __remote_files_fresh:
+        refresh_remote_files()
+
+
+def find_remote_copy(zn: str):
+    """ Id of a copy of the zip on Google Drive with the same MD5 (or the same
+    name, for zips of older versions without MD5), None if it has none, or if
+    the inventory is not available """
+    load_remote_files()
+    if __remote_files is None:
+        return None
+    row = __manifest.execute(
+        "SELECT checksum FROM archives WHERE name = ?", (zn,)).fetchone()
+    checksum = None if row is None else row[0]
+    for fid, size, md5 in __remote_files.get(zn, []):
+        if checksum is None or md5 == checksum:
+            return fid
+    return None
+
+
+def add_remote_copy(zn: str, file: dict) -> None:
+    with __manifest:
+        __manifest.execute(
+            "INSERT OR REPLACE INTO remote_files (id, name, size, md5, "
+            "updated) VALUES (?, ?, ?, ?, ?)",
+            (file["id"], zn, file.get("size"), file.get("md5Checksum"),
+             time.time()))
+    if __remote_files is not None:
+        __remote_files.setdefault(zn, []).append(
+            (file["id"], None if file.get("size") is None
+             else int(file["size"]), file.get("md5Checksum")))
 
 
 def upload_to_google_drive(path: str) -> bool:
     """ Upload the zip file to Google Drive """
-    zp = os.path.abspath(path)
     zn = os.path.basename(path)
 
-    if not os.path.isfile(f"{zp}.ready"):
-        cout(f"{zn} is not ready")
-        return False
-    if os.path.isfile(f"{zp}.uploaded"):
+    state = get_archive_state(zn)
+    if state == "uploaded":
         cout(f"{zn} is already uploaded")
         return True
-    if os.path.isfile(f"{zp}.uploading"):
+    if state == "uploading":
         cout(f"{zn} is being uploaded")
         return False
 
-    # Set the flag file to be uploading status
-    os.rename(f"{zp}.ready", f"{zp}.uploading")
+    # Set the manifest to be uploading status
+    if not set_archive_state(zn, "uploading", "ready"):
+        cout(f"{zn} is not ready")
+        return False
+    # The zip may have been moved to the secondary volume
+    zp = archive_path(os.path.dirname(os.path.abspath(path)), zn)
+    remote_id = find_remote_copy(zn)
+    if remote_id is not None:
+        # Uploaded before the manifest lost track of it
+        set_archive_state(zn, "uploaded", "uploading")
+        with __manifest:
+            __manifest.execute(
+                "UPDATE archives SET remote_id = ? WHERE name = ?",
+                (remote_id, zn))
+        cout(f"{zn} is already on Google Drive")
+        return True
     try:
         if __gdrive_folder_id is None or len(__gdrive_folder_id) == 0:
             file_metadata = {"name": zn}
             cout(f"Uploading {zn} to root")
         else:
             file_metadata = {"name": zn, "parents": [__gdrive_folder_id]}
-            cout(f"Uploading {zn} to folder \"{gdrive_dir_name}\"")
+            cout(f"Uploading {zn} to folder \"{get_folder_name()}\"")
+        from apiclient.http import MediaFileUpload
         media = MediaFileUpload(zp, mimetype = "application/zip",
                                 resumable = True)
-        file = __service.files().create(body = file_metadata,
-                                        media_body = media,
-                                        fields = "id").execute()
+        file = get_drive().execute(get_drive().service.files().create(
+            body = file_metadata, media_body = media,
+            fields = "id,md5Checksum,size"))
     except BaseException as be:
         cerr(f"Failed to upload {zn}: {be}")
         send_email(f"[TweetCrawler]: Failed to upload {zn}", str(be))
         return False
-    # Set the flag file to be uploaded status
-    os.rename(f"{zp}.uploading", f"{zp}.uploaded")
-    cout("Uploaded")
+    # Compare with the MD5 computed while zipping
+    checksum = __manifest.execute(
+        "SELECT checksum FROM archives WHERE name = ?", (zn,)).fetchone()[0]
+    remote = file.get("md5Checksum")
+    if checksum is not None and remote is not None and remote != checksum:
+        msg = f"MD5 of {zn} on Google Drive is {remote}, expected {checksum}"
+        cerr(msg)
+        send_email(f"[TweetCrawler]: Failed to upload {zn}", msg)
+        try:
+            get_drive().execute(get_drive().service.files().delete(
+                fileId = file["id"]))
+        except BaseException as be:
+            cerr(f"Failed to delete the copy of {zn}: {be}")
+        # Upload again on the next run
+        set_archive_state(zn, "ready", "uploading")
+        return False
+    # Set the manifest to be uploaded status
+    set_archive_state(zn, "uploaded", "uploading")
+    with __manifest:
+        __manifest.execute("UPDATE archives SET remote_id = ? WHERE name = ?",
+                           (file.get("id"), zn))
+    add_remote_copy(zn, file)
+    cout("Uploaded" if remote is None else f"Uploaded (MD5 {remote})")
     return True
 
 
+def verify_remote_copies(names: list) -> dict:
+    """ Check the copies on Google Drive of zips about to be swept, in
+    batches. For each zip, True if its copy has the same MD5, False if it
+    has no copy, None if it cannot be told. """
+    copies = {}
+    verified = {}
+    for zn in names:
+        fid = find_remote_copy(zn)
+        if fid is None:
+            # Without the inventory, the id recorded at upload is checked
+            row = __manifest.execute(
+                "SELECT remote_id FROM archives WHERE name = ?",
+                (zn,)).fetchone()
+            fid = None if __remote_files is not None or row is None \
+                else row[0]
+        if fid is None:
+            verified[zn] = False if __remote_files is not None else None
+        else:
+            copies[zn] = fid
+    if len(copies) == 0:
+        return verified
+    try:
+        drive = get_drive()
+        results = drive.execute_batch([
+            drive.service.files().get(fileId = fid,
+                                      fields = "id,md5Checksum,trashed")
+            for fid in copies.values()])
+    except BaseException as be:
+        cerr(f"Failed to verify the copies on Google Drive: {be}")
+        return {zn: verified.get(zn) for zn in names}
+    for (zn, fid), (file, exception) in zip(copies.items(), results):
+        if exception is not None:
+            status = getattr(getattr(exception, "resp", None), "status", None)
+            if status != 404:
+                cerr(f"Failed to verify the copy of {zn}: {exception}")
+            verified[zn] = False if status == 404 else None
+            continue
+        checksum = __manifest.execute(
+            "SELECT checksum FROM archives WHERE name = ?", (zn,)).fetchone()[0]
+        verified[zn] = not file.get("trashed", False) and \
+            (checksum is None or file.get("md5Checksum") == checksum)
+    return verified
+
+
+def is_remote_expired(zn: str) -> bool:
+    """ If a file of the Google Drive folder is a zip to trash """
+    return ZIP_PATTERN.match(zn) is not None and \
+        (current - zipname_to_datetime(zn)).days > __remote_keep_days
+
+
+def trim_remote_archives() -> None:
+    """ Move the zips of the Google Drive folder older than remote_keep_days
+    to the trash, in batches """
+    if __remote_keep_days == 0:
+        return
+    # Only listed again when the cached inventory has zips to trash
+    if not any(is_remote_expired(zn) for zn, in __manifest.execute(
+            "SELECT name FROM remote_files")):
+        return
+    load_remote_files()
+    if __remote_files is None:
+        return
+    expired = [(zn, fid) for zn, copies in sorted(__remote_files.items())
+               if is_remote_expired(zn) for fid, size, md5 in copies]
+    if len(expired) == 0:
+        return
+    try:
+        drive = get_drive()
+        results = drive.execute_batch([
+            drive.service.files().update(fileId = fid,
+                                         body = {"trashed": True},
+                                         fields = "id")
+            for zn, fid in expired])
+    except BaseException as be:
+        cerr(f"Failed to trash old zips on Google Drive: {be}")
+        return
+    for (zn, fid), (_, exception) in zip(expired, results):
+        if exception is not None:
+            cerr(f"Failed to trash {zn} on Google Drive: {exception}")
+            continue
+        with __manifest:
+            __manifest.execute("DELETE FROM remote_files WHERE id = ?", (fid,))
+            __manifest.execute(
+                "UPDATE archives SET remote_id = NULL WHERE remote_id = ?",
+                (fid,))
+        __remote_files[zn] = [c for c in __remote_files[zn] if c[0] != fid]
+        record_action(__manifest, "trash", zn,
+                      f"{fid} on Google Drive, older than "
+                      f"{__remote_keep_days} days")
+
+
 def filename_to_datetime(filename: str) -> datetime:
-    basename = os.path.basename(filename).split(".")[0]
+    # Remove the prefix, which does not contain "-"
+    basename = os.path.basename(filename).split(".")[0].split("-", 1)[1]
     return datetime.strptime(
         f"{basename}:00:00.000001 +0000",
-        "tweets-%Y%m%d-%H:%M:%S.%f %z")
+        "%Y%m%d-%H:%M:%S.%f %z")
 
 
 def zipname_to_datetime(filename: str) -> datetime:
-    basename = os.path.basename(filename).split(".")[0]
+    # Remove the prefix, which does not contain "-"
+    basename = os.path.basename(filename).split(".")[0].split("-", 1)[1]
     return datetime.strptime(
         f"{basename}-00:00:00.000001 +0000",
-        "tweets-%Y%m%d-%H:%M:%S.%f %z")
+        "%Y%m%d-%H:%M:%S.%f %z")
+
+
+def record_hourly(save_path: str, name: str, stored: str = None) -> None:
+    """ Add a finished hourly file to the manifest """
+    st = os.stat(hourly_path(save_path, name, stored))
+    m = HOURLY_PATTERN.match(name)
+    now = time.time()
+    with __manifest:
+        __manifest.execute(
+            "INSERT INTO hourly (name, prefix, day, hour, size, mtime, lines, "
+            "checksum, stored, state, created, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, ?, 'finished', ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET size = excluded.size, "
+            "mtime = excluded.mtime, stored = excluded.stored, "
+            "updated = excluded.updated",
+            (name, m.group(1), m.group(2), int(m.group(3)), st.st_size,
+             st.st_mtime, stored, now, now))
 
 
-def finish_files(save_path: str) -> None:
-    """" Search for any unfinished tmp files and rename them """
-    for f in glob.glob(os.path.join(save_path,
-                                    "tweets-"
-                                    # 4 digits year, 2 digits months and day
-                                    "20[0-9][0-9][01][0-9][0-3][0-9]-"
-                                    # 2 digits minutes
-                                    "[0-2][0-9].tmp")):
+def finish_files(save_path: str, tmp_names: list = None) -> list:
+    """" Search for any unfinished tmp files and rename them, return the new
+    names """
+    renamed = []
+    if tmp_names is None:
+        tmp_names = [n for n in os.listdir(save_path) if TMP_PATTERN.match(n)]
+    for tn in sorted(tmp_names):
+        f = os.path.join(save_path, tn)
         file_time = filename_to_datetime(f)
         diff_sec = (datetime.now(tz = timezone.utc) - file_time).total_seconds()
         if diff_sec >= 125 * 60:  # Differ by 2 hours 5 minutes
             try:
+                trimmed = trim_padding(f)
+                if trimmed > 0:
+                    cout(f"Trimmed {trimmed} bytes of padding from "
+                         f"{os.path.basename(f)}")
                 os.rename(f, f[:-4])
                 cout(
                     f"Renamed {os.path.basename(f)} to "
@@ -374,180 +1060,1324 @@ def finish_files(save_path: str) -> None:
                 cerr(
                     f"Failed to rename {os.path.basename(f)} to "
                     f"{os.path.basename(f[:-4])}")
+                continue
+            renamed.append(os.path.basename(f[:-4]))
+            if HOURLY_PATTERN.match(renamed[-1]):
+                record_hourly(save_path, renamed[-1])
+    return renamed
 
 
-def deduplicate(path: str):
-    tweets = {}
-    num_lines = 0
+def normalize_raw_files(save_path: str, raw_names: list) -> None:
+    """ Normalize the raw files of the raw ingest mode into hourly files, one
+    process per file, exactly as the crawler does while crawling """
+    if len(raw_names) == 0:
+        return
+    jobs = []
+    for rn in sorted(raw_names):
+        out_path = os.path.join(save_path, f"{rn[:-4]}.normalizing")
+        if os.path.isfile(out_path):
+            os.remove(out_path)  # Left by an interrupted run
+        jobs.append((os.path.join(save_path, rn), out_path, __profile))
+    t = time.monotonic()
+    # Forked workers do not import this script again
+    with multiprocessing.get_context("fork").Pool(
+            min(__normalize_processes, len(jobs))) as pool:
+        results = pool.starmap(normalize_raw_file, jobs)
+    total = 0
+    for (raw_path, out_path, _), (stats_in, stats_out, summary) in zip(
+            jobs, results):
+        rn = os.path.basename(raw_path)
+        name = rn[:-4]
+        saved_path = os.path.join(save_path, name)
+        expected = read_integrity(raw_path)
+        if expected is not None:
+            report_mismatches(rn, stats_in.mismatches(expected))
+        stored = "gzip" if os.path.isfile(saved_path + ".gz") else None
+        if stored is not None or os.path.isfile(saved_path):
+            # Hourly file written in parsed mode for the same hour
+            with open(out_path, "r") as inf, open_hourly(
+                    hourly_path(save_path, name, stored), "at") as outf:
+                for line in inf:
+                    outf.write(line)
+            os.remove(out_path)
+            saved_stats = read_integrity(saved_path)
+            if saved_stats is not None:
+                saved_stats.merge(stats_out)
+                write_integrity(saved_path, saved_stats)
+        else:
+            write_integrity(saved_path, stats_out)
+            os.rename(out_path, saved_path)
+        raw_summary = read_summary(raw_path)
+        if raw_summary is not None:
+            # Tweets shed by the crawler
+            summary.merge(raw_summary)
+            os.remove(raw_path + SUMMARY_SUFFIX)
+        write_summary(saved_path, summary)
+        os.remove(raw_path)
+        remove_integrity(raw_path)
+        record_hourly(save_path, name, stored)
+        total += stats_out.lines
+        cout(f"Normalized {rn} to {name} ({stats_in.lines} raw, "
+             f"{stats_out.lines} tweets)")
+    elapsed = time.monotonic() - t
+    cout(f"Normalized {len(jobs)} raw files in {elapsed:.1f} s "
+         f"({total / max(elapsed, 1e-6):.0f} tweets/s)")
+
+
+# Lines sorted in memory at once while merging the files of the hosts
+MERGE_RUN_LINES = 100000
+# Gaps recorded per host and per hour, the last one absorbs the rest
+MERGE_MAX_GAPS = 1000
+# Seconds after the start of an hour before it is merged without the hosts
+# that have not finished it
+MERGE_WAIT = 3 * 3600
+
+
+def sorted_runs(path: str, host: int, stats: HourStats, run_dir: str):
+    """ Split an hourly file into runs sorted by tweet id, each in a
+    temporary file of lines "ID<TAB>HOST<TAB>JSON". Return the runs and the
+    number of lines that could not be read. """
+    runs = []
+    buf = []
+    invalid = 0
+
+    def flush() -> None:
+        buf.sort()
+        run = tempfile.TemporaryFile("w+", dir = run_dir, prefix = ".merge-")
+        for tid, line in buf:
+            run.write(f"{tid}\t{host}\t{line}\n")
+        run.seek(0)
+        runs.append(run)
+        buf.clear()
+
     with open(path, "r") as inf:
         for line in inf:
+            # A file left by a crash may end with padding or a partial line
             line = line.rstrip("\n")
-            if len(line) == 0:
+            if len(line.strip("\0")) == 0:
+                continue
+            try:
+                t = json.loads(line)
+                tid = int(t["data"]["id"] if "data" in t else t["id"])
+            except (ValueError, KeyError, TypeError):
+                invalid += 1
+                continue
+            stats.add((line + "\n").encode("utf-8"), tid)
+            buf.append((tid, line))
+            if len(buf) >= MERGE_RUN_LINES:
+                flush()
+    if len(buf) > 0:
+        flush()
+    return runs, invalid
+
+
+def read_run(run):
+    for record in run:
+        tid, host, line = record.rstrip("\n").split("\t", 2)
+        yield int(tid), int(host), line
+
+
+def merge_hour(save_path: str, name: str, hosts: list, paths: dict) -> None:
+    """ Merge the files of an hour written by several hosts into one hourly
+    file sorted by tweet id without duplicates, with a k-way merge of runs
+    of bounded size. Record the tweets missing from each host, and which
+    hosts supplied them. """
+    out_path = os.path.join(save_path, f"{name}.merging")
+    saved_path = os.path.join(save_path, name)
+    # Left by an interrupted run
+    remove_integrity(saved_path)
+    if os.path.isfile(saved_path + SUMMARY_SUFFIX):
+        os.remove(saved_path + SUMMARY_SUFFIX)
+    runs = []
+    host_lines = []
+    base = None
+    base_summary = None
+    sources = []
+    for i, host in enumerate(hosts):
+        if host not in paths:
+            host_lines.append(0)
+            continue
+        path = paths[host]
+        st = os.stat(path)
+        sources.append((path, name, host, st.st_size, st.st_mtime))
+        stats = HourStats()
+        host_runs, invalid = sorted_runs(path, i, stats, save_path)
+        runs.extend(host_runs)
+        host_lines.append(stats.lines)
+        expected = read_integrity(path)
+        if expected is not None:
+            report_mismatches(f"{host}/{os.path.basename(path)}",
+                              stats.mismatches(expected))
+        if invalid > 0:
+            cerr(f"Skipped {invalid} unreadable lines of "
+                 f"{host}/{os.path.basename(path)}")
+        # Count the tweets of the most complete host with a summary, and
+        # those of the others it missed
+        summary = read_summary(path)
+        if summary is not None and (base is None or
+                                    stats.lines > host_lines[base]):
+            base, base_summary = i, summary
+    summary = HourSummary() if base_summary is None else base_summary
+    if base_summary is not None:
+        # Tweets shed by a host may have been received by the others
+        summary.shed = summary.spilled = 0
+
+    # Open gap of each host: first id, last id, tweets and suppliers
+    gaps = [[] for _ in hosts]
+    open_gaps = [None for _ in hosts]
+    out_stats = HourStats()
+    try:
+        with open(out_path, "w") as outf:
+            merged = heapq.merge(*[read_run(r) for r in runs])
+            for tid, group in itertools.groupby(merged, key = lambda r: r[0]):
+                group = list(group)
+                present = {host for _, host, _ in group}
+                line = group[0][2] + "\n"
+                outf.write(line)
+                out_stats.add(line.encode("utf-8"), tid)
+                if base is None or base not in present:
+                    t = json.loads(line)
+                    # Tweets of older versions are not wrapped in "data"
+                    summary.add(tweet_facts(t if "data" in t else
+                                            {"data": t}))
+                for i in range(len(hosts)):
+                    gap = open_gaps[i]
+                    if i in present:
+                        if gap is not None:
+                            gaps[i].append(gap)
+                            open_gaps[i] = None
+                        continue
+                    if gap is None and len(gaps[i]) >= MERGE_MAX_GAPS:
+                        gap = open_gaps[i] = gaps[i].pop()
+                    if gap is None:
+                        open_gaps[i] = [tid, tid, 1, present]
+                    else:
+                        gap[1] = tid
+                        gap[2] += 1
+                        gap[3] = gap[3] | present
+            for i, gap in enumerate(open_gaps):
+                if gap is not None:
+                    gaps[i].append(gap)
+    finally:
+        for run in runs:
+            run.close()
+
+    write_integrity(saved_path, out_stats)
+    write_summary(saved_path, summary)
+    os.rename(out_path, saved_path)
+    with __manifest:
+        for i, host_gaps in enumerate(gaps):
+            __manifest.executemany(
+                "INSERT INTO merge_gaps (name, host, first_id, last_id, "
+                "tweets, supplied_by) VALUES (?, ?, ?, ?, ?, ?)",
+                [(name, hosts[i], first_id, last_id, num,
+                  ",".join(hosts[h] for h in sorted(suppliers)))
+                 for first_id, last_id, num, suppliers in host_gaps])
+        __manifest.executemany(
+            "INSERT OR REPLACE INTO merged_sources (path, name, host, size, "
+            "mtime, state, updated) VALUES (?, ?, ?, ?, ?, 'merged', ?)",
+            [source + (time.time(),) for source in sources])
+    record_hourly(save_path, name)
+    cout(f"Merged {name} from {len(paths)} of {len(hosts)} hosts "
+         f"({out_stats.lines} tweets)")
+    for i, host_gaps in enumerate(gaps):
+        if len(host_gaps) == 0:
+            continue
+        suppliers = set()
+        for gap in host_gaps:
+            suppliers |= gap[3]
+        cout(f"Filled {sum(g[2] for g in host_gaps)} tweets missing from "
+             f"{hosts[i]} in {len(host_gaps)} gaps, from "
+             f"{', '.join(hosts[h] for h in sorted(suppliers))}")
+
+
+def merge_sources(save_path: str) -> None:
+    """ Merge the hourly files of the crawlers of several hosts, once every
+    host has finished the hour, or MERGE_WAIT after it started """
+    hosts = [os.path.basename(d.rstrip("/")) or d for d in __source_dirs]
+    if len(set(hosts)) < len(hosts):
+        hosts = __source_dirs
+    found = {}
+    for host, source_dir in zip(hosts, __source_dirs):
+        for entry in os.scandir(source_dir):
+            if HOURLY_PATTERN.match(entry.name):
+                found.setdefault(entry.name, {})[host] = entry.path
+            elif TMP_PATTERN.match(entry.name) and \
+                    not entry.name.endswith(".raw.tmp"):
+                # Left by a crawler that crashed
+                found.setdefault(entry.name[:-4], {}).setdefault(
+                    host, entry.path)
+    known = {r[0] for r in __manifest.execute("SELECT name FROM hourly")}
+    now = datetime.now(tz = timezone.utc)
+    for name in sorted(found.keys()):
+        if name in known or is_merged(save_path, name):
+            continue
+        paths = found[name]
+        finished = [h for h in hosts
+                    if h in paths and not paths[h].endswith(".tmp")]
+        age = (now - filename_to_datetime(name)).total_seconds()
+        if len(finished) < len(hosts) and age < MERGE_WAIT:
+            continue
+        merge_hour(save_path, name, hosts, paths)
+
+
+def is_merged(save_path: str, name: str) -> bool:
+    """ If an hour missing from the manifest was merged before, e.g. when the
+    manifest was lost: its file, or the zip of its day, is still there """
+    if os.path.exists(os.path.join(save_path, name)) or \
+            os.path.exists(os.path.join(save_path, name + ".gz")):
+        return True
+    match = HOURLY_PATTERN.match(name)
+    zn = f"{match.group(1)}-{match.group(2)}.zip"
+    return any(os.path.exists(os.path.join(d, zn))
+               for d in (save_path, __secondary_dir) if d is not None)
+
+
+def sweep_sources() -> None:
+    """ Remove the files of source_dirs merged into hours that are archived
+    and older than keep_files_for_days, unless they changed since the
+    merge """
+    if __keep_days is None or __keep_days == 0:
+        return
+    removed = 0
+    for path, name, size, mtime in __manifest.execute(
+            "SELECT m.path, m.name, m.size, m.mtime FROM merged_sources m "
+            "JOIN hourly h ON h.name = m.name WHERE m.state = 'merged' "
+            "AND h.state = 'archived' ORDER BY m.name").fetchall():
+        if (current - filename_to_datetime(name)).days <= __keep_days:
+            continue
+        state = "removed"
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            st = None
+        if st is not None and (st.st_size != size or st.st_mtime != mtime):
+            cerr(f"{path} changed after it was merged, keeping it")
+            state = "changed"
+        elif st is not None:
+            os.remove(path)
+            remove_integrity(path)
+            if os.path.isfile(path + SUMMARY_SUFFIX):
+                os.remove(path + SUMMARY_SUFFIX)
+            removed += 1
+        with __manifest:
+            __manifest.execute(
+                "UPDATE merged_sources SET state = ?, updated = ? "
+                "WHERE path = ?", (state, time.time(), path))
+    if removed > 0:
+        cout(f"Removed {removed} merged files of {KEY_SOURCE_DIRS}")
+
+
+# Hours are backfilled while the recent search has their tweets, with an
+# hour to spare
+BACKFILL_WINDOW = SEARCH_DAYS * 86400 - 3600
+# The usual number of tweets of an hour is the median of the same hour of
+# the days before, if enough of them are known
+USUAL_DAYS = 14
+USUAL_MIN_DAYS = 3
+# Tweets found for an hour, before they are merged into its file
+BACKFILL_SUFFIX = ".backfill"
+
+
+def usual_lines(prefix: str, day: str, hour: int):
+    """ Median number of tweets of the hour in the days before, None if too
+    few of them are known """
+    first = (datetime.strptime(day, "%Y%m%d") -
+             timedelta(days = USUAL_DAYS)).strftime("%Y%m%d")
+    lines = [r[0] for r in __manifest.execute(
+        "SELECT lines FROM hourly WHERE prefix = ? AND hour = ? AND "
+        "day >= ? AND day < ? AND lines IS NOT NULL",
+        (prefix, hour, first, day))]
+    if len(lines) < USUAL_MIN_DAYS:
+        return None
+    return int(statistics.median(lines))
+
+
+def hourly_lines(save_path: str, name: str, stored: str = None) -> int:
+    """ Number of tweets of a finished hourly file """
+    stats = read_integrity(os.path.join(save_path, name))
+    if stats is not None:
+        return stats.lines
+    with open_hourly(hourly_path(save_path, name, stored), "rb") as inf:
+        return sum(1 for _ in inf)
+
+
+def queue_backfill(save_path: str) -> None:
+    """ Queue a job for each query of the stream of the finished hours that
+    are missing, or have fewer tweets than backfill_below of the usual
+    number, while the recent search still has their tweets """
+    now = datetime.now(tz = timezone.utc)
+    first = (now - timedelta(seconds = BACKFILL_WINDOW)).replace(
+        minute = 0, second = 0, microsecond = 0) + timedelta(hours = 1)
+    # Hours the crawler has finished, as in finish_files
+    last = now - timedelta(minutes = 125)
+    queued = {r[0] for r in __manifest.execute(
+        "SELECT DISTINCT name FROM backfill")}
+    for prefix, queries in sorted(__backfill_queries.items()):
+        row = __manifest.execute(
+            "SELECT day, hour FROM hourly WHERE prefix = ? "
+            "ORDER BY day, hour LIMIT 1", (prefix,)).fetchone()
+        if row is None:
+            continue  # Nothing crawled yet
+        start = datetime.strptime(f"{row[0]}{row[1]:02d}", "%Y%m%d%H").replace(
+            tzinfo = timezone.utc)
+        hours = {name: (state, stored) for name, state, stored in
+                 __manifest.execute(
+                     "SELECT name, state, stored FROM hourly WHERE "
+                     "prefix = ? AND day >= ?",
+                     (prefix, first.strftime("%Y%m%d")))}
+        t = max(first, start)
+        while t <= last:
+            name = f"{prefix}-{t.strftime('%Y%m%d-%H')}"
+            day, hour = t.strftime("%Y%m%d"), t.hour
+            t += timedelta(hours = 1)
+            if name in queued:
+                continue
+            usual = usual_lines(prefix, day, hour)
+            if name in hours:
+                state, stored = hours[name]
+                if state != "finished" or usual is None:
+                    continue
+                lines = hourly_lines(save_path, name, stored)
+                if lines >= __backfill_below * usual:
+                    continue
+            elif any(os.path.exists(os.path.join(save_path, name + suffix))
+                     for suffix in (".tmp", ".raw", ".raw.tmp")):
+                continue  # Not finished or normalized yet
+            else:
+                lines = 0
+            now_ts = time.time()
+            with __manifest:
+                __manifest.executemany(
+                    "INSERT OR IGNORE INTO backfill (name, query, lines, "
+                    "usual, state, created, updated) "
+                    "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                    [(name, query, lines, usual or 0, now_ts, now_ts)
+                     for query in queries])
+            cout(f"Queued backfill of {name} ({lines} tweets, usually "
+                 f"{'unknown' if usual is None else usual})")
+
+
+def fetch_backfill(save_path: str) -> None:
+    """ Page through the recent search for the queued jobs, the oldest hours
+    first since they leave it first, while the rate limit allows. The
+    tweets found are normalized with the profile of the crawler and added
+    to the BACKFILL_SUFFIX file of the hour. """
+    jobs = __manifest.execute(
+        "SELECT name, query, next_token FROM backfill "
+        "WHERE state = 'queued'").fetchall()
+    jobs.sort(key = lambda j: (filename_to_datetime(j[0]), j[0], j[1]))
+    for name, query, next_token in jobs:
+        start = filename_to_datetime(name).replace(microsecond = 0)
+        if start.timestamp() < time.time() - SEARCH_DAYS * 86400:
+            with __manifest:
+                __manifest.execute(
+                    "UPDATE backfill SET state = 'fetched', complete = 0, "
+                    "updated = ? WHERE name = ? AND query = ?",
+                    (time.time(), name, query))
+            cerr(f"Backfill of {name} for \"{query}\" is incomplete, its "
+                 f"tweets left the recent search")
+            continue
+        with open(os.path.join(save_path, name + BACKFILL_SUFFIX),
+                  "a") as outf:
+            while True:
+                if not __search.can_request():
+                    raise RateLimited(__search.reset)
+                try:
+                    page = __search.search(query, start,
+                                           start + timedelta(hours = 1),
+                                           __profile, next_token)
+                except InvalidQuery as e:
+                    with __manifest:
+                        __manifest.execute(
+                            "UPDATE backfill SET state = 'fetched', "
+                            "complete = 0, updated = ? "
+                            "WHERE name = ? AND query = ?",
+                            (time.time(), name, query))
+                    cerr(f"Backfill of {name} for \"{query}\" failed: {e}")
+                    break
+                found = 0
+                for payload in page_payloads(page):
+                    line = normalize_tweet(payload, __profile)
+                    if line is not None:
+                        outf.write(line)
+                        found += 1
+                outf.flush()
+                next_token = page.get("meta", {}).get("next_token")
+                done = next_token is None
+                with __manifest:
+                    __manifest.execute(
+                        "UPDATE backfill SET next_token = ?, "
+                        "requests = requests + 1, found = found + ?, "
+                        "complete = ?, state = ?, updated = ? "
+                        "WHERE name = ? AND query = ?",
+                        (next_token, found, 1 if done else None,
+                         "fetched" if done else "queued", time.time(), name,
+                         query))
+                if done:
+                    break
+
+
+def merge_backfill(save_path: str, name: str) -> None:
+    """ Append the tweets found for an hour that are not in its file yet,
+    and add them to its integrity and summary sidecars. The file of a
+    missing hour is created, even without tweets, so its day can be
+    zipped. """
+    saved_path = os.path.join(save_path, name)
+    staged_path = saved_path + BACKFILL_SUFFIX
+    row = __manifest.execute("SELECT stored FROM hourly WHERE name = ?",
+                             (name,)).fetchone()
+    stored = None if row is None else row[0]
+    path = hourly_path(save_path, name, stored)
+    ids = set()
+    if os.path.isfile(path):
+        with open_hourly(path, "rt") as inf:
+            for line in inf:
+                try:
+                    t = json.loads(line)
+                    ids.add(int(t["data"]["id"] if "data" in t else t["id"]))
+                except (ValueError, KeyError, TypeError):
+                    continue
+    stats = HourStats()
+    summary = HourSummary()
+    with open_hourly(path, "at") as outf:
+        if os.path.isfile(staged_path):
+            with open(staged_path, "r") as inf:
+                for line in inf:
+                    t = json.loads(line)
+                    tid = int(t["data"]["id"])
+                    if tid in ids:
+                        continue
+                    ids.add(tid)
+                    outf.write(line)
+                    stats.add(line.encode("utf-8"), tid)
+                    summary.add(tweet_facts(t))
+    saved_stats = read_integrity(saved_path)
+    if saved_stats is not None:
+        saved_stats.merge(stats)
+        write_integrity(saved_path, saved_stats)
+    elif row is None:
+        write_integrity(saved_path, stats)
+    write_summary(saved_path, summary)
+    record_hourly(save_path, name, stored)
+    with __manifest:
+        __manifest.execute(
+            "UPDATE backfill SET state = 'merged', updated = ? "
+            "WHERE name = ?", (time.time(), name))
+    if os.path.isfile(staged_path):
+        os.remove(staged_path)
+    cout(f"Backfilled {name} with {stats.lines} tweets")
+
+
+def backfill(save_path: str) -> None:
+    """ Queue, fetch and merge the backfill of the hours the crawler
+    missed. The budget of search requests left is kept in the manifest for
+    the next run. """
+    queue_backfill(save_path)
+    state = dict(__manifest.execute(
+        "SELECT key, value FROM remote_state "
+        "WHERE key IN ('search_remaining', 'search_reset')"))
+    if state.get("search_remaining") is not None:
+        __search.remaining = int(state["search_remaining"])
+        __search.reset = float(state["search_reset"])
+    requests = __search.requests
+    try:
+        fetch_backfill(save_path)
+    except RateLimited as e:
+        cout(f"Backfill paused: {e}")
+    except (OSError, ValueError) as e:
+        cerr(f"Failed to search recent tweets: {e}")
+    finally:
+        with __manifest:
+            __manifest.executemany(
+                "INSERT OR REPLACE INTO remote_state (key, value) "
+                "VALUES (?, ?)",
+                [("search_remaining", None if __search.remaining is None
+                  else str(__search.remaining)),
+                 ("search_reset", str(__search.reset))])
+    if __search.requests > requests:
+        remaining = "unknown" if __search.remaining is None \
+            else __search.remaining
+        cout(f"Made {__search.requests - requests} search requests, "
+             f"{remaining} left in the rate-limit window")
+    for (name,) in __manifest.execute(
+            "SELECT name FROM backfill GROUP BY name "
+            "HAVING SUM(state = 'fetched') > 0 AND "
+            "SUM(state = 'queued') = 0").fetchall():
+        merge_backfill(save_path, name)
+
+
+def report_mismatches(name: str, mismatches: list) -> bool:
+    """ Report a file that does not match its integrity sidecar, return if it
+    matched """
+    if len(mismatches) == 0:
+        return True
+    msg = f"{name} does not match what the crawler wrote: " \
+          f"{', '.join(mismatches)}"
+    cerr(msg)
+    send_email(f"[TweetCrawler]: Integrity check failed for {name}", msg)
+    return False
+
+
+def deduplicate(path: str) -> HourStats:
+    """ Remove the duplicate tweets of an hourly file. Return the statistics
+    of the file before, to check it against its integrity sidecar. """
+    tweets = {}
+    stats = HourStats()
+    with open_hourly(path, "rt") as inf:
+        for line in inf:
+            if len(line.rstrip("\n")) == 0:
                 continue
             t = json.loads(line)
-            tid = int(t["id"])
-            tweets[tid] = line
-            num_lines += 1
+            tid = int(t["data"]["id"] if "data" in t else t["id"])
+            stats.add(line.encode("utf-8"), tid)
+            tweets[tid] = line.rstrip("\n")
+    num_lines = stats.lines
     if num_lines < 2 or len(tweets) == num_lines:
-        return
-    with open(path, "w") as outf:
+        return stats
+    with open_hourly(path, "wt") as outf:
         for tid in sorted(tweets.keys()):
             outf.write(tweets[tid] + "\n")
     cout(
         f"Deduplicate {os.path.basename(path)} from {num_lines} to "
         f"{len(tweets)}")
+    return stats
+
+
+class HashingWriter:
+    """ Write-only file wrapper computing the MD5 of everything written """
+
+    def __init__(self, fp):
+        self.__fp = fp
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.md5.update(data)
+        self.size += len(data)
+        return self.__fp.write(data)
+
+    def flush(self) -> None:
+        self.__fp.flush()
+
+
+# Days a zstd dictionary is used before it is trained again on the latest
+# hours of its prefix
+DICT_MAX_AGE = 7 * 86400
+DICT_TRAIN_HOURS = 24
+
+
+def current_dictionary(save_path: str, prefix: str) -> (int, bytes):
+    """ The zstd dictionary of a prefix, trained again on the latest finished
+    hours when it gets old. None if none could be trained. """
+    row = __manifest.execute(
+        "SELECT id, data, created FROM dictionaries WHERE prefix = ? "
+        "ORDER BY created DESC LIMIT 1", (prefix,)).fetchone()
+    if row is not None and time.time() - row[2] < DICT_MAX_AGE:
+        return row[0], row[1]
+    paths = [hourly_path(save_path, name, stored) for name, stored in
+             __manifest.execute(
+                 "SELECT name, stored FROM hourly WHERE prefix = ? AND "
+                 "state = 'finished' ORDER BY day DESC, hour DESC LIMIT ?",
+                 (prefix, DICT_TRAIN_HOURS))]
+    t = time.monotonic()
+    samples = sample_lines(paths, lambda p: open_hourly(p, "rb"))
+    try:
+        dict_id, data = train_dictionary(samples)
+    except ValueError as e:
+        cerr(f"Failed to train a dictionary for {prefix}: {e}")
+        return (None, None) if row is None else (row[0], row[1])
+    with __manifest:
+        __manifest.execute(
+            "INSERT OR REPLACE INTO dictionaries (id, prefix, hours, samples, "
+            "data, created) VALUES (?, ?, ?, ?, ?, ?)",
+            (dict_id, prefix, len(paths), len(samples), data, time.time()))
+    cout(f"Trained dictionary {dict_id} for {prefix} on {len(samples)} tweets "
+         f"of {len(paths)} hours in {time.monotonic() - t:.1f} s")
+    return dict_id, data
 
 
 def zip_tweets(save_path: str) -> None:
     """ Zip all text files, group by day """
-    days = set()
-    for f in glob.glob(os.path.join(save_path,
-                                    "tweets-"
-                                    # 4 digits year, 2 digits months and day
-                                    "20[0-9][0-9][01][0-9][0-3][0-9]-"
-                                    # 2 digits minutes
-                                    "[0-2][0-9]")):
-        fn = os.path.basename(f)
-        day_str = fn.split("-")[1]
-        days.add(day_str)
-    for day_str in sorted(list(days)):
-        files = []
-        for hour in range(24):
-            if hour < 10:
-                f = os.path.join(__working_dir, f"tweets-{day_str}-0{hour}")
-            else:
-                f = os.path.join(__working_dir, f"tweets-{day_str}-{hour}")
-            if os.path.isfile(f):
-                files.append(f)
-            else:
-                break
-        if len(files) == 24:
-            zipp = os.path.join(__working_dir, f"tweets-{day_str}.zip")
-            flagp = os.path.join(__working_dir, f"tweets-{day_str}.zip.ready")
-            if not os.path.isfile(flagp):
-                # Create zip
-                zf = zipfile.ZipFile(zipp, "w")
-                # Add to zip in order
-                for f in files:
-                    if __dedup:
-                        deduplicate(f)
-                    os.chmod(f, 0o644)
-                    fn = os.path.basename(f)
-                    zf.write(f, fn, zipfile.ZIP_DEFLATED, 9)
-                    cout(f"Zipped {fn} (size = {os.path.getsize(f)})")
-                zf.close()  # Finish the zip file
-                del zf
+    days = __manifest.execute(
+        "SELECT prefix, day, COUNT(*) FROM hourly WHERE state = 'finished' "
+        "GROUP BY prefix, day ORDER BY prefix, day").fetchall()
+    # Days waiting for the backfill of some hours
+    backfilling = {HOURLY_PATTERN.match(r[0]).group(1, 2) for r in
+                   __manifest.execute("SELECT DISTINCT name FROM backfill "
+                                      "WHERE state != 'merged'")}
+    for prefix, day_str, num_files in days:
+        if (prefix, day_str) in backfilling:
+            cout(f"Backfilling {prefix}-{day_str}")
+        elif num_files == 24:
+            zn = f"{prefix}-{day_str}.zip"
+            zipp = os.path.join(save_path, zn)
+            if get_archive_state(zn) is None:
+                files = [(os.path.join(save_path, name),
+                          hourly_path(save_path, name, stored))
+                         for name, stored in __manifest.execute(
+                             "SELECT name, stored FROM hourly WHERE "
+                             "prefix = ? AND day = ? AND state = 'finished' "
+                             "ORDER BY hour", (prefix, day_str))]
+                members = []
+                dict_id, dictionary = (None, None)
+                if __archive_codec == "zstd":
+                    dict_id, dictionary = current_dictionary(save_path,
+                                                             prefix)
+                # Create zip, hashing both the members and the zip itself
+                # while they are written
+                with open(zipp, "wb") as outf:
+                    hw = HashingWriter(outf)
+                    zf = zipfile.ZipFile(hw, "w", zipfile.ZIP_DEFLATED,
+                                         compresslevel = 9)
+                    if dictionary is not None:
+                        # Each hour is a zstd frame of its own
+                        zf.writestr(dictionary_name(dict_id), dictionary)
+                    # Add to zip in order
+                    for f, stored_f in files:
+                        fn = os.path.basename(f)
+                        expected = read_integrity(f)
+                        verified = None
+                        if __dedup:
+                            # Check what the crawler wrote before it changes
+                            stats = deduplicate(stored_f)
+                            if expected is not None:
+                                verified = report_mismatches(
+                                    fn, stats.mismatches(expected))
+                        os.chmod(stored_f, 0o644)
+                        size = os.path.getsize(stored_f)
+                        md5 = hashlib.md5()
+                        stats = HourStats()
+                        # The size of a compressed file is not known before
+                        with open_hourly(stored_f, "rb") as inf, \
+                                open_member_writer(zf, fn, dictionary, (
+                                    stored_f != f or
+                                    size >= zipfile.ZIP64_LIMIT)) as zm:
+                            while True:
+                                chunk = inf.read(1048576)
+                                stats.add_chunk(chunk)
+                                if not chunk:
+                                    break
+                                md5.update(chunk)
+                                zm.write(chunk)
+                        if expected is not None and verified is None:
+                            verified = report_mismatches(
+                                fn, stats.mismatches(expected, False))
+                        size = stats.bytes
+                        members.append((fn, size, stats.lines,
+                                        md5.hexdigest(), verified))
+                        cout(f"Zipped {fn} (size = {size})")
+                    zf.close()  # Finish the zip file
+                    del zf
                 os.chmod(zipp, 0o644)
 
-                # Create an empty flag file to indicate the zip file has been
-                # created successfully
-                outf = open(flagp, "w")
-                outf.close()
-                del outf
-                os.chmod(flagp, 0o644)
+                # Record the zip and its members in one transaction so the
+                # zip is only ready once all of them are archived
+                now = time.time()
+                with __manifest:
+                    __manifest.execute(
+                        "INSERT OR REPLACE INTO archives (name, prefix, day, "
+                        "size, lines, checksum, codec, dictionary, state, "
+                        "created, updated) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'ready', ?, ?)",
+                        (zn, prefix, day_str, hw.size,
+                         sum(m[2] for m in members), hw.md5.hexdigest(),
+                         "zip" if dictionary is None else "zstd", dict_id,
+                         now, now))
+                    for fn, size, lines, checksum, verified in members:
+                        __manifest.execute(
+                            "UPDATE hourly SET state = 'archived', "
+                            "size = ?, lines = ?, checksum = ?, verified = ?, "
+                            "updated = ? WHERE name = ?",
+                            (size, lines, checksum, verified, now, fn))
 
                 # Remove original files
-                for f in files:
-                    os.remove(f)
-                    cout(f"Removed {os.path.basename(f)}")
-                cout(f"Created {day_str}.zip")
+                for f, stored_f in files:
+                    os.remove(stored_f)
+                    remove_integrity(f)
+                    cout(f"Removed {os.path.basename(stored_f)}")
+                cout(f"Created {zn}")
+                del files
         else:
-            cout(f"Not completed {day_str}")
-        del files
+            cout(f"Not completed {prefix}-{day_str}")
     del days
 
 
+def sweep_summaries(save_path: str, summary_names: list) -> None:
+    """ Remove the summaries too old for the weekly digest """
+    last_day = (current - timedelta(days = SUMMARY_KEEP_DAYS)).strftime(
+        "%Y%m%d")
+    for name in summary_names:
+        if SUMMARY_PATTERN.match(name).group(2) < last_day:
+            os.remove(os.path.join(save_path, name))
+
+
+def build_weekly_digest(save_path: str, days: int = 7) -> str:
+    """ Report the tweets of the last days from the summaries of the hourly
+    files """
+    first = (current - timedelta(days = days)).strftime("%Y%m%d")
+    last = (current - timedelta(days = 1)).strftime("%Y%m%d")
+    summaries = {}
+    hours = {}
+    for name in sorted(os.listdir(save_path)):
+        m = SUMMARY_PATTERN.match(name)
+        if m is None or not first <= m.group(2) <= last:
+            continue
+        summary = read_summary(os.path.join(save_path,
+                                            name[:-len(SUMMARY_SUFFIX)]))
+        if summary is None:
+            continue
+        prefix, day = m.group(1), m.group(2)
+        if (prefix, day) not in summaries:
+            summaries[(prefix, day)] = HourSummary()
+            hours[(prefix, day)] = 0
+        summaries[(prefix, day)].merge(summary)
+        hours[(prefix, day)] += 1
+
+    lines = [f"Tweets from {first} to {last} (UTC)"]
+    for prefix in sorted(set(p for p, _ in summaries)):
+        week = HourSummary()
+        lines += ["", prefix, f"  {'Day':<10}{'Hours':>7}{'Tweets':>12}"
+                              f"{'Geo':>8}"]
+        for (p, day), summary in sorted(summaries.items()):
+            if p != prefix:
+                continue
+            week.merge(summary)
+            lines.append(f"  {day:<10}{hours[(p, day)]:>7}"
+                         f"{summary.tweets:>12}"
+                         f"{summary.geo[1] / max(1, summary.tweets):>8.1%}")
+        num_hours = sum(h for (p, _), h in hours.items() if p == prefix)
+        lines.append(f"  {'Total':<10}{num_hours:>7}{week.tweets:>12}"
+                     f"{week.geo[1] / max(1, week.tweets):>8.1%}")
+        for dimension in SUMMARY_DIMENSIONS:
+            top = ", ".join(f"{value or '(none)'} "
+                            f"{count / max(1, week.tweets):.1%}"
+                            for value, count in week.top(dimension, 10))
+            lines.append(f"  Top {dimension}: {top}")
+        if week.shed > 0 or week.spilled > 0:
+            lines.append(f"  Shed under load: {week.shed} tweets, "
+                         f"written late: {week.spilled} tweets")
+        if week.min_lag is not None:
+            lines.append(f"  Delay: {week.min_lag:.1f} s to "
+                         f"{week.max_lag:.1f} s")
+    if len(summaries) == 0:
+        lines.append("No summaries")
+    return "\n".join(lines) + "\n"
+
+
 def worker(save_path: str) -> None:
     """ Check all files """
-    # Check if any tmp file is unfinished
-    finish_files(save_path)
+    global current, weekly_digest_file, __remote_files_fresh
+    current = datetime.now(tz = timezone.utc)  # Current UTC date
+    rotate_log()
+    # What is already on Google Drive, listed when first needed
+    __remote_files_fresh = False
+
+    # The space manager does not compress or move files meanwhile
+    with __storage_lock:
+        # Merge the hourly files of the other hosts
+        if len(__source_dirs) > 0:
+            merge_sources(save_path)
+
+        # Bring the manifest up to date with the directory
+        tmp_names, raw_names, summary_names = reconcile(save_path)
 
-    # Find files to be zipped
-    zip_tweets(save_path)
+        # Check if any tmp file is unfinished
+        renamed = finish_files(save_path, tmp_names)
+
+        # Normalize raw files of the raw ingest mode
+        normalize_raw_files(save_path, raw_names +
+                            [n for n in renamed if RAW_PATTERN.match(n)])
+
+        # Fill the hours the crawler missed from the recent search
+        if __search is not None:
+            backfill(save_path)
+
+        # Find files to be zipped
+        zip_tweets(save_path)
 
     files_uploaded = []
     files_cleaned = []
+    to_sweep = []
 
     # Find files to be uploaded
     # Find all zips
-    for f in sorted(glob.glob(
-            os.path.join(save_path,
-                         "tweets-"
-                         # 4 digits year, 2 digits months and day
-                         "20[0-9][0-9][01][0-9][0-3][0-9].zip"))):
-        if os.path.isfile("{0}.ready".format(f)) \
-                and not os.path.isfile(f"{f}.uploaded") \
-                and not os.path.isfile(f"{f}.uploading"):
-            # Upload to Google Drive first, if successful, FILENAME.uploaded
-            # should be found
+    for zn, state in __manifest.execute(
+            "SELECT name, state FROM archives WHERE state != 'cleaned' "
+            "ORDER BY name").fetchall():
+        f = os.path.join(save_path, zn)
+        if state == "ready":
+            # Upload to Google Drive first, if successful, the manifest
+            # should mark it as uploaded
             if upload_to_google_drive(f):
-                files_uploaded.append(os.path.basename(f))
-
-        if os.path.isfile(f"{f}.uploading"):
+                files_uploaded.append(zn)
+        elif state == "uploading":
             # The zip file is being uploaded or aborted at some place,
             # try re-upload
             fdate = zipname_to_datetime(f)  # UTC date of the zip file
             if (current - fdate).days >= 2:
                 # Only retry after 2 days
-                # Restore the flag file
-                os.rename(f"{f}.uploading", f"{f}.ready")
+                # Restore the ready state
+                set_archive_state(zn, "ready", "uploading")
                 # Re-upload
                 if upload_to_google_drive(f):
-                    files_uploaded.append(os.path.basename(f))
+                    files_uploaded.append(zn)
 
-        if os.path.isfile(f"{f}.uploaded"):
+        if get_archive_state(zn) == "uploaded":
             # The zip file had been uploaded
             fdate = zipname_to_datetime(f)  # UTC date of the zip file
             if __keep_days is not None and __keep_days > 0:
                 # Sweeping is enabled
                 if (current - fdate).days > __keep_days:
                     # The file is too old
-                    os.remove(f)  # Remove the zip file
-                    os.remove(f"{f}.uploaded")  # Remove the flag file
-                    cout(f"Cleaned {os.path.basename(f)}")
-                    files_cleaned.append(os.path.basename(f))
-
-    # Clean some junk files
-    for f in sorted(glob.glob(
-            os.path.join(save_path,
-                         "tweets-"
-                         # 4 digits year, 2 digits months and day
-                         "20[0-9][0-9][01][0-9][0-3][0-9].zip.ready"))):
-        zipf = f[:-6]  # zip file
-        if not os.path.isfile(zipf):
-            os.remove(f)  # Remove the flag file if the zip file does not exist
-            cout(f"Cleaned {os.path.basename(f)}")
-            files_cleaned.append(os.path.basename(f))
-    for f in sorted(glob.glob(
-            os.path.join(save_path,
-                         "tweets-"
-                         # 4 digits year, 2 digits months and day
-                         "20[0-9][0-9][01][0-9][0-3][0-9].zip.uploaded"))):
-        zipf = f[:-9]  # zip file
-        if not os.path.isfile(zipf):
-            os.remove(f)  # Remove the flag file if the zip file does not exist
-            cout(f"Cleaned {os.path.basename(f)}")
-            files_cleaned.append(os.path.basename(f))
-        basef = zipf[:-4]
-        for ef in glob.glob(os.path.join(basef + "-[0-2][0-9]")):
-            if os.path.getsize(ef) == 0:
-                os.remove(ef)
-    for f in sorted(glob.glob(
-            os.path.join(save_path,
-                         "tweets-"
-                         # 4 digits year, 2 digits months and day
-                         "20[0-9][0-9][01][0-9][0-3][0-9].zip.uploading"))):
-        zipf = f[:-10]  # zip file
-        if not os.path.isfile(zipf):
-            os.remove(f)  # Remove the flag file if the zip file does not exist
-            cout(f"Cleaned {os.path.basename(f)}")
-            files_cleaned.append(os.path.basename(f))
-
-    # Only report a digest of the whole week on Sunday
-    if datetime.today().isoweekday() == 7 and len(
-            weekly_digest_file) > 0 and os.path.isfile(weekly_digest_file):
-        send_email(f"[TweetCrawler]: Weekly Digest", "", [weekly_digest_file, ])
+                    to_sweep.append(zn)
+
+    # Never remove the only copy, the copies are checked together
+    for zn, verified in verify_remote_copies(to_sweep).items():
+        if verified is None:
+            cout(f"The copy of {zn} cannot be checked, keeping it")
+        elif not verified:
+            cerr(f"{zn} is not on Google Drive, uploading again")
+            set_archive_state(zn, "ready", "uploaded")
+        elif set_archive_state(zn, "cleaned", "uploaded"):
+            # Remove the zip file
+            os.remove(archive_path(save_path, zn))
+            cout(f"Cleaned {zn}")
+            files_cleaned.append(zn)
+
+    if len(__source_dirs) > 0:
+        sweep_sources()
+    trim_remote_archives()
+    if __drive is not None and __drive.calls > 0:
+        cout(f"Google Drive: {__drive.report()}")
+        __drive.reset()
+
+    # Only report a digest of the whole week on Sunday, when the log rotates
+    if datetime.today().isoweekday() == 7 and len(weekly_digest_file) > 0:
+        send_email(f"[TweetCrawler]: Weekly Digest",
+                   build_weekly_digest(save_path) +
+                   f"\nThe log of the week is {weekly_digest_file}\n")
+        weekly_digest_file = ""
+    sweep_summaries(save_path, summary_names)
+
+
+# Seconds between the checks of the free space in daemon mode
+SPACE_CHECK_INTERVAL = 60
+# Hourly files are compressed once the crawler and the zipper are done
+COMPRESS_MIN_AGE = 3 * 3600
+COMPRESS_MIN_IDLE = 3600
+GB = 1024 ** 3
+# Held while the files of working_dir are renamed, zipped, compressed or
+# moved
+__storage_lock = Lock()
+__last_space_alert = 0.0
+
+
+def record_action(db: sqlite3.Connection, action: str, name: str,
+                  detail: str) -> None:
+    """ Log an action of the space manager, or of the remote retention, in
+    the manifest """
+    with db:
+        db.execute("INSERT INTO storage_actions (time, action, name, detail) "
+                   "VALUES (?, ?, ?, ?)", (time.time(), action, name, detail))
+    cout(f"{action.capitalize()}: {detail}" if name is None
+         else f"{action.capitalize()} {name}: {detail}")
+
+
+def compress_hourly(db: sqlite3.Connection, save_path: str,
+                    name: str) -> bool:
+    """ Replace a finished hourly file with its gzip """
+    path = os.path.join(save_path, name)
+    part_path = f"{path}.gz.part"
+    size = os.path.getsize(path)
+    with open(path, "rb") as inf, gzip.open(part_path, "wb",
+                                            compresslevel = 6) as outf:
+        shutil.copyfileobj(inf, outf, 1048576)
+    os.rename(part_path, f"{path}.gz")
+    st = os.stat(f"{path}.gz")
+    with db:
+        cur = db.execute(
+            "UPDATE hourly SET stored = 'gzip', size = ?, mtime = ?, "
+            "updated = ? WHERE name = ? AND state = 'finished' "
+            "AND stored IS NULL", (st.st_size, st.st_mtime, time.time(), name))
+    if cur.rowcount == 0:
+        # Zipped or compressed meanwhile
+        os.remove(f"{path}.gz")
+        return False
+    os.remove(path)
+    record_action(db, "compressed", name, f"{size} to {st.st_size} bytes")
+    return True
+
+
+def move_archive(db: sqlite3.Connection, save_path: str, zn: str) -> bool:
+    """ Move a zip file to the secondary volume, checking the copy against
+    the MD5 computed while zipping """
+    src = os.path.join(save_path, zn)
+    dst = os.path.join(__secondary_dir, zn)
+    size = os.path.getsize(src)
+    if shutil.disk_usage(__secondary_dir).free < 2 * size:
+        cerr(f"Not enough space in {__secondary_dir} for {zn}")
+        return False
+    md5 = hashlib.md5()
+    with open(src, "rb") as inf, open(f"{dst}.part", "wb") as outf:
+        while True:
+            chunk = inf.read(1048576)
+            if not chunk:
+                break
+            md5.update(chunk)
+            outf.write(chunk)
+        outf.flush()
+        os.fsync(outf.fileno())
+    checksum = db.execute("SELECT checksum FROM archives WHERE name = ?",
+                          (zn,)).fetchone()[0]
+    if checksum is not None and md5.hexdigest() != checksum:
+        os.remove(f"{dst}.part")
+        cerr(f"MD5 of {zn} is {md5.hexdigest()}, expected {checksum}")
+        return False
+    os.rename(f"{dst}.part", dst)
+    with db:
+        cur = db.execute(
+            "UPDATE archives SET location = ?, updated = ? WHERE name = ? "
+            "AND location IS NULL AND state IN ('ready', 'uploaded')",
+            (__secondary_dir, time.time(), zn))
+    if cur.rowcount == 0:
+        # Being uploaded or cleaned meanwhile
+        os.remove(dst)
+        return False
+    os.remove(src)
+    record_action(db, "moved", zn, f"{size} bytes to {__secondary_dir}")
+    return True
+
+
+def manage_space(db: sqlite3.Connection, save_path: str) -> None:
+    """ Compress finished hourly files, then move zip files to the secondary
+    volume, while the free space of working_dir is below the thresholds.
+    Alert by email, at most once an hour, when it stays too low. """
+    global __last_space_alert
+    compress_below = __space_thresholds[KEY_COMPRESS_BELOW_GB]
+    move_below = __space_thresholds[KEY_MOVE_BELOW_GB]
+    alert_below = __space_thresholds[KEY_ALERT_BELOW_GB]
+    with __storage_lock:
+        free = shutil.disk_usage(save_path).free / GB
+        if free < compress_below:
+            now = time.time()
+            for name, mtime in db.execute(
+                    "SELECT name, mtime FROM hourly WHERE state = 'finished' "
+                    "AND stored IS NULL ORDER BY day, hour").fetchall():
+                age = (datetime.now(tz = timezone.utc) -
+                       filename_to_datetime(name)).total_seconds()
+                if age < COMPRESS_MIN_AGE or (
+                        mtime is not None and now - mtime < COMPRESS_MIN_IDLE):
+                    continue
+                compress_hourly(db, save_path, name)
+                free = shutil.disk_usage(save_path).free / GB
+                if free >= compress_below:
+                    break
+        if __secondary_dir is not None and free < move_below:
+            # Zip files already on Google Drive first, oldest first
+            for zn, in db.execute(
+                    "SELECT name FROM archives WHERE location IS NULL "
+                    "AND state IN ('ready', 'uploaded') "
+                    "ORDER BY state = 'ready', day").fetchall():
+                move_archive(db, save_path, zn)
+                free = shutil.disk_usage(save_path).free / GB
+                if free >= move_below:
+                    break
+    if free < alert_below and time.time() - __last_space_alert >= 3600:
+        __last_space_alert = time.time()
+        msg = (f"{save_path} has {free:.2f} GB free, below "
+               f"{alert_below:.2f} GB")
+        record_action(db, "alert", None, msg)
+        send_email(f"[TweetCrawler]: Low disk space", msg)
+
+
+def run_space_manager(save_path: str) -> None:
+    """ Check the free space of working_dir every minute, with a connection
+    to the manifest of its own """
+    db = sqlite3.connect(__manifest_path, timeout = 60)
+    while True:
+        try:
+            manage_space(db, save_path)
+        except Exception as ex:
+            cerr(f"Failed to manage the space of {save_path}: {ex}")
+        time.sleep(SPACE_CHECK_INTERVAL)
+
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class DirectoryWatcher:
+    """ Report names of files renamed into or written in a directory. Use
+    inotify when the platform supports it, otherwise poll the directory. """
+
+    def __init__(self, path: str, poll_interval: float = 30):
+        self.__path = path
+        self.__poll_interval = poll_interval
+        self.__fd = -1
+        self.__names = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            if libc.inotify_add_watch(fd, os.fsencode(path),
+                                      IN_MOVED_TO | IN_CLOSE_WRITE) < 0:
+                errno = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(errno, "inotify_add_watch failed")
+            self.__fd = fd
+        except (AttributeError, OSError, TypeError):
+            self.__names = set(os.listdir(path))
+
+    @property
+    def method(self) -> str:
+        return "inotify" if self.__fd >= 0 else "polling"
+
+    def wait(self, timeout: float) -> list:
+        """ Wait up to timeout seconds, return the names that changed """
+        if self.__fd < 0:
+            time.sleep(max(0.0, min(timeout, self.__poll_interval)))
+            names = set(os.listdir(self.__path))
+            changed = sorted(names - self.__names)
+            self.__names = names
+            return changed
+        readable, _, _ = select.select([self.__fd], [], [], max(0.0, timeout))
+        if len(readable) == 0:
+            return []
+        changed = []
+        try:
+            buf = os.read(self.__fd, 65536)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(buf):
+            _, _, _, length = INOTIFY_EVENT.unpack_from(buf, offset)
+            offset += INOTIFY_EVENT.size
+            name = buf[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if len(name) > 0:
+                changed.append(os.fsdecode(name))
+        return changed
+
+    def close(self) -> None:
+        if self.__fd >= 0:
+            os.close(self.__fd)
+            self.__fd = -1
+
+
+def run_daemon(save_path: str) -> None:
+    """ Keep running, check all files whenever the crawler finishes an hourly
+    file and at least once every interval """
+    watcher = DirectoryWatcher(save_path)
+    cout(f"Watching {save_path} ({watcher.method}), checking at least every "
+         f"{__daemon_interval} minutes")
+    if any(v > 0 for v in __space_thresholds.values()):
+        Thread(target = run_space_manager, args = (save_path,),
+               name = "space-manager", daemon = True).start()
+    next_check = 0.0
+    try:
+        while True:
+            now = time.monotonic()
+            if now >= next_check:
+                try:
+                    worker(save_path)
+                except Exception as ex:
+                    cerr(traceback.format_exc())
+                    send_email(f"[TweetCrawler]: Uploader failed", str(ex))
+                next_check = time.monotonic() + __daemon_interval * 60
+                continue
+            changed = watcher.wait(next_check - now)
+            if any(HOURLY_PATTERN.match(n) or RAW_PATTERN.match(n)
+                   for n in changed):
+                # The crawler renames all finished files at about the same
+                # time, give it a few seconds before checking
+                time.sleep(5)
+                watcher.wait(0)
+                next_check = 0.0
+    finally:
+        watcher.close()
+
+
+def setup(setting_path: str, daemon: bool = False) -> None:
+    """ Read the settings, open the log and the manifest. Exit if the
+    settings cannot be used. Google Drive is only authorized when it is
+    first used, and the log is only rotated by worker(). """
+    global __setting_path, __daemon, __working_dir, __log_path, \
+        __gdrive_client_secret, __gdrive_settings, __gdrive_folder_id, \
+        __gdrive_api_root, __keep_days, __remote_keep_days, __dedup, \
+        __manifest_path, \
+        __daemon_interval, __crawler_settings, __normalize_processes, \
+        __secondary_dir, __source_dirs, __backfill_below, \
+        __twitter_api_root, __search, __backfill_queries, __archive_codec, \
+        __email_address, __email_name, \
+        __email_password, __email_smtp, __email_port, __email_ssl, \
+        __email_recipients, __profile, __manifest
+    __setting_path = setting_path
+    __daemon = daemon
+    try:
+        settings = read_settings(__setting_path, UPLOADER_SETTINGS)
+    except (OSError, SettingsError) as e:
+        print(f"Cannot read {__setting_path}: {e}", file = sys.stderr)
+        sys.exit(-1)
+    __working_dir = settings[KEY_WORKING_DIR]
+    __log_path = settings[KEY_LOG_File]
+    __gdrive_client_secret = settings[KEY_GOOGLE_DRIVE_CLIENT_SECRETS_JSON]
+    __gdrive_settings = settings[KEY_GOOGLE_DRIVE_TOKEN_PICKLE]
+    __gdrive_folder_id = settings[KEY_GOOGLE_DRIVE_FOLDER_ID]
+    __gdrive_api_root = settings[KEY_GOOGLE_DRIVE_API_ROOT]
+    __keep_days = settings[KEY_KEEP_FILES_FOR_DAYS]
+    __remote_keep_days = settings[KEY_REMOTE_KEEP_DAYS]
+    __dedup = settings[KEY_DEDUPLICATE]
+    __manifest_path = settings[KEY_MANIFEST_PATH]
+    __daemon_interval = settings[KEY_DAEMON_INTERVAL]
+    __crawler_settings = settings[KEY_CRAWLER_SETTINGS]
+    __normalize_processes = settings[KEY_NORMALIZE_PROCESSES]
+    __secondary_dir = settings[KEY_SECONDARY_DIR]
+    __source_dirs = settings[KEY_SOURCE_DIRS]
+    __backfill_below = settings[KEY_BACKFILL_BELOW]
+    __twitter_api_root = settings[KEY_TWITTER_API_ROOT]
+    __archive_codec = settings[KEY_ARCHIVE_CODEC]
+    for key in __space_thresholds:
+        __space_thresholds[key] = settings[key]
+    __email_address = settings[KEY_EMAIL_ADDRESS]
+    __email_name = settings[KEY_EMAIL_NAME]
+    __email_password = settings[KEY_EMAIL_PASSWORD]
+    __email_smtp = settings[KEY_EMAIL_SMTP]
+    __email_port = settings[KEY_EMAIL_PORT]
+    __email_ssl = settings[KEY_EMAIL_SSL]
+    __email_recipients = settings[KEY_EMAIL_RECIPIENTS]
+
+    if __working_dir is None:
+        print(f"{KEY_WORKING_DIR} is not set", file = sys.stderr)
+        sys.exit(-1)
+
+    # Zips are only trashed on Google Drive after they are swept, or the
+    # sweeper would upload them again
+    if __remote_keep_days > 0 and __keep_days is not None and \
+            __keep_days >= __remote_keep_days:
+        print(f"{KEY_REMOTE_KEEP_DAYS} must be more than "
+              f"{KEY_KEEP_FILES_FOR_DAYS}", file = sys.stderr)
+        sys.exit(-1)
+
+    if __manifest_path is None:
+        __manifest_path = os.path.join(__working_dir,
+                                       "tweets-manifest.sqlite3")
+
+    # Raw files of the crawler are normalized with its projection profile
+    __profile = get_profile({"full": {}}, "full")
+    if __crawler_settings is not None:
+        try:
+            __profile = get_profile(*read_profiles(__crawler_settings))
+        except (OSError, ValueError) as e:
+            print(f"Invalid setting ({KEY_CRAWLER_SETTINGS}): {e}",
+                  file = sys.stderr)
+            sys.exit(-1)
+
+    if __archive_codec == "zstd":
+        try:
+            require_zstd()
+        except ValueError as e:
+            print(f"Invalid setting ({KEY_ARCHIVE_CODEC}): {e}",
+                  file = sys.stderr)
+            sys.exit(-1)
+
+    # Backfill with the token and the queries of the crawler streams
+    if __backfill_below > 0:
+        if __crawler_settings is None:
+            print(f"{KEY_BACKFILL_BELOW} needs {KEY_CRAWLER_SETTINGS}",
+                  file = sys.stderr)
+            sys.exit(-1)
+        try:
+            token = read_settings(__crawler_settings,
+                                  [Setting(KEY_TWITTER_BEAR_TOKEN)],
+                                  False)[KEY_TWITTER_BEAR_TOKEN]
+            streams = read_streams(__crawler_settings)
+        except (OSError, ValueError) as e:
+            print(f"Invalid setting ({KEY_CRAWLER_SETTINGS}): {e}",
+                  file = sys.stderr)
+            sys.exit(-1)
+        if token is None:
+            print(f"{KEY_TWITTER_BEAR_TOKEN} is not set in "
+                  f"{__crawler_settings}", file = sys.stderr)
+            sys.exit(-1)
+        __backfill_queries = {}
+        for stream in streams.values():
+            if stream["backfill_query"] is not None:
+                __backfill_queries[stream["prefix"]] = \
+                    [stream["backfill_query"]]
+            elif len(stream["rules"]) > 0:
+                __backfill_queries[stream["prefix"]] = \
+                    sorted(set(stream["rules"].values()))
+        __search = SearchClient(token, __twitter_api_root)
+
+    if __gdrive_client_secret is None:
+        print(f"{KEY_GOOGLE_DRIVE_CLIENT_SECRETS_JSON} is not set",
+              file = sys.stderr)
+        sys.exit(-1)
+
+    if __gdrive_settings is None:
+        print(f"{KEY_GOOGLE_DRIVE_TOKEN_PICKLE} is not set",
+              file = sys.stderr)
+        sys.exit(-1)
+
+    open_log()
+
+    if __gdrive_folder_id is None:
+        cout("Files will be uploaded to Google Drive's root")
+
+    # Email
+    if __email_address is None or __email_smtp is None \
+            or __email_port < 1 \
+            or __email_recipients is None or len(__email_recipients) == 0:
+        __email_address = None
+        __email_name = None
+        __email_password = None
+        __email_smtp = None
+        __email_port = -1
+        __email_recipients = None
+
+    try:
+        __manifest = sqlite3.connect(__manifest_path, timeout = 60)
+        __manifest.executescript(MANIFEST_SCHEMA)
+        __manifest.commit()
+        os.chmod(__manifest_path, 0o644)
+    except BaseException as be:
+        cerr(f"Failed to open manifest {__manifest_path}: {be}")
+        sys.exit(-1)
+
+    if __keep_days is None or __keep_days == 0:
+        cout("All zip files will be kept")
+    else:
+        last_date = (current - timedelta(days = __keep_days)).strftime(
+            "%Y-%m-%d")
+        cout(f"Zip files older than {last_date} "
+             f"(excluding {last_date}) will be removed")
+
+
+def main() -> None:
+    if len(sys.argv) not in (2, 3) or \
+            (len(sys.argv) == 3 and sys.argv[2] != "--daemon"):
+        print(f"Usage: {os.path.basename(__file__)} SETTINGS_FILE [--daemon]")
+        sys.exit(0)
+    setting_path = os.path.abspath(sys.argv[1])
+    if not os.path.isfile(setting_path):
+        print(f"Cannot find {setting_path}", file = sys.stderr)
+        sys.exit(-1)
+    t = time.perf_counter()
+    setup(setting_path, len(sys.argv) == 3)
+    cout(f"Started in {time.perf_counter() - t:.3f} s")
+    if __daemon:
+        run_daemon(__working_dir)
+    else:
+        if any(v > 0 for v in __space_thresholds.values()):
+            manage_space(__manifest, __working_dir)
+        worker(__working_dir)
 
 
 if __name__ == "__main__":
-    worker(__working_dir)
+    main()
@@ -0,0 +1,105 @@
+""" The scripts are imported from Scripts/, as they import each other """
+
+import os
+import pickle
+import sys
+
+import pytest
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "Scripts")
+sys.path.insert(0, SCRIPTS)
+
+from standins import DriveStandIn, SearchStandIn  # noqa: E402
+
+
+# Module state of the crawler, kept between the tests of this process
+CRAWLER_STATE = ("__file_stats", "__open_files", "__recent_ids",
+                 "__handed_ids", "__raw_ids", "__file_counts",
+                 "__file_summaries", "__file_shed")
+CRAWLER_FLAGS = {"__handing_off": False, "__handed_off": False,
+                 "__writes_in_flight": 0, "__handed_until": 0}
+
+
+@pytest.fixture(autouse = True)
+def crawler_state():
+    """ Start and leave every test with a crawler that holds no file, no
+    tweet id and no handoff """
+    import TweetCrawler
+
+    def reset() -> None:
+        TweetCrawler.close_all_files()
+        for name in CRAWLER_STATE:
+            getattr(TweetCrawler, name).clear()
+        for name, value in CRAWLER_FLAGS.items():
+            setattr(TweetCrawler, name, value)
+
+    reset()
+    yield
+    reset()
+
+
+@pytest.fixture
+def drive():
+    stand_in = DriveStandIn()
+    yield stand_in
+    stand_in.close()
+
+
+@pytest.fixture
+def search():
+    stand_in = SearchStandIn()
+    yield stand_in
+    stand_in.close()
+
+
+def drive_credentials(tmp_path) -> tuple:
+    """ Client secrets and a valid token of Google Drive, for the stand-in """
+    from google.oauth2.credentials import Credentials
+
+    secrets = tmp_path / "client_secrets.json"
+    secrets.write_text("{}")
+    token = tmp_path / "token.pickle"
+    with open(token, "wb") as outf:
+        pickle.dump(Credentials(token = "token"), outf)
+    (tmp_path / "tweets").mkdir()
+    return secrets, token
+
+
+def write_settings(tmp_path, drive, secrets, token, settings: dict) -> str:
+    values = {"working_dir": tmp_path / "tweets",
+              "log_file": tmp_path / "uploader.log",
+              "google_drive_client_secrets_json": secrets,
+              "google_drive_token_pickle": token,
+              "google_drive_api_root": drive.url, **settings}
+    path = tmp_path / "uploader_settings.txt"
+    path.write_text("".join(f"{k}={v}\n" for k, v in values.items()
+                            if v is not None))
+    return str(path)
+
+
+@pytest.fixture
+def uploader(tmp_path, drive):
+    """ Set up the uploader in this process with settings against the Drive
+    stand-in, return the module """
+    pytest.importorskip("googleapiclient")
+    import UploaderAndSweeper
+
+    secrets, token = drive_credentials(tmp_path)
+
+    def start(**settings):
+        manifest = getattr(UploaderAndSweeper, "__manifest")
+        if manifest is not None:
+            manifest.close()
+        # A new process, as far as Google Drive is concerned
+        for name in ("__drive", "__gdrive_dir_name", "__gdrive_root_id",
+                     "__remote_files", "__remote_files_fresh"):
+            setattr(UploaderAndSweeper, name, None)
+        UploaderAndSweeper.setup(
+            write_settings(tmp_path, drive, secrets, token, settings))
+        return UploaderAndSweeper
+
+    yield start
+    manifest = getattr(UploaderAndSweeper, "__manifest")
+    if manifest is not None:
+        manifest.close()
@@ -0,0 +1,302 @@
+""" Local HTTP stand-ins of the services the scripts use, each one serving
+on 127.0.0.1 from a thread of its own """
+
+import email
+import hashlib
+import json
+import re
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+
+class StandIn:
+    """ HTTP server calling handle(method, path, headers, body) for every
+    request, which returns the status, headers and body of the response """
+
+    def __init__(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def respond(self) -> None:
+                size = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(size) if size > 0 else b""
+                status, headers, data = stand_in.handle(
+                    self.command, self.path, self.headers, body)
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = respond
+
+        self.lock = Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self.thread = Thread(target = self.server.serve_forever, daemon = True)
+        self.thread.start()
+
+    def handle(self, method: str, path: str, headers, body: bytes):
+        raise NotImplementedError
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def json_response(status: int, obj, headers: dict = None):
+    data = b"" if obj is None else json.dumps(obj).encode("utf-8")
+    return status, {"Content-Type": "application/json", **(headers or {})}, \
+        data
+
+
+def error(status: int, message: str):
+    return json_response(status, {"error": {"code": status,
+                                            "message": message}})
+
+
+class DriveStandIn(StandIn):
+    """ Google Drive v3 as the uploader uses it: files get, list, update and
+    delete, resumable uploads, the changes feed and the batch endpoint.
+    Lists and changes are returned in pages of page_size. Page tokens of the
+    changes are indexes in the changes; those before expired_before are
+    refused. """
+
+    ROOT_ID = "0AROOTFOLDER"
+
+    def __init__(self, page_size: int = 2):
+        self.files = {}
+        self.changes = []
+        self.expired_before = 0
+        self.page_size = page_size
+        # (method, path) of every request, and the size of every batch
+        self.requests = []
+        self.batches = []
+        # Statuses to answer the next requests of a file id with, in turn
+        self.faults = {}
+        # Metadata of the uploads in progress, and if the bytes received are
+        # altered on the way
+        self.uploads = {}
+        self.corrupt_uploads = False
+        self.__next_id = 0
+        super().__init__()
+
+    def add_file(self, name: str, parent: str = None, md5: str = "0" * 32,
+                 size: int = 1, fid: str = None) -> str:
+        with self.lock:
+            self.__next_id += 1
+            fid = fid or f"file{self.__next_id}"
+            self.files[fid] = {"id": fid, "name": name, "size": str(size),
+                               "md5Checksum": md5,
+                               "parents": [parent or self.ROOT_ID],
+                               "trashed": False}
+            self.changes.append(fid)
+        return fid
+
+    def update_file(self, fid: str, **fields) -> None:
+        with self.lock:
+            self.files[fid].update(fields)
+            self.changes.append(fid)
+
+    def expire_tokens(self) -> None:
+        self.expired_before = len(self.changes)
+
+    def handle(self, method: str, path: str, headers, body: bytes):
+        if urllib.parse.urlparse(path).path.rstrip("/") == "/batch/drive/v3":
+            return self.handle_batch(headers, body)
+        return self.handle_one(method, path, body)
+
+    def handle_one(self, method: str, path: str, body: bytes):
+        url = urllib.parse.urlparse(path)
+        query = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+        with self.lock:
+            self.requests.append((method, url.path))
+            return self.__route(method, url.path, query, body)
+
+    def __route(self, method: str, path: str, query: dict, body: bytes):
+        if path == "/upload/drive/v3/files":
+            return self.__upload(method, query, body)
+        if path == "/changes/startPageToken":
+            return json_response(200, {"startPageToken":
+                                       str(len(self.changes))})
+        if path == "/changes":
+            start = int(query["pageToken"])
+            if start < self.expired_before or start > len(self.changes):
+                return error(404, "Page token is no longer valid")
+            end = min(start + self.page_size, len(self.changes))
+            page = []
+            for fid in self.changes[start:end]:
+                file = self.files.get(fid)
+                page.append({"fileId": fid, "removed": file is None,
+                             **({} if file is None else {"file": file})})
+            result = {"changes": page}
+            if end < len(self.changes):
+                result["nextPageToken"] = str(end)
+            else:
+                result["newStartPageToken"] = str(end)
+            return json_response(200, result)
+        if path == "/files" and method == "GET":
+            parent = re.match(r"^'([^']+)' in parents", query["q"]).group(1)
+            listed = sorted((f for f in self.files.values()
+                             if parent in f["parents"] and not f["trashed"]),
+                            key = lambda f: f["id"])
+            start = int(query.get("pageToken", 0))
+            end = start + self.page_size
+            result = {"files": [{k: f[k] for k in ("id", "name", "size",
+                                                   "md5Checksum")}
+                                for f in listed[start:end]]}
+            if end < len(listed):
+                result["nextPageToken"] = str(end)
+            return json_response(200, result)
+        match = re.match(r"^/files/([^/]+)$", path)
+        if match is None:
+            return error(404, f"No route {method} {path}")
+        fid = match.group(1)
+        faults = self.faults.get(fid, [])
+        if len(faults) > 0:
+            return error(faults.pop(0), "Injected fault")
+        if fid == "root":
+            return json_response(200, {"id": self.ROOT_ID})
+        if fid not in self.files:
+            return error(404, f"File not found: {fid}")
+        if method == "PATCH":
+            self.files[fid].update(json.loads(body or b"{}"))
+            self.changes.append(fid)
+        elif method == "DELETE":
+            del self.files[fid]
+            self.changes.append(fid)
+            return 204, {}, b""
+        return json_response(200, self.files[fid])
+
+    def __upload(self, method: str, query: dict, body: bytes):
+        """ Start a resumable upload with the metadata, or finish it with
+        all the bytes at once """
+        if method == "POST":
+            upload_id = str(len(self.uploads))
+            self.uploads[upload_id] = json.loads(body or b"{}")
+            return json_response(200, None, {
+                "Location": f"{self.url}upload/drive/v3/files?"
+                            f"uploadType=resumable&upload_id={upload_id}"})
+        metadata = self.uploads.pop(query["upload_id"])
+        if self.corrupt_uploads:
+            body = body[:-1] + bytes([body[-1] ^ 1])
+        self.__next_id += 1
+        fid = f"file{self.__next_id}"
+        self.files[fid] = {"id": fid, "name": metadata["name"],
+                           "size": str(len(body)),
+                           "md5Checksum": hashlib.md5(body).hexdigest(),
+                           "parents": metadata.get("parents",
+                                                   [self.ROOT_ID]),
+                           "trashed": False}
+        self.changes.append(fid)
+        return json_response(200, self.files[fid])
+
+    def handle_batch(self, headers, body: bytes):
+        """ Answer every part of a multipart/mixed batch as a request of its
+        own """
+        message = email.message_from_bytes(
+            f"Content-Type: {headers['Content-Type']}\r\n\r\n".encode(
+                "utf-8") + body)
+        parts = message.get_payload()
+        with self.lock:
+            self.batches.append(len(parts))
+        boundary = "batch_response_boundary"
+        out = []
+        for part in parts:
+            content_id = part["Content-ID"].strip("<>")
+            request = part.get_payload()
+            if isinstance(request, list):
+                request = request[0].as_string()
+            head, _, inner_body = request.replace("\r\n", "\n").partition(
+                "\n\n")
+            method, path, _ = head.split("\n", 1)[0].split(" ", 2)
+            status, _, data = self.handle_one(
+                method, path, inner_body.strip().encode("utf-8"))
+            out.append(f"--{boundary}\r\n"
+                       f"Content-Type: application/http\r\n"
+                       f"Content-ID: <response-{content_id}>\r\n\r\n"
+                       f"HTTP/1.1 {status} Status\r\n"
+                       f"Content-Type: application/json\r\n"
+                       f"Content-Length: {len(data)}\r\n\r\n".encode("utf-8")
+                       + data + b"\r\n")
+        out.append(f"--{boundary}--\r\n".encode("utf-8"))
+        return 200, {"Content-Type":
+                     f"multipart/mixed; boundary={boundary}"}, b"".join(out)
+
+
+class SearchStandIn(StandIn):
+    """ Recent search of the Twitter API v2: the tweets added for a query
+    between the start and end times, in pages of page_size chained by a
+    next_token. Every response has the rate-limit headers; budget requests
+    are answered in a window of window seconds, the next ones are refused
+    with 429 until it ends. """
+
+    def __init__(self, page_size: int = 2, budget: int = 180,
+                 window: float = 900.0):
+        self.tweets = []
+        self.page_size = page_size
+        self.budget = budget
+        self.window = window
+        self.remaining = budget
+        self.reset = time.time() + window
+        # Parameters of every request
+        self.requests = []
+        super().__init__()
+
+    def start_window(self, budget: int, window: float) -> None:
+        with self.lock:
+            self.budget = self.remaining = budget
+            self.window = window
+            self.reset = time.time() + window
+
+    def add_tweet(self, query: str, tweet_id: int, created_at,
+                  lang: str = "en") -> None:
+        with self.lock:
+            self.tweets.append((query, {
+                "id": str(tweet_id), "text": f"Tweet {tweet_id}",
+                "author_id": "1", "lang": lang,
+                "created_at": created_at.strftime("%Y-%m-%dT%H:%M:%S.000Z")}))
+
+    def handle(self, method: str, path: str, headers, body: bytes):
+        url = urllib.parse.urlparse(path)
+        if url.path != "/2/tweets/search/recent":
+            return error(404, f"No route {method} {url.path}")
+        if headers.get("Authorization") != "Bearer token":
+            return error(401, "Unauthorized")
+        query = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+        with self.lock:
+            now = time.time()
+            if now >= self.reset:
+                self.remaining = self.budget
+                self.reset = now + self.window
+            limits = {"x-rate-limit-limit": str(self.budget),
+                      "x-rate-limit-reset": str(self.reset)}
+            if self.remaining == 0:
+                limits["x-rate-limit-remaining"] = "0"
+                return json_response(429, {"title": "Too Many Requests"},
+                                     limits)
+            self.remaining -= 1
+            limits["x-rate-limit-remaining"] = str(self.remaining)
+            self.requests.append(query)
+            found = [t for q, t in self.tweets if q == query["query"] and
+                     query["start_time"] <= t["created_at"][:19] + "Z" <
+                     query["end_time"]]
+        start = int(query.get("next_token", "page0")[len("page"):])
+        end = start + self.page_size
+        page = found[start:end]
+        result = {"meta": {"result_count": len(page)}}
+        if len(page) > 0:
+            result["data"] = page
+            result["includes"] = {"users": [{"id": "1", "name": "User",
+                                             "username": "user"}]}
+        if end < len(found):
+            result["meta"]["next_token"] = f"page{end}"
+        return json_response(200, result, limits)
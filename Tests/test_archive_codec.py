@@ -0,0 +1,78 @@
+""" Zips of the zstd codec, written by the uploader and read back as the
+reprocessing reads them """
+
+import json
+import os
+import time
+import zipfile
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from ArchiveCodec import DICT_PATTERN, FRAME_SIZE, ZSTD_SUFFIX, \
+    dictionary_name, open_member
+
+DAY = datetime.now(tz = timezone.utc) - timedelta(days = 3)
+DICT_ID = 7
+
+
+def hour_text(hour: int) -> bytes:
+    lines = [json.dumps({"data": {"id": str(tid), "text": "Tweet",
+                                  "lang": "en"}}) + "\n"
+             for tid in range(hour * 100 + 1, hour * 100 + 101)]
+    if hour == 5:
+        # One line longer than a frame
+        lines.insert(50, json.dumps({"data": {
+            "id": "9999", "text": "x" * (FRAME_SIZE + 100000)}}) + "\n")
+    return "".join(lines).encode("utf-8")
+
+
+@pytest.fixture
+def zstd_zip(uploader, tmp_path):
+    """ Zip a day with the zstd codec and a dictionary of the manifest,
+    return the path of the zip """
+    pytest.importorskip("zstandard")
+    up = uploader(archive_codec = "zstd")
+    save_path = str(tmp_path / "tweets")
+    dictionary = hour_text(0)
+    with getattr(up, "__manifest") as manifest:
+        manifest.execute(
+            "INSERT INTO dictionaries (id, prefix, hours, samples, data, "
+            "created) VALUES (?, 'tweets', 24, 100, ?, ?)",
+            (DICT_ID, dictionary, time.time()))
+    for hour in range(24):
+        name = f"tweets-{DAY:%Y%m%d}-{hour:02d}"
+        with open(os.path.join(save_path, name), "wb") as outf:
+            outf.write(hour_text(hour))
+        up.record_hourly(save_path, name)
+    up.zip_tweets(save_path)
+    assert getattr(up, "__manifest").execute(
+        "SELECT codec, dictionary FROM archives").fetchone() == \
+        ("zstd", DICT_ID)
+    return os.path.join(save_path, f"tweets-{DAY:%Y%m%d}.zip")
+
+
+def test_zstd_members_read_back(zstd_zip):
+    with zipfile.ZipFile(zstd_zip) as zf:
+        assert zf.read(dictionary_name(DICT_ID)) == hour_text(0)
+        for hour in range(24):
+            name = f"tweets-{DAY:%Y%m%d}-{hour:02d}"
+            # Written to an unseekable file, the stored member has its
+            # sizes and CRC in a data descriptor after its frames
+            info = zf.getinfo(name + ZSTD_SUFFIX)
+            assert info.compress_type == zipfile.ZIP_STORED
+            assert info.flag_bits & 0x08
+            with open_member(zf, name) as zm:
+                assert zm.read() == hour_text(hour)
+    assert zipfile.ZipFile(zstd_zip).testzip() is None
+
+
+def test_zstd_members_need_their_dictionary(zstd_zip, tmp_path):
+    stripped = str(tmp_path / "stripped.zip")
+    with zipfile.ZipFile(zstd_zip) as zf, \
+            zipfile.ZipFile(stripped, "w") as out:
+        for info in zf.infolist():
+            if not DICT_PATTERN.match(info.filename):
+                out.writestr(info, zf.read(info))
+    with zipfile.ZipFile(stripped) as zf, pytest.raises(ValueError):
+        open_member(zf, f"tweets-{DAY:%Y%m%d}-00")
@@ -0,0 +1,126 @@
+""" Backfilling hours from the recent search stand-in """
+
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from RecentSearch import SearchClient
+from SegmentWriter import HourStats, read_integrity, write_integrity
+from TweetNormalizer import HourSummary, read_summary, tweet_facts, \
+    write_summary
+
+
+def start(uploader, search, tmp_path, streams: str):
+    """ Set up the uploader to backfill the streams of the crawler """
+    crawler_settings = tmp_path / "crawler_settings.txt"
+    crawler_settings.write_text(f"twitter_bear_token=token\n{streams}")
+    return uploader(crawler_settings = crawler_settings, backfill_below = 0.5,
+                    twitter_api_root = search.url)
+
+
+def last_hour() -> datetime:
+    """ The last hour the crawler has finished, the only one queued after
+    an hour known to the manifest """
+    return (datetime.now(tz = timezone.utc) - timedelta(minutes = 125)
+            ).replace(minute = 0, second = 0, microsecond = 0)
+
+
+def queue(up, name: str, *queries) -> None:
+    now = time.time()
+    manifest = getattr(up, "__manifest")
+    with manifest:
+        manifest.executemany(
+            "INSERT INTO backfill (name, query, lines, usual, state, created, "
+            "updated) VALUES (?, ?, 0, 0, 'queued', ?, ?)",
+            [(name, query, now, now) for query in queries])
+
+
+def read_ids(path) -> list:
+    with open(path) as inf:
+        return [int(json.loads(line)["data"]["id"]) for line in inf]
+
+
+def test_job_resumes_from_its_page_after_the_rate_limit(uploader, search,
+                                                         tmp_path):
+    up = start(uploader, search, tmp_path,
+               "streams=news\nstream.news.backfill_query=news\n")
+    manifest = getattr(up, "__manifest")
+    save_path = str(tmp_path / "tweets")
+    hour = last_hour()
+    name = f"news-{hour:%Y%m%d-%H}"
+    for i in range(5):
+        search.add_tweet("news", 1000 + i, hour + timedelta(minutes = i))
+    search.add_tweet("news", 999, hour - timedelta(minutes = 1))
+    search.start_window(2, 2.0)
+    queue(up, name, "news")
+
+    up.backfill(save_path)
+    assert [r.get("next_token") for r in search.requests] == [None, "page2"]
+    assert manifest.execute(
+        "SELECT state, next_token, requests, found FROM backfill"
+    ).fetchone() == ("queued", "page4", 2, 4)
+    assert dict(manifest.execute(
+        "SELECT key, value FROM remote_state WHERE key = 'search_remaining'"
+    )) == {"search_remaining": "0"}
+    assert not os.path.exists(os.path.join(save_path, name))
+
+    # A new run knows the budget is spent without asking
+    setattr(up, "__search", SearchClient("token", search.url))
+    up.backfill(save_path)
+    assert len(search.requests) == 2
+
+    time.sleep(max(0.0, search.reset - time.time()) + 0.1)
+    up.backfill(save_path)
+    assert [r.get("next_token") for r in search.requests] == \
+        [None, "page2", "page4"]
+    assert manifest.execute(
+        "SELECT state, requests, found FROM backfill").fetchone() == \
+        ("merged", 3, 5)
+    path = os.path.join(save_path, name)
+    assert read_ids(path) == list(range(1000, 1005))
+    assert read_integrity(path).lines == 5
+    assert read_summary(path).tweets == 5
+    assert not os.path.exists(path + up.BACKFILL_SUFFIX)
+
+
+def test_merge_skips_known_ids_and_updates_sidecars(uploader, search,
+                                                    tmp_path):
+    up = start(uploader, search, tmp_path,
+               "streams=news\nstream.news.rule.a=alpha\n"
+               "stream.news.rule.b=beta\n")
+    save_path = str(tmp_path / "tweets")
+    hour = last_hour()
+    name = f"news-{hour:%Y%m%d-%H}"
+    path = os.path.join(save_path, name)
+    # The hour the crawler saved, with its sidecars
+    stats = HourStats()
+    summary = HourSummary()
+    with open(path, "w") as outf:
+        for tid in (1, 2, 3):
+            tweet = {"data": {"id": str(tid), "lang": "en"}}
+            line = json.dumps(tweet) + "\n"
+            outf.write(line)
+            stats.add(line.encode("utf-8"), tid)
+            summary.add(tweet_facts(tweet))
+    write_integrity(path, stats)
+    write_summary(path, summary)
+    up.record_hourly(save_path, name)
+    # Both rules match tweet 4
+    for tid in (2, 3, 4):
+        search.add_tweet("alpha", tid, hour, "fr")
+    for tid in (4, 5):
+        search.add_tweet("beta", tid, hour, "fr")
+    queue(up, name, "alpha", "beta")
+
+    up.backfill(save_path)
+    assert read_ids(path) == [1, 2, 3, 4, 5]
+    expected = HourStats()
+    with open(path, "rb") as inf:
+        for line, tid in zip(inf, read_ids(path)):
+            expected.add(line, tid)
+    assert read_integrity(path).mismatches(expected) == []
+    merged = read_summary(path)
+    assert merged.tweets == 5
+    assert merged.to_dict()["lang"] == [["en", "fr"], [3, 2]]
+    assert not os.path.exists(path + up.BACKFILL_SUFFIX)
@@ -0,0 +1,81 @@
+""" The daemon mode of the uploader, woken up by the hourly files the
+crawler finishes """
+
+import os
+
+import pytest
+
+
+def test_watcher_reports_files_renamed_or_written(tmp_path):
+    from UploaderAndSweeper import DirectoryWatcher
+
+    watcher = DirectoryWatcher(str(tmp_path))
+    try:
+        assert watcher.method == "inotify"
+        assert watcher.wait(0) == []
+        (tmp_path / "tweets-20240101-05.tmp").write_text("tweet\n")
+        os.rename(tmp_path / "tweets-20240101-05.tmp",
+                  tmp_path / "tweets-20240101-05")
+        changed = watcher.wait(5)
+        assert "tweets-20240101-05" in changed
+    finally:
+        watcher.close()
+    watcher.close()
+
+
+def test_watcher_polls_without_inotify(tmp_path, monkeypatch):
+    import UploaderAndSweeper
+
+    def no_libc(*args, **kwargs):
+        raise OSError("No libc")
+
+    monkeypatch.setattr(UploaderAndSweeper.ctypes, "CDLL", no_libc)
+    (tmp_path / "old").write_text("")
+    watcher = UploaderAndSweeper.DirectoryWatcher(str(tmp_path), 0.01)
+    assert watcher.method == "polling"
+    (tmp_path / "tweets-20240101-05").write_text("tweet\n")
+    assert watcher.wait(1) == ["tweets-20240101-05"]
+    assert watcher.wait(1) == []
+
+
+class FakeWatcher:
+    """ Report the scripted names at each wait, stop the daemon after """
+
+    def __init__(self, changes: list):
+        self.changes = changes
+        self.closed = False
+        self.method = "fake"
+
+    def __call__(self, path: str):
+        return self
+
+    def wait(self, timeout: float) -> list:
+        if len(self.changes) == 0:
+            raise KeyboardInterrupt
+        return self.changes.pop(0)
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def test_daemon_checks_when_an_hour_is_finished(uploader, tmp_path,
+                                               monkeypatch):
+    up = uploader()
+    calls = []
+
+    def worker(save_path: str) -> None:
+        calls.append(save_path)
+        if len(calls) == 1:
+            raise RuntimeError("Failed once")
+
+    watcher = FakeWatcher([["tweets-20240101-05.tmp"], ["uploader.log"],
+                           ["tweets-20240101-05"], [],
+                           ["news-20240101-05.raw"], []])
+    monkeypatch.setattr(up, "worker", worker)
+    monkeypatch.setattr(up, "DirectoryWatcher", watcher)
+    monkeypatch.setattr(up.time, "sleep", lambda seconds: None)
+    with pytest.raises(KeyboardInterrupt):
+        up.run_daemon(str(tmp_path / "tweets"))
+    # At start, even after a failure, then once per batch of finished hours
+    assert len(calls) == 3
+    assert watcher.closed
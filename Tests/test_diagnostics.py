@@ -0,0 +1,36 @@
+""" The diagnostic signals of the crawler """
+
+import os
+import signal
+import time
+
+import TweetCrawler
+
+
+def test_signal_while_logging(tmp_path):
+    log_path = tmp_path / "crawler.log"
+    settings = tmp_path / "crawler_settings.txt"
+    settings.write_text(f"working_dir={tmp_path / 'tweets'}\n"
+                        f"twitter_bear_token=token\n"
+                        f"log_file={log_path}\n"
+                        f"profile_seconds=1\n")
+    TweetCrawler.setup(str(settings))
+    previous = signal.signal(signal.SIGUSR1,
+                             TweetCrawler.on_diagnostic_signal)
+    try:
+        # The signals arrive while the main thread is inside write_log
+        log_lock = getattr(TweetCrawler, "__log_lock")
+        with log_lock:
+            os.kill(os.getpid(), signal.SIGUSR1)
+            os.kill(os.getpid(), signal.SIGUSR1)
+            time.sleep(0.1)
+        end = time.monotonic() + 10
+        while time.monotonic() < end and \
+                "Wrote" not in log_path.read_text():
+            time.sleep(0.05)
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+    log = log_path.read_text()
+    assert "Running sample_cpu for 1s" in log
+    assert "Profiling is already running" in log
+    assert len(list((tmp_path / "tweets").glob("crawler-cpu-*.txt"))) == 1
@@ -0,0 +1,86 @@
+""" Batches of Google Drive requests, against the Drive stand-in """
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import DriveClient
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """ The waits before each retry, without waiting """
+    waits = []
+    monkeypatch.setattr(DriveClient.time, "sleep", waits.append)
+    return waits
+
+
+def get_requests(client, ids) -> list:
+    return [client.service.files().get(fileId = fid, fields = "id")
+            for fid in ids]
+
+
+def test_refused_requests_are_retried_in_the_next_batch(uploader, drive,
+                                                        sleeps):
+    ids = [drive.add_file(f"tweets-2024010{d}.zip", "folder")
+           for d in range(1, 5)]
+    drive.faults[ids[1]] = [429]
+    drive.faults[ids[2]] = [503]
+    client = uploader().get_drive()
+    results = client.execute_batch(get_requests(client, ids + ["missing"]))
+    assert [r["id"] for r, e in results[:4]] == ids
+    assert all(e is None for r, e in results[:4])
+    # Not found is not retried
+    assert results[4][0] is None
+    assert results[4][1].resp.status == 404
+    assert drive.batches == [5, 2]
+    assert sleeps == [2]
+    assert (client.requests, client.calls, client.batches) == (7, 2, 2)
+
+
+def test_retries_are_capped(uploader, drive, sleeps):
+    fid = drive.add_file("tweets-20240101.zip", "folder")
+    drive.faults[fid] = [500] * (DriveClient.BATCH_RETRIES + 2)
+    client = uploader().get_drive()
+    (response, exception), = client.execute_batch(
+        get_requests(client, [fid]))
+    assert response is None
+    assert exception.resp.status == 500
+    assert drive.batches == [1] * (DriveClient.BATCH_RETRIES + 1)
+    assert sleeps == [2, 4, 8]
+    assert drive.faults[fid] == [500]
+    assert client.report().startswith("4 requests in 4 calls (4 batched)")
+    client.reset()
+    assert client.report() == "0 requests in 0 calls (0 batched), 0.000 s"
+
+
+def test_old_zips_are_trashed_in_a_batch(uploader, drive, sleeps):
+    today = datetime.now(tz = timezone.utc)
+    old = [drive.add_file(f"tweets-{today - timedelta(days = d):%Y%m%d}.zip",
+                          "folder") for d in (40, 41, 42)]
+    recent = drive.add_file(f"tweets-{today - timedelta(days = 5):%Y%m%d}.zip",
+                            "folder")
+    other = drive.add_file("notes.txt", "folder")
+    drive.faults[old[1]] = [429]
+    drive.faults[old[2]] = [403]
+    up = uploader(google_drive_folder_id = "folder", keep_files_for_days = 2,
+                  remote_keep_days = 30)
+    manifest = getattr(up, "__manifest")
+    up.refresh_remote_files()
+    up.current = today
+    drive.batches.clear()
+    drive.requests.clear()
+    up.get_drive().reset()
+
+    up.trim_remote_archives()
+    assert [drive.files[fid]["trashed"] for fid in old] == \
+        [True, True, False]
+    assert not drive.files[recent]["trashed"]
+    assert drive.requests.count(("PATCH", f"/files/{old[0]}")) == 1
+    assert drive.batches == [3, 1]
+    assert up.get_drive().report().startswith("4 requests in 2 calls")
+    assert sorted(r[0] for r in manifest.execute(
+        "SELECT id FROM remote_files")) == sorted([old[2], recent, other])
+    assert sorted(r[0] for r in manifest.execute(
+        "SELECT name FROM storage_actions WHERE action = 'trash'")) == \
+        sorted(drive.files[fid]["name"] for fid in old[:2])
@@ -0,0 +1,108 @@
+""" The fan-out sink of the crawler, with consumers on localhost """
+
+import json
+import os
+import socket
+import tempfile
+import time
+from datetime import datetime
+from threading import Thread
+
+import pytest
+
+from TweetSinks import FanoutSink
+
+BUFFER = 200
+BURST = BUFFER // 2
+TIMESTAMP = datetime(2024, 1, 1, 5)
+
+
+def tweet(n: int, size: int = 1024) -> str:
+    return json.dumps({"data": {"id": str(10 ** 18 + n),
+                                "text": f"tweet {n} " + "x" * size}}) + "\n"
+
+
+@pytest.fixture(params = ["tcp", "unix"])
+def sink(request):
+    if request.param == "tcp":
+        address = "tcp:127.0.0.1:0"
+    else:
+        # The path of a Unix socket is short, tmp_path may be too long
+        sock_dir = tempfile.mkdtemp()
+        address = f"unix:{os.path.join(sock_dir, 'fanout.sock')}"
+    fanout = FanoutSink(address, BUFFER, lambda msg, error: print(msg))
+    yield fanout
+    fanout.close()
+    if request.param == "unix":
+        assert not os.path.exists(address[5:])
+
+
+def connect(sink, prefixes: str = None) -> socket.socket:
+    address = sink.address
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    conn = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_INET:
+        # A small window, so the stalled consumer is soon full
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    conn.connect(address)
+    if prefixes is not None:
+        conn.sendall(prefixes.encode("utf-8") + b"\n")
+    return conn
+
+
+def wait_for(condition, timeout: float = 10) -> bool:
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def test_stalled_consumer_is_dropped(sink):
+    fast = connect(sink, "a")
+    stalled = connect(sink)
+    assert wait_for(lambda: len(getattr(sink, "_FanoutSink__subscribers"))
+                    == 2)
+    # The subscription is read before the first tweet
+    time.sleep(0.2)
+    received = []
+
+    def read() -> None:
+        buf = b""
+        while True:
+            data = fast.recv(65536)
+            if len(data) == 0:
+                break
+            buf += data
+            *lines, buf = buf.split(b"\n")
+            received.extend(lines)
+
+    reader = Thread(target = read, daemon = True)
+    reader.start()
+
+    sent = 0
+    slowest = 0.0
+    while sink.dropped == 0 and sent < 50000:
+        for _ in range(BURST):
+            prefix = "a" if sent % 5 else "b"
+            t = time.perf_counter()
+            assert sink.write(TIMESTAMP, prefix, tweet(sent))
+            slowest = max(slowest, time.perf_counter() - t)
+            sent += 1
+        # The fast consumer never falls behind the buffer
+        expected = sum(1 for n in range(sent) if n % 5)
+        assert wait_for(lambda: len(received) == expected)
+
+    assert sink.dropped == 1
+    assert slowest < 0.5
+    # The stalled consumer is disconnected after what was sent to it
+    stalled.settimeout(10)
+    while stalled.recv(65536):
+        pass
+    stalled.close()
+    # Only the subscribed stream reached the fast consumer, in order
+    ids = [json.loads(line)["data"]["id"] for line in received]
+    assert ids == [str(10 ** 18 + n) for n in range(sent) if n % 5]
+    assert len(getattr(sink, "_FanoutSink__subscribers")) == 1
+    fast.close()
@@ -0,0 +1,95 @@
+""" The rolling restart of the crawler, on its side of each process """
+
+import json
+import os
+import socket
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+from threading import Thread
+
+import pytest
+
+import TweetCrawler
+
+
+@pytest.fixture
+def crawler(tmp_path):
+    settings = tmp_path / "crawler_settings.txt"
+    settings.write_text(
+        f"working_dir={tmp_path / 'tweets'}\n"
+        f"twitter_bear_token=token\n"
+        f"log_file={tmp_path / 'crawler.log'}\n"
+        f"control_socket={os.path.join(tempfile.mkdtemp(), 'control')}\n")
+    TweetCrawler.setup(str(settings))
+    return TweetCrawler
+
+
+# Tweets of hours already finished are not written
+HOUR = datetime.now(tz = timezone.utc).replace(minute = 0, second = 0,
+                                               microsecond = 0)
+
+
+def entry(tweet_id: int, hours_ago: int = 0) -> tuple:
+    return HOUR - timedelta(hours = hours_ago), "tweets", \
+        json.dumps({"data": {"id": str(tweet_id)}}) + "\n", "", \
+        str(tweet_id), None
+
+
+def test_handed_ids_are_skipped_then_released(crawler):
+    last = 1 << 60
+    handed = [str(last - 2), str(last)]
+    crawler.import_file_state([], handed)
+    assert not crawler.write_entry(*entry(last))
+    assert crawler.write_entry(*entry(last - 1))
+    # Still within the margin, tweets may arrive out of order
+    assert crawler.write_entry(*entry(last + crawler.HANDOFF_MARGIN))
+    assert not crawler.write_entry(*entry(last - 2))
+    # Past the margin, the ids are no longer kept
+    assert crawler.write_entry(*entry(last + crawler.HANDOFF_MARGIN + 1))
+    assert len(getattr(crawler, "__handed_ids")) == 0
+
+
+def test_hand_off_replies_and_exits(crawler, tmp_path):
+    crawler.write_entry(*entry(1000, 1))
+    crawler.write_entry(*entry(2000, 1))
+    ours, theirs = socket.socketpair()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            ours.close()
+            crawler.hand_off(theirs, 2000)
+        finally:
+            os._exit(1)
+    theirs.close()
+    reply = json.loads(ours.makefile("r").readline())
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert reply["ids"] == ["1000", "2000"]
+    assert [f["count"] for f in reply["files"]
+            if f["key"] == ["tweets", int((HOUR - timedelta(hours = 1))
+                                          .strftime("%y%m%d%H00"))]] == [2]
+    # The log was flushed before the exit
+    assert "tweets written since 2000" in \
+        (tmp_path / "crawler.log").read_text()
+
+
+def test_hand_off_waits_for_the_writes_in_progress(crawler, monkeypatch):
+    exits = []
+    monkeypatch.setattr(crawler.os, "_exit", exits.append)
+    assert crawler.begin_write()
+    ours, theirs = socket.socketpair()
+    thread = Thread(target = crawler.hand_off, args = (theirs, 0))
+    thread.start()
+    thread.join(0.2)
+    assert thread.is_alive()
+    # The write in progress goes on, the next tweets are refused
+    assert not crawler.save_tweet(entry(3000)[2])
+    assert crawler.write_entry(*entry(1000))
+    crawler.end_write()
+    thread.join(10)
+    assert exits == [0]
+    assert json.loads(ours.makefile("r").readline())["ids"] == ["1000"]
+    # No file is opened once the files are handed off
+    assert not crawler.write_entry(*entry(2000))
+    assert crawler.create_or_get_file(entry(2000)[0]) == (None, None)
@@ -0,0 +1,107 @@
+""" The integrity statistics of the hourly files, checked while zipping,
+and the MD5 of the zips checked against Google Drive """
+
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+from SegmentWriter import HourStats, read_integrity, write_integrity
+
+DAY = datetime.now(tz = timezone.utc) - timedelta(days = 3)
+
+
+def hour_lines(hour: int) -> list:
+    return [json.dumps({"data": {"id": str(tid)}}) + "\n"
+            for tid in range(hour * 10 + 1, hour * 10 + 11)]
+
+
+def stats_of(lines: list) -> HourStats:
+    stats = HourStats()
+    for line in lines:
+        stats.add(line.encode("utf-8"), int(json.loads(line)["data"]["id"]))
+    return stats
+
+
+def zip_day(up, save_path: str, corrupt: int = None) -> str:
+    """ Zip a day whose hours have integrity sidecars, one of them not
+    matching its file, return the name of the zip """
+    for hour in range(24):
+        path = os.path.join(save_path, f"tweets-{DAY:%Y%m%d}-{hour:02d}")
+        lines = hour_lines(hour)
+        write_integrity(path, stats_of(lines))
+        if hour == corrupt:
+            lines[3] = lines[3].replace("id", "ID")
+        with open(path, "w") as outf:
+            outf.writelines(lines)
+        up.record_hourly(save_path, os.path.basename(path))
+    up.zip_tweets(save_path)
+    return f"tweets-{DAY:%Y%m%d}.zip"
+
+
+def test_stats_of_appended_files_merge(tmp_path):
+    first, second = hour_lines(0), hour_lines(1)
+    merged = stats_of(first)
+    merged.merge(stats_of(second))
+    whole = stats_of(second + first)
+    assert merged.mismatches(whole) == []
+    assert (merged.lines, merged.min_id, merged.max_id) == (20, 1, 20)
+    # Read in chunks, without the ids
+    chunked = HourStats()
+    data = "".join(first + second).encode("utf-8")
+    for start in range(0, len(data), 7):
+        chunked.add_chunk(data[start:start + 7])
+    chunked.add_chunk(b"")
+    assert chunked.mismatches(whole, False) == []
+
+    path = str(tmp_path / "tweets-20240101-05")
+    assert read_integrity(path) is None
+    write_integrity(path, merged)
+    assert read_integrity(path).to_dict() == whole.to_dict()
+    with open(f"{path}.integrity", "w") as outf:
+        outf.write("{")
+    assert read_integrity(path) is None
+
+
+def test_mismatched_hours_are_recorded(uploader, tmp_path):
+    up = uploader()
+    save_path = str(tmp_path / "tweets")
+    zip_day(up, save_path, corrupt = 5)
+    verified = dict(getattr(up, "__manifest").execute(
+        "SELECT hour, verified FROM hourly"))
+    assert verified == {hour: int(hour != 5) for hour in range(24)}
+    assert not any(n.endswith(".integrity") for n in os.listdir(save_path))
+
+
+def test_upload_with_another_md5_is_not_kept(uploader, drive, tmp_path):
+    up = uploader()
+    manifest = getattr(up, "__manifest")
+    save_path = str(tmp_path / "tweets")
+    zn = zip_day(up, save_path)
+    drive.corrupt_uploads = True
+    assert not up.upload_to_google_drive(os.path.join(save_path, zn))
+    # The copy is deleted, and the zip uploaded again by the next run
+    assert drive.files == {}
+    assert up.get_archive_state(zn) == "ready"
+
+    drive.corrupt_uploads = False
+    assert up.upload_to_google_drive(os.path.join(save_path, zn))
+    (fid, file), = drive.files.items()
+    assert manifest.execute(
+        "SELECT state, remote_id, checksum FROM archives").fetchone() == \
+        ("uploaded", fid, file["md5Checksum"])
+
+
+def test_copies_are_verified_by_md5(uploader, drive, tmp_path):
+    up = uploader()
+    manifest = getattr(up, "__manifest")
+    save_path = str(tmp_path / "tweets")
+    zn = zip_day(up, save_path)
+    checksum = manifest.execute("SELECT checksum FROM archives").fetchone()[0]
+    fid = drive.add_file(zn, md5 = checksum)
+    with manifest:
+        manifest.execute("UPDATE archives SET remote_id = ?", (fid,))
+    assert up.verify_remote_copies([zn]) == {zn: True}
+    drive.update_file(fid, md5Checksum = "0" * 32)
+    assert up.verify_remote_copies([zn]) == {zn: False}
+    drive.update_file(fid, md5Checksum = checksum, trashed = True)
+    assert up.verify_remote_copies([zn]) == {zn: False}
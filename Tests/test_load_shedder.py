@@ -0,0 +1,126 @@
+""" The shed, spill and probe decisions of the load shedder, on a fake clock
+advanced by the writes """
+
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from TweetCrawler import LoadShedder
+
+HOUR = datetime(2024, 1, 1, 5)
+LATENCY = 0.010
+
+
+class FakeDisk:
+    """ Clock of the shedder, and writes taking latency seconds of it """
+
+    def __init__(self):
+        self.now = 0.0
+        self.latency = 0.0
+        self.written = []
+        self.threads = set()
+        self.counts = []
+        self.finished = set()
+
+    def clock(self) -> float:
+        return self.now
+
+    def write(self, timestamp, prefix, data, suffix, tweet_id, summary):
+        self.now += self.latency
+        self.written.append(tweet_id)
+        self.threads.add(threading.current_thread().name)
+        return True
+
+    def count(self, timestamp, prefix, suffix, shed, spilled) -> None:
+        self.counts.append((timestamp, shed, spilled))
+
+    def totals(self) -> tuple:
+        return sum(c[1] for c in self.counts), sum(c[2] for c in self.counts)
+
+
+@pytest.fixture
+def disk():
+    return FakeDisk()
+
+
+@pytest.fixture
+def shedder(disk):
+    def create(keep_rate: float = 0.5, max_bytes: int = 1 << 20):
+        created = LoadShedder(LATENCY, keep_rate, max_bytes, disk.write,
+                              disk.count, lambda t: t in disk.finished,
+                              lambda msg, error: None, disk.clock)
+        shedders.append(created)
+        return created
+    shedders = []
+    yield create
+    for created in shedders:
+        created.close()
+
+
+def entry(tweet_id: int, hour: datetime = HOUR) -> tuple:
+    return hour, "tweets", f"tweet {tweet_id}\n", "", str(tweet_id), None
+
+
+def start_shedding(shedder, disk) -> None:
+    """ One slow write is enough for the average to pass the latency """
+    disk.latency = 1.0
+    assert shedder.write(False, entry(0))
+    disk.latency = 0.0
+
+
+def wait_for(condition) -> None:
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+def test_slow_writes_spill_all_but_locations_and_probes(shedder, disk):
+    shed = shedder()
+    start_shedding(shed, disk)
+    assert shed.write(False, entry(1))
+    assert shed.write(True, entry(2))
+    assert shed.write(False, entry(3))
+    # A second after the last write, the next one is written to measure
+    disk.now += LoadShedder.PROBE_INTERVAL
+    assert shed.write(False, entry(4))
+    assert shed.write(False, entry(5))
+    assert disk.written == ["0", "2", "4"]
+    assert disk.totals() == (0, 0)
+
+
+def test_fast_writes_write_back_off_the_calling_thread(shedder, disk):
+    shed = shedder()
+    start_shedding(shed, disk)
+    for tweet_id in range(1, 4):
+        assert shed.write(False, entry(tweet_id))
+    # Fast writes of located tweets bring the average down
+    for tweet_id in range(100, 200):
+        shed.write(True, entry(tweet_id))
+    wait_for(lambda: disk.totals() == (0, 3))
+    assert [i for i in disk.written if int(i) < 100] == ["0", "1", "2", "3"]
+    assert "write-back" in disk.threads
+
+
+def test_full_buffer_keeps_a_share_and_sheds_the_rest(shedder, disk):
+    shed = shedder(keep_rate = 0.5, max_bytes = 1)
+    start_shedding(shed, disk)
+    assert shed.write(False, entry(1))  # Spilled, the buffer is now full
+    assert [shed.write(False, entry(i)) for i in range(2, 6)] == \
+        [False, True, False, True]
+    assert disk.written == ["0", "3", "5"]
+    assert disk.totals() == (2, 0)
+
+
+def test_spilled_tweets_of_finished_hours_are_shed(shedder, disk):
+    shed = shedder()
+    start_shedding(shed, disk)
+    later = datetime(2024, 1, 1, 6)
+    assert shed.write(False, entry(1))
+    assert shed.write(False, entry(2, later))
+    disk.finished.add(HOUR)
+    shed.close()
+    assert disk.written == ["0", "2"]
+    assert sorted(disk.counts) == [(HOUR, 1, 0), (later, 0, 1)]
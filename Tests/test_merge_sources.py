@@ -0,0 +1,56 @@
+""" Merging the hourly files of several crawler hosts """
+
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+
+def write_hour(path, ids, wrapped: bool = True) -> None:
+    with open(path, "w") as outf:
+        for tid in ids:
+            t = {"id": str(tid), "text": "x"}
+            outf.write(json.dumps({"data": t} if wrapped else t) + "\n")
+
+
+def test_merged_sources_are_recorded_and_swept(uploader, tmp_path):
+    hosts = [tmp_path / "host1", tmp_path / "host2"]
+    for host in hosts:
+        host.mkdir()
+    day = datetime.now(tz = timezone.utc) - timedelta(days = 10)
+    names = [f"tweets-{day:%Y%m%d}-{h:02d}" for h in range(24)]
+    for h, name in enumerate(names):
+        base = 10 ** 18 + h * 1000
+        write_hour(hosts[0] / name, range(base, base + 10))
+        # Tweets saved by an older version, not wrapped in "data"
+        write_hour(hosts[1] / name, range(base + 5, base + 15), h != 0)
+    up = uploader(source_dirs = ",".join(str(h) for h in hosts),
+                  keep_files_for_days = 2)
+    manifest = getattr(up, "__manifest")
+    save_path = str(tmp_path / "tweets")
+
+    up.merge_sources(save_path)
+    with open(os.path.join(save_path, names[0])) as inf:
+        assert len(inf.readlines()) == 15
+    assert manifest.execute(
+        "SELECT COUNT(*) FROM merged_sources WHERE state = 'merged'"
+    ).fetchone()[0] == 48
+
+    # The manifest lost the hours, they are not merged again
+    with manifest:
+        manifest.execute("DELETE FROM hourly")
+    up.merge_sources(save_path)
+    assert manifest.execute("SELECT COUNT(*) FROM hourly").fetchone()[0] == 0
+
+    up.reconcile(save_path)
+    up.zip_tweets(save_path)
+    assert os.path.isfile(os.path.join(save_path, f"tweets-{day:%Y%m%d}.zip"))
+    # A host wrote again into one of its files after the merge
+    with open(hosts[1] / names[3], "a") as outf:
+        outf.write("late\n")
+    up.current = datetime.now(tz = timezone.utc)
+    up.sweep_sources()
+    assert sorted(os.listdir(hosts[0])) == []
+    assert sorted(os.listdir(hosts[1])) == [names[3]]
+    assert dict(manifest.execute(
+        "SELECT state, COUNT(*) FROM merged_sources GROUP BY state")) == \
+        {"removed": 47, "changed": 1}
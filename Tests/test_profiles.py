@@ -0,0 +1,73 @@
+""" Projection profiles of the crawler settings, and the trimming of the
+tweets saved """
+
+import pytest
+
+from TweetNormalizer import FIELDS_EXPANSIONS, get_profile, \
+    normalize_tweet, read_profiles, trim_json
+
+
+def read(tmp_path, text: str) -> (dict, str):
+    path = tmp_path / "crawler_settings.txt"
+    path.write_text(text)
+    return read_profiles(str(path))
+
+
+def test_profiles_are_read(tmp_path, capsys):
+    assert read(tmp_path, "working_dir=/tmp\n") == ({"full": {}}, "full")
+    profiles, name = read(
+        tmp_path,
+        "projection_profile=lite\n"
+        "profile.lite.tweet_fields=id, text,author_id,created_at,,lang\n"
+        "profile.lite.drop=data.entities.annotations\n"
+        "profile.lite.colour=red\n"
+        "profile.other=1\n")
+    assert name == "lite"
+    assert profiles["lite"] == {
+        "tweet_fields": ["id", "text", "author_id", "created_at", "lang"],
+        "drop": ["data.entities.annotations"]}
+    err = capsys.readouterr().err
+    assert "Incorrect profile option: profile.lite.colour" in err
+    assert "Incorrect profile option: profile.other" in err
+
+    profile = get_profile(profiles, name)
+    assert profile["expansions"] == FIELDS_EXPANSIONS
+    assert profile["drop"] == {"data": {"entities": {"annotations": {}}}}
+    assert profile["keep"] == {}
+
+
+@pytest.mark.parametrize("text", [
+    "projection_profile=missing\n",
+    "profile.lite.expansions=geo.place_id\n",
+    "profile.lite.tweet_fields=id,text,author_id\n",
+])
+def test_unusable_profiles_are_refused(tmp_path, text):
+    with pytest.raises(ValueError):
+        read(tmp_path, text)
+
+
+def test_trim_json():
+    tweet = {"data": {"id": "1", "text": "", "entities": {"urls": []},
+                      "geo": None, "public_metrics": {"likes": 0}},
+             "includes": [{}, {"id": "2"}, []]}
+    assert not trim_json(tweet)
+    assert tweet == {"data": {"id": "1", "public_metrics": {"likes": 0}},
+                     "includes": [{"id": "2"}]}
+    assert trim_json({"a": [{"b": ""}], "c": None})
+    assert trim_json(None)
+    assert not trim_json(0)
+
+
+def test_tweets_are_projected():
+    profiles = {"lite": {"keep": ["data", "includes.users.id"],
+                         "drop": ["data.lang"]}}
+    tweet = {"data": {"id": "1", "text": "Tweet", "author_id": "2",
+                      "created_at": "2024-01-01T00:00:00.000Z", "lang": "en",
+                      "entities": {}},
+             "includes": {"users": [{"id": "2", "name": "User"}]},
+             "matching_rules": [{"id": "3", "tag": "news:a"}]}
+    assert normalize_tweet(tweet, get_profile(profiles, "lite")) == (
+        '{"data":{"author_id":"2","created_at":"2024-01-01T00:00:00.000Z",'
+        '"id":"1","text":"Tweet"},"includes":{"users":[{"id":"2"}]}}\n')
+    assert normalize_tweet({"data": {"id": "1"}},
+                           get_profile({"full": {}}, "full")) is None
@@ -0,0 +1,109 @@
+""" The raw ingest mode of the crawler, normalized by the uploader, against
+the parsed mode """
+
+import json
+import os
+from datetime import datetime, timezone
+
+import pytest
+
+import TweetCrawler
+from TweetNormalizer import scan_raw_geo, scan_raw_tweet, tweet_facts
+
+HOUR = datetime.now(tz = timezone.utc)
+CREATED_AT = HOUR.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+USERS = {"users": [{"id": "1", "name": "User", "username": "user"}]}
+
+
+def tweet(tweet_id, text: str = "Tweet", **fields) -> dict:
+    return {"id": str(tweet_id), "text": text, "author_id": "1",
+            "created_at": CREATED_AT, **fields}
+
+
+def rules(*tags) -> list:
+    return [{"id": str(i), "tag": tag} for i, tag in enumerate(tags)]
+
+
+PAYLOADS = [
+    json.dumps({"data": tweet(1, 'Say "hi" \\ "geo": {}'),
+                "includes": USERS, "matching_rules": rules("news:a")}),
+    # Compact, with "data" last and created_at before id
+    json.dumps({"includes": USERS, "matching_rules": rules("news:a"),
+                "data": {"created_at": CREATED_AT, "id": "2",
+                         "text": "Ends with \\", "author_id": "1",
+                         "entities": {"mentions": [{"id": "99"}]}}},
+               separators = (",", ":")),
+    # A location, and a nested "matching_rules" key before the real one
+    json.dumps({"data": tweet(3, geo = {"place_id": "p1"}),
+                "includes": {**USERS, "places": [{"id": "p1",
+                                                  "country_code": "FR"}],
+                             "tweets": [{"id": "7", "matching_rules": []}]},
+                "matching_rules": rules("news:a", "news:b")}),
+    json.dumps({"data": tweet(4, 'The "matching_rules": [{"tag": "x"}]',
+                              geo = None),
+                "includes": USERS, "matching_rules": rules("news:b")}),
+    # Without data.id, not a tweet
+    json.dumps({"data": {"text": "No id", "created_at": CREATED_AT},
+                "includes": USERS, "matching_rules": rules("news:a")}),
+    json.dumps({"errors": [{"title": "operational-disconnect"}]}),
+]
+
+
+@pytest.fixture
+def crawl(tmp_path):
+    """ Save the payloads with a crawler in a mode, return its working_dir """
+    def run(mode: str, working_dir) -> str:
+        settings = tmp_path / f"crawler_{mode}.txt"
+        settings.write_text(
+            f"working_dir={working_dir}\n"
+            f"twitter_bear_token=token\n"
+            f"log_file={tmp_path / f'crawler_{mode}.log'}\n"
+            f"ingest_mode={mode}\n"
+            f"streams=sample,news\n"
+            f"stream.news.rule.a=a\n"
+            f"stream.news.rule.b=b\n")
+        TweetCrawler.setup(str(settings))
+        save = TweetCrawler.save_raw_tweet if mode == "raw" \
+            else TweetCrawler.save_tweet
+        for data in PAYLOADS:
+            save(data)
+        TweetCrawler.close_all_files()
+        return str(settings)
+    return run
+
+
+def test_raw_files_normalize_to_the_parsed_files(crawl, uploader, tmp_path):
+    crawl("parsed", tmp_path / "parsed")
+    settings = crawl("raw", tmp_path / "tweets")
+    save_path = str(tmp_path / "tweets")
+    raw_names = []
+    for name in os.listdir(save_path):
+        if name.endswith(".raw.tmp"):
+            os.rename(os.path.join(save_path, name),
+                      os.path.join(save_path, name[:-4]))
+            raw_names.append(name[:-4])
+    assert len(raw_names) == 1
+    up = uploader(crawler_settings = settings)
+    up.normalize_raw_files(save_path, raw_names)
+
+    parsed = {name[:-4] for name in os.listdir(tmp_path / "parsed")
+              if name.endswith(".tmp")}
+    assert parsed == {raw_names[0][:-4]}
+    for name in parsed:
+        with open(tmp_path / "parsed" / f"{name}.tmp", "rb") as inf:
+            expected = inf.read()
+        with open(os.path.join(save_path, name), "rb") as inf:
+            assert inf.read() == expected
+        assert len(expected.splitlines()) == 4
+
+
+def test_scanners_agree_with_the_parser():
+    for data in PAYLOADS:
+        payload = json.loads(data)
+        fields = payload.get("data", {})
+        assert scan_raw_tweet(data) == (fields.get("id"),
+                                        fields.get("created_at"))
+        if "id" in fields:
+            assert scan_raw_geo(data) == tweet_facts(payload)[3]
+    assert [scan_raw_geo(data) for data in PAYLOADS[:4]] == \
+        [False, False, True, False]
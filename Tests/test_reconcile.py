@@ -0,0 +1,154 @@
+""" Bringing the manifest in line with the files of working_dir """
+
+import gzip
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+DAY = datetime.now(tz = timezone.utc) - timedelta(days = 3)
+
+
+def write_hour(path, ids, mode: str = "w") -> None:
+    with open(path, mode) as outf:
+        for tid in ids:
+            outf.write(json.dumps({"data": {"id": str(tid)}}) + "\n")
+
+
+def read_ids(path) -> list:
+    with gzip.open(path, "rt") if str(path).endswith(".gz") \
+            else open(path) as inf:
+        return [int(json.loads(line)["data"]["id"]) for line in inf]
+
+
+def test_late_file_is_appended_to_the_gzip(uploader, tmp_path):
+    up = uploader()
+    manifest = getattr(up, "__manifest")
+    save_path = str(tmp_path / "tweets")
+    name = f"tweets-{DAY:%Y%m%d}-05"
+    path = os.path.join(save_path, name)
+    write_hour(path, range(1, 11))
+    up.record_hourly(save_path, name)
+    assert up.compress_hourly(manifest, save_path, name)
+
+    # The crawler finished the hour again after the compression
+    write_hour(path, range(11, 14))
+    up.reconcile(save_path)
+    assert not os.path.isfile(path)
+    assert read_ids(f"{path}.gz") == list(range(1, 14))
+    size, stored = manifest.execute(
+        "SELECT size, stored FROM hourly WHERE name = ?", (name,)).fetchone()
+    assert (size, stored) == (os.path.getsize(f"{path}.gz"), "gzip")
+
+    # Interrupted before the removal of the file, it is not appended twice
+    write_hour(path, range(11, 14))
+    up.reconcile(save_path)
+    assert not os.path.isfile(path)
+    assert read_ids(f"{path}.gz") == list(range(1, 14))
+
+
+def test_interrupted_compression_keeps_the_file(uploader, tmp_path):
+    up = uploader()
+    save_path = str(tmp_path / "tweets")
+    name = f"tweets-{DAY:%Y%m%d}-05"
+    path = os.path.join(save_path, name)
+    write_hour(path, range(1, 11))
+    up.record_hourly(save_path, name)
+    # Renamed, but the manifest does not know the gzip yet
+    with open(path, "rb") as inf, gzip.open(f"{path}.gz", "wb") as outf:
+        outf.write(inf.read())
+    up.reconcile(save_path)
+    assert not os.path.isfile(f"{path}.gz")
+    assert read_ids(path) == list(range(1, 11))
+
+
+def test_only_copies_of_archived_hours_are_removed(uploader, tmp_path):
+    up = uploader()
+    save_path = str(tmp_path / "tweets")
+    names = [f"tweets-{DAY:%Y%m%d}-{h:02d}" for h in range(24)]
+    for h, name in enumerate(names):
+        write_hour(os.path.join(save_path, name), range(h * 10, h * 10 + 10))
+        up.record_hourly(save_path, name)
+    up.zip_tweets(save_path)
+    assert os.listdir(save_path).count(f"tweets-{DAY:%Y%m%d}.zip") == 1
+
+    # The removal after the zip was interrupted
+    write_hour(os.path.join(save_path, names[3]), range(30, 40))
+    # Tweets of an hour finished after its day was zipped
+    write_hour(os.path.join(save_path, names[4]), range(1000, 1003))
+    up.reconcile(save_path)
+    assert not os.path.isfile(os.path.join(save_path, names[3]))
+    assert read_ids(os.path.join(save_path, names[4])) == \
+        list(range(1000, 1003))
+
+
+def test_flag_files_are_imported_once(uploader, tmp_path):
+    up = uploader()
+    manifest = getattr(up, "__manifest")
+    save_path = str(tmp_path / "tweets")
+    flags = {"20240101": ["ready"], "20240102": ["uploading"],
+             "20240103": ["uploaded"],
+             # After a crash, the furthest flag wins
+             "20240104": ["ready", "uploading", "uploaded"],
+             # Without its zip, only the flag is removed
+             "20240105": ["uploaded"]}
+    for day, day_flags in flags.items():
+        if day != "20240105":
+            with open(os.path.join(save_path, f"tweets-{day}.zip"), "wb") \
+                    as outf:
+                outf.write(b"zip")
+        for flag in day_flags:
+            open(os.path.join(save_path, f"tweets-{day}.zip.{flag}"),
+                 "w").close()
+    up.reconcile(save_path)
+    assert sorted(manifest.execute(
+        "SELECT name, prefix, day, size, state FROM archives")) == [
+        ("tweets-20240101.zip", "tweets", "20240101", 3, "ready"),
+        ("tweets-20240102.zip", "tweets", "20240102", 3, "uploading"),
+        ("tweets-20240103.zip", "tweets", "20240103", 3, "uploaded"),
+        ("tweets-20240104.zip", "tweets", "20240104", 3, "uploaded")]
+    assert not any(n.endswith(("ready", "uploading", "uploaded"))
+                   for n in os.listdir(save_path))
+
+    # A flag left after the import does not move the zip back
+    open(os.path.join(save_path, "tweets-20240103.zip.ready"), "w").close()
+    up.reconcile(save_path)
+    assert manifest.execute(
+        "SELECT state FROM archives WHERE name = 'tweets-20240103.zip'"
+    ).fetchone() == ("uploaded",)
+
+
+def test_missing_files_leave_the_manifest(uploader, tmp_path):
+    up = uploader()
+    manifest = getattr(up, "__manifest")
+    save_path = str(tmp_path / "tweets")
+    names = [f"tweets-{DAY:%Y%m%d}-{h:02d}" for h in range(2)]
+    for name in names:
+        write_hour(os.path.join(save_path, name), range(10))
+    zn = f"tweets-{DAY:%Y%m%d}.zip"
+    with open(os.path.join(save_path, zn), "wb") as outf:
+        outf.write(b"zip")
+    open(os.path.join(save_path, f"{zn}.ready"), "w").close()
+    up.reconcile(save_path)
+    assert manifest.execute("SELECT COUNT(*) FROM hourly").fetchone() == (2,)
+
+    os.remove(os.path.join(save_path, names[1]))
+    os.remove(os.path.join(save_path, zn))
+    up.reconcile(save_path)
+    assert list(manifest.execute("SELECT name FROM hourly")) == \
+        [(names[0],)]
+    assert manifest.execute("SELECT COUNT(*) FROM archives").fetchone() == \
+        (0,)
+
+
+def test_leftover_tmp_files_are_not_recorded(uploader, tmp_path):
+    up = uploader()
+    manifest = getattr(up, "__manifest")
+    save_path = str(tmp_path / "tweets")
+    name = f"tweets-{DAY:%Y%m%d}-05"
+    write_hour(os.path.join(save_path, f"{name}.tmp"), range(10))
+    write_hour(os.path.join(save_path, f"{name}.gz.part"), range(10))
+    tmp_names, raw_names, summary_names = up.reconcile(save_path)
+    assert (tmp_names, raw_names, summary_names) == ([f"{name}.tmp"], [], [])
+    assert manifest.execute("SELECT COUNT(*) FROM hourly").fetchone() == (0,)
+    assert os.path.isfile(os.path.join(save_path, f"{name}.tmp"))
+    assert not os.path.isfile(os.path.join(save_path, f"{name}.gz.part"))
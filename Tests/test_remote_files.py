@@ -0,0 +1,126 @@
+""" The cached inventory of the Google Drive folder, against the Drive
+stand-in """
+
+import hashlib
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+
+@pytest.fixture
+def run_uploader(uploader):
+    """ Refresh the inventory as a new run of the uploader does, return its
+    manifest """
+    def run(**settings):
+        up = uploader(**settings)
+        up.refresh_remote_files()
+        return getattr(up, "__manifest")
+    return run
+
+
+def remote_rows(manifest) -> list:
+    return sorted(manifest.execute("SELECT id, name FROM remote_files"))
+
+
+def remote_state(manifest) -> dict:
+    return dict(manifest.execute("SELECT key, value FROM remote_state"))
+
+
+def add_folder(drive) -> None:
+    drive.add_file("Tweets", fid = "folder")
+
+
+def test_rebuild_pages_through_the_folder(run_uploader, drive):
+    add_folder(drive)
+    ids = [drive.add_file(f"tweets-2024010{d}.zip", "folder") for d in
+           range(1, 6)]
+    drive.add_file("elsewhere.zip", "other")
+    trashed = drive.add_file("tweets-20240106.zip", "folder")
+    drive.update_file(trashed, trashed = True)
+    manifest = run_uploader(google_drive_folder_id = "folder")
+    assert [fid for fid, _ in remote_rows(manifest)] == sorted(ids)
+    assert remote_state(manifest) == {"folder": "folder",
+                                      "page_token": str(len(drive.changes))}
+    # The token, the first page and the folder name in one batch, then the
+    # other pages of 2 files
+    assert drive.batches == [3]
+    assert drive.requests.count(("GET", "/files")) == 3
+
+
+def test_changes_are_applied_page_by_page(run_uploader, drive):
+    add_folder(drive)
+    kept = drive.add_file("tweets-20240101.zip", "folder")
+    trashed = drive.add_file("tweets-20240102.zip", "folder")
+    moved = drive.add_file("tweets-20240103.zip", "folder")
+    run_uploader(google_drive_folder_id = "folder")
+
+    added = drive.add_file("tweets-20240104.zip", "folder")
+    drive.add_file("elsewhere.zip", "other")
+    drive.update_file(trashed, trashed = True)
+    drive.update_file(moved, parents = ["other"])
+    drive.requests.clear()
+    manifest = run_uploader(google_drive_folder_id = "folder")
+    assert remote_rows(manifest) == sorted(
+        [(kept, "tweets-20240101.zip"), (added, "tweets-20240104.zip")])
+    # Read from the new start page token of the last page, not listed again
+    assert remote_state(manifest)["page_token"] == str(len(drive.changes))
+    assert drive.requests.count(("GET", "/files")) == 0
+    assert drive.requests.count(("GET", "/changes")) == 2
+
+    # Nothing changed since
+    manifest = run_uploader(google_drive_folder_id = "folder")
+    assert [fid for fid, _ in remote_rows(manifest)] == sorted([kept, added])
+
+
+def test_invalid_token_rebuilds(run_uploader, drive):
+    add_folder(drive)
+    first = drive.add_file("tweets-20240101.zip", "folder")
+    run_uploader(google_drive_folder_id = "folder")
+    second = drive.add_file("tweets-20240102.zip", "folder")
+    drive.expire_tokens()
+    manifest = run_uploader(google_drive_folder_id = "folder")
+    assert [fid for fid, _ in remote_rows(manifest)] == sorted([first, second])
+    assert remote_state(manifest)["page_token"] == str(len(drive.changes))
+    assert drive.requests.count(("GET", "/files")) == 2
+
+
+def test_files_of_my_drive_stay_cached(run_uploader, drive):
+    """ Without a folder id, the files are in My Drive, whose parents are
+    its id rather than "root" """
+    first = drive.add_file("tweets-20240101.zip")
+    manifest = run_uploader()
+    assert remote_state(manifest)["folder"] == drive.ROOT_ID
+    second = drive.add_file("tweets-20240102.zip")
+    drive.update_file(first, md5Checksum = "1" * 32)
+    manifest = run_uploader()
+    assert [fid for fid, _ in remote_rows(manifest)] == sorted([first, second])
+    assert manifest.execute("SELECT md5 FROM remote_files WHERE id = ?",
+                            (first,)).fetchone() == ("1" * 32,)
+
+
+def test_only_runs_with_zips_to_check_list_the_folder(uploader, drive,
+                                                       tmp_path):
+    add_folder(drive)
+    save_path = str(tmp_path / "tweets")
+    up = uploader(google_drive_folder_id = "folder", keep_files_for_days = 2)
+    up.worker(save_path)
+    assert drive.requests == []
+
+    # A zip to sweep, whose copy is checked first
+    day = datetime.now(tz = timezone.utc) - timedelta(days = 5)
+    zn = f"tweets-{day:%Y%m%d}.zip"
+    with open(os.path.join(save_path, zn), "wb") as outf:
+        outf.write(b"zip")
+    now = time.time()
+    with getattr(up, "__manifest") as manifest:
+        manifest.execute(
+            "INSERT INTO archives (name, prefix, day, size, checksum, state, "
+            "created, updated) "
+            "VALUES (?, 'tweets', ?, 3, ?, 'uploaded', ?, ?)",
+            (zn, f"{day:%Y%m%d}", hashlib.md5(b"zip").hexdigest(), now, now))
+    drive.add_file(zn, "folder", md5 = hashlib.md5(b"zip").hexdigest())
+    up.worker(save_path)
+    assert ("GET", "/files") in drive.requests
+    assert not os.path.isfile(os.path.join(save_path, zn))
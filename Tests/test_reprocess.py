@@ -0,0 +1,66 @@
+""" Reprocessing archived days """
+
+import json
+import os
+import zipfile
+
+import pytest
+
+import Reprocess
+from ArchiveCodec import dictionary_name, open_member, open_member_writer
+
+MEMBERS = ["tweets-20240101-00", "tweets-20240101-01"]
+
+
+def hour_text(hour: int) -> str:
+    return "".join(
+        json.dumps({"data": {"id": str(n), "text": "x", "author_id": "1",
+                             "created_at": "2024-01-01T00:00:00.000Z"},
+                    "includes": {"users": [{"id": "1"}]}}) + "\n"
+        for n in range(hour * 10, hour * 10 + 10))
+
+
+def read_ids(data: bytes) -> list:
+    return [int(json.loads(line)["data"]["id"]) for line in
+            data.decode("utf-8").splitlines()]
+
+
+def run_reprocess(tmp_path, dictionary: bytes = None) -> zipfile.ZipFile:
+    """ Reprocess a day archived with the codec of the dictionary, return
+    the new archive """
+    settings = tmp_path / "crawler_settings.txt"
+    settings.write_text("projection_profile=full\n")
+    archive_dir = tmp_path / "archives"
+    output_dir = tmp_path / "output"
+    archive_dir.mkdir()
+    output_dir.mkdir()
+    with zipfile.ZipFile(archive_dir / "tweets-20240101.zip", "w") as zf:
+        if dictionary is not None:
+            zf.writestr(dictionary_name(7), dictionary)
+        for hour, member in enumerate(MEMBERS):
+            with open_member_writer(zf, member, dictionary, False) as zm:
+                zm.write(hour_text(hour).encode("utf-8"))
+
+    Reprocess.reprocess(str(settings), str(archive_dir), str(output_dir), 1)
+    assert sorted(os.listdir(output_dir)) == [Reprocess.CHECKPOINT_NAME,
+                                              "tweets-20240101.zip"]
+    return zipfile.ZipFile(output_dir / "tweets-20240101.zip")
+
+
+def test_zipped_days_leave_no_sidecars(tmp_path):
+    with run_reprocess(tmp_path) as zf:
+        assert zf.namelist() == MEMBERS
+        assert read_ids(zf.read(MEMBERS[1])) == list(range(10, 20))
+
+
+def test_zstd_days_keep_their_codec(tmp_path):
+    pytest.importorskip("zstandard")
+    dictionary = hour_text(5).encode("utf-8")
+    with run_reprocess(tmp_path, dictionary) as zf:
+        assert zf.namelist() == [dictionary_name(7)] + \
+            [f"{member}.zst" for member in MEMBERS]
+        assert zf.read(dictionary_name(7)) == dictionary
+        for hour, member in enumerate(MEMBERS):
+            with open_member(zf, member) as zm:
+                assert read_ids(zm.read()) == \
+                    list(range(hour * 10, hour * 10 + 10))
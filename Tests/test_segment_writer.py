@@ -0,0 +1,68 @@
+""" The memory-mapped writer of the hourly files, and the padding it leaves
+after a crash """
+
+import os
+from datetime import datetime, timedelta, timezone
+
+from SegmentWriter import MmapSegmentWriter, trim_padding
+
+EXTENT = 4096
+
+
+def test_writer_grows_by_extents_and_truncates_on_close(tmp_path):
+    path = str(tmp_path / "tweets-20240101-05.tmp")
+    writer = MmapSegmentWriter(path, EXTENT)
+    assert os.path.getsize(path) == EXTENT
+    lines = [f"{n:09d}\n" * 10 for n in range(100)]
+    for line in lines:
+        assert writer.write(line) == len(line)
+    assert writer.tell() == 10000
+    # Preallocated past the text, in whole extents
+    assert os.path.getsize(path) == 3 * EXTENT
+    writer.close()
+    assert writer.closed
+    writer.close()
+    with open(path) as inf:
+        assert inf.read() == "".join(lines)
+
+
+def test_writer_appends_after_the_padding_of_a_crash(tmp_path):
+    path = str(tmp_path / "tweets-20240101-05.tmp")
+    # The text of a writer that was not closed, in its preallocated extent
+    with open(path, "wb") as outf:
+        outf.write(b"first\n".ljust(EXTENT, b"\0"))
+    writer = MmapSegmentWriter(path, EXTENT)
+    assert writer.tell() == 6
+    writer.write("second\n")
+    writer.close()
+    with open(path) as inf:
+        assert inf.read() == "first\nsecond\n"
+
+
+def test_trim_padding(tmp_path):
+    path = str(tmp_path / "tweets-20240101-05.tmp")
+    with open(path, "wb") as outf:
+        outf.write(b"first\n" + b"\0" * 100000)
+    assert trim_padding(path) == 100000
+    assert trim_padding(path) == 0
+    with open(path, "rb") as inf:
+        assert inf.read() == b"first\n"
+    with open(path, "wb") as outf:
+        outf.write(b"\0" * 10)
+    assert trim_padding(path) == 10
+    assert os.path.getsize(path) == 0
+
+
+def test_finished_files_are_trimmed(uploader, tmp_path):
+    up = uploader()
+    save_path = str(tmp_path / "tweets")
+    hour = datetime.now(tz = timezone.utc) - timedelta(hours = 3)
+    name = hour.strftime("tweets-%Y%m%d-%H")
+    with open(os.path.join(save_path, f"{name}.tmp"), "wb") as outf:
+        outf.write(b'{"data": {"id": "1"}}\n'.ljust(EXTENT, b"\0"))
+    assert up.finish_files(save_path) == [name]
+    with open(os.path.join(save_path, name), "rb") as inf:
+        assert inf.read() == b'{"data": {"id": "1"}}\n'
+    assert getattr(up, "__manifest").execute(
+        "SELECT size FROM hourly WHERE name = ?", (name,)).fetchone() == \
+        (22,)
@@ -0,0 +1,133 @@
+""" The streams of the crawler settings, and the rules of the filtered
+stream kept in line with them """
+
+import os
+
+import pytest
+
+import TweetCrawler
+from TweetNormalizer import read_streams
+
+
+def write_settings(path, text: str) -> str:
+    path.write_text(text)
+    return str(path)
+
+
+def test_streams_are_read(tmp_path):
+    settings = tmp_path / "crawler_settings.txt"
+    assert read_streams(write_settings(settings, "")) == {
+        "sample": {"prefix": "tweets", "rules": {}, "backfill_query": None}}
+    assert read_streams(write_settings(
+        settings,
+        "streams=sample, news\n"
+        "stream.sample.prefix=all\n"
+        "stream.news.rule.a=#a lang:en\n"
+        "stream.news.rule.b=\n"
+        "stream.news.backfill_query=#a OR #b\n"
+        "stream.other.rule.c=c\n")) == {
+        "sample": {"prefix": "all", "rules": {}, "backfill_query": None},
+        "news": {"prefix": "news", "rules": {"news:a": "#a lang:en"},
+                 "backfill_query": "#a OR #b"}}
+
+
+@pytest.mark.parametrize("text", [
+    "streams=bad-name\n",
+    "streams=news\nstream.news.prefix=tweets-2\n",
+    "streams=a,b\nstream.a.rule.x=x\nstream.b.rule.x=x\n"
+    "stream.b.prefix=a\n",
+    "streams=sample,news\n",
+])
+def test_incorrect_streams_are_refused(tmp_path, text):
+    with pytest.raises(ValueError):
+        read_streams(write_settings(tmp_path / "crawler_settings.txt", text))
+
+
+class FakeRules:
+    """ The rules of the filtered stream, as tweepy.Client returns them """
+
+    def __init__(self, rules: dict):
+        from tweepy import StreamingRule
+        self.rules = [StreamingRule(value, tag, str(i))
+                      for i, (tag, value) in enumerate(rules.items())]
+        self.deleted = []
+        self.added = []
+
+    def get_rules(self):
+        return type("Response", (), {"data": self.rules})
+
+    def delete_rules(self, ids: list) -> None:
+        self.deleted.extend(ids)
+        self.rules = [r for r in self.rules if r.id not in ids]
+
+    def add_rules(self, rules: list):
+        self.added.extend((r.tag, r.value) for r in rules)
+        self.rules.extend(rules)
+        return type("Response", (), {"errors": []})
+
+    def current(self) -> dict:
+        return {r.tag: r.value for r in self.rules}
+
+
+@pytest.fixture
+def crawler(tmp_path, monkeypatch):
+    """ The crawler with the streams of a settings file, without a log """
+    pytest.importorskip("tweepy")
+    monkeypatch.setattr(TweetCrawler, "__log_file", None)
+
+    def load(text: str) -> str:
+        path = write_settings(tmp_path / "crawler_settings.txt", text)
+        monkeypatch.setattr(TweetCrawler, "__setting_path", path)
+        monkeypatch.setattr(TweetCrawler, "__streams", read_streams(path))
+        monkeypatch.setattr(TweetCrawler, "__streams_mtime",
+                            os.path.getmtime(path))
+        return path
+    return load
+
+
+def test_rules_are_synced(crawler):
+    crawler("streams=sample,news,sports\n"
+            "stream.news.rule.a=#a\nstream.news.rule.b=#b2\n"
+            "stream.sports.rule.c=#c\n")
+    client = FakeRules({"news:a": "#a", "news:b": "#b", "old:x": "#x"})
+    TweetCrawler.sync_rules(client)
+    assert sorted(client.deleted) == ["1", "2"]
+    assert sorted(client.added) == [("news:b", "#b2"), ("sports:c", "#c")]
+    assert client.current() == {"news:a": "#a", "news:b": "#b2",
+                                "sports:c": "#c"}
+    # Nothing to change
+    client.deleted.clear()
+    client.added.clear()
+    TweetCrawler.sync_rules(client)
+    assert (client.deleted, client.added) == ([], [])
+
+
+def test_rule_changes_are_applied_without_restart(crawler, monkeypatch):
+    path = crawler("streams=sample,news\nstream.news.rule.a=#a\n")
+    client = FakeRules({"news:a": "#a"})
+    monkeypatch.setattr(TweetCrawler, "__filter_stream", client)
+    edits = [
+        "streams=sample,news\nstream.news.rule.a=#a2\n",
+        # Not applied without a restart
+        "streams=news\nstream.news.rule.a=#a3\n",
+        "streams=sample,news\nstream.news.rule.a=#a2\nstream.news.rule.b=#b\n",
+    ]
+    applied = []
+
+    def sleep(seconds: float) -> None:
+        if len(applied) > 0:
+            applied[-1] = client.current()
+        if len(edits) == 0:
+            raise KeyboardInterrupt
+        with open(path, "w") as outf:
+            outf.write(edits.pop(0))
+        # A new mtime, as a later edit of the file would have
+        mtime = os.path.getmtime(path) + len(applied) + 1
+        os.utime(path, (mtime, mtime))
+        applied.append(None)
+
+    monkeypatch.setattr(TweetCrawler.time, "sleep", sleep)
+    with pytest.raises(KeyboardInterrupt):
+        TweetCrawler.watch_rules()
+    assert applied == [{"news:a": "#a2"}, {"news:a": "#a2"},
+                       {"news:a": "#a2", "news:b": "#b"}]
@@ -0,0 +1,97 @@
+""" The summaries of the hourly files, kept two weeks for the weekly
+digest """
+
+import os
+from datetime import datetime, timedelta, timezone
+
+from TweetNormalizer import HourSummary, read_summary, write_summary
+
+NOW = datetime.now(tz = timezone.utc)
+
+
+def summary_of(facts: list, lags: list = (), shed: int = 0,
+               spilled: int = 0) -> HourSummary:
+    summary = HourSummary()
+    for fact, lag in zip(facts, list(lags) + [None] * len(facts)):
+        summary.add(fact, lag)
+    summary.shed, summary.spilled = shed, spilled
+    return summary
+
+
+def write_hour_summary(save_path: str, prefix: str, days_ago: int,
+                       summary: HourSummary) -> str:
+    name = f"{prefix}-{NOW - timedelta(days = days_ago):%Y%m%d}-05"
+    write_summary(os.path.join(save_path, name), summary)
+    return f"{name}.summary"
+
+
+def test_summaries_merge(tmp_path):
+    first = summary_of([("en", "FR", "web", True), ("fr", None, "web", False)],
+                       [2.5, 0.5], shed = 3)
+    second = summary_of([("en", None, "app", False)], [7.0], spilled = 2)
+    first.merge(second)
+    assert (first.tweets, first.shed, first.spilled) == (3, 3, 2)
+    assert first.top("lang", 10) == [("en", 2), ("fr", 1)]
+    assert first.top("country", 1) == [("", 2)]
+    assert list(first.geo) == [2, 1]
+    assert (first.min_lag, first.max_lag) == (0.5, 7.0)
+    assert HourSummary(first.to_dict()).to_dict() == first.to_dict()
+
+    # A sidecar already there is added to
+    path = str(tmp_path / "tweets-20240101-05")
+    write_summary(path, second)
+    write_summary(path, second)
+    saved = read_summary(path)
+    assert (saved.tweets, saved.spilled) == (2, 4)
+    assert saved.top("source", 10) == [("app", 2)]
+
+
+def test_summaries_are_kept_two_weeks(uploader, tmp_path):
+    up = uploader()
+    up.current = NOW
+    save_path = str(tmp_path / "tweets")
+    names = [write_hour_summary(save_path, "tweets", days, HourSummary())
+             for days in (13, 14, 15)]
+    up.sweep_summaries(save_path, names)
+    assert sorted(n for n in os.listdir(save_path)
+                  if n.endswith(".summary")) == sorted(names[:2])
+
+
+def test_weekly_digest(uploader, tmp_path):
+    up = uploader()
+    up.current = NOW
+    save_path = str(tmp_path / "tweets")
+    for days in (1, 2):
+        write_hour_summary(save_path, "tweets", days, summary_of(
+            [("en", "FR", "web", True)] + [("fr", None, "app", False)] * 3,
+            [1.0, 4.0], shed = days))
+    write_hour_summary(save_path, "news", 3, summary_of(
+        [("de", None, "web", False)]))
+    # Outside of the last 7 days
+    for days in (0, 8):
+        write_hour_summary(save_path, "tweets", days, summary_of(
+            [("ja", None, "web", False)] * 100))
+    day = [f"{NOW - timedelta(days = d):%Y%m%d}" for d in range(8)]
+    assert up.build_weekly_digest(save_path).splitlines() == [
+        f"Tweets from {day[7]} to {day[1]} (UTC)",
+        "",
+        "news",
+        "  Day         Hours      Tweets     Geo",
+        f"  {day[3]}        1           1    0.0%",
+        "  Total           1           1    0.0%",
+        "  Top lang: de 100.0%",
+        "  Top country: (none) 100.0%",
+        "  Top source: web 100.0%",
+        "",
+        "tweets",
+        "  Day         Hours      Tweets     Geo",
+        f"  {day[2]}        1           4   25.0%",
+        f"  {day[1]}        1           4   25.0%",
+        "  Total           2           8   25.0%",
+        "  Top lang: fr 75.0%, en 25.0%",
+        "  Top country: (none) 75.0%, FR 25.0%",
+        "  Top source: app 75.0%, web 25.0%",
+        "  Shed under load: 3 tweets, written late: 0 tweets",
+        "  Delay: 1.0 s to 4.0 s"]
+    assert up.build_weekly_digest(str(tmp_path)).splitlines()[-1] == \
+        "No summaries"